@@ -0,0 +1,321 @@
+import datetime
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+ACCESS_EVENTS_DDL = """
+    CREATE TABLE IF NOT EXISTS access_events (
+        event_id CHAR(32) NOT NULL PRIMARY KEY,
+        lab_id VARCHAR(64) NOT NULL,
+        user_id VARCHAR(64) NULL,
+        reservation_id BIGINT NULL,
+        method VARCHAR(16) NOT NULL,
+        verified TINYINT(1) NOT NULL,
+        message VARCHAR(255) NULL,
+        created_at DATETIME(3) NOT NULL,
+        KEY access_events_lab_time (lab_id, created_at)
+    )
+"""
+
+# Column sizes above; record() cuts longer values down to fit
+FIELD_LIMITS = {"lab_id": 64, "user_id": 64, "method": 16, "message": 255}
+
+# The event id is the idempotency key: rows of a batch replayed after a
+# crash between commit and the offset update are left as they are. Unlike
+# INSERT IGNORE this still fails on a bad value instead of clamping it, so
+# the batch stays in the journal.
+INSERT_EVENTS_QUERY = """
+    INSERT INTO access_events
+        (event_id, lab_id, user_id, reservation_id, method, verified, message, created_at)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE event_id = event_id
+"""
+
+
+def install_access_events_table(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(ACCESS_EVENTS_DDL)
+    connection.commit()
+
+
+def read_offset(path):
+    try:
+        with open(path + ".offset") as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_offset(path, offset):
+    tmp_path = path + ".offset.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(str(offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path + ".offset")
+
+
+class RejectedBatch(Exception):
+    """The database took the connection but refused the batch."""
+
+
+def read_events(path, offset, limit):
+    """Up to ``limit`` complete events after byte ``offset``; returns them
+    and the offset just past the last one read."""
+    events = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while len(events) < limit:
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                # End of file, or an append still in progress
+                break
+            offset += len(line)
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                logger.error(f"Skipping unreadable journal line in {path} at {offset - len(line)}")
+    return events, offset
+
+
+class AccessJournal:
+    """Write-behind queue for check-ins and access events.
+
+    ``record`` appends one JSON line to a local append-only journal and
+    fsyncs it before returning, so the door decision never waits on RDS.
+    A flusher thread writes the journal to the database in batches: one
+    multi-row insert into access_events keyed by the event id, and
+    one ``UPDATE reservations SET checked = 1 ... IN (...)`` for the
+    check-ins among them. Both are idempotent, so a batch is retried with
+    backoff until the DB takes it, and the offset of the last flushed byte
+    is saved only after the commit. A fully flushed journal is truncated.
+    A batch the DB still refuses after ``max_attempts`` is written event by
+    event, and the events it refuses on their own are moved to
+    ``dead-letter.log`` in ``directory``, so they do not hold up the rest.
+
+    Each process locks its own ``journal-<n>.log`` in ``directory`` (server
+    workers included); a journal left behind by a process that is gone is
+    flushed by whichever process next finds it unlocked.
+
+    ``connect`` returns a DB connection usable as a context manager.
+    Nothing is opened until ``open``, so the object can be created before
+    a pre-fork server forks.
+    """
+
+    def __init__(self, directory, connect, batch_size=200, interval=5.0, max_backoff=60.0,
+                 compact_bytes=1024 ** 2, max_attempts=5):
+        self.directory = directory
+        self.connect = connect
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.compact_bytes = compact_bytes
+        self.max_attempts = max_attempts
+        self.path = None
+        self._file = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        # (journal path, offset, refusals) of the batch that keeps failing
+        self._refused = None
+
+    def open(self):
+        """Take a journal slot, replay what it still holds and start flushing."""
+        with self._lock:
+            if self._file is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            slot = 0
+            while True:
+                path = os.path.join(self.directory, f"journal-{slot}.log")
+                f = open(path, "a+b")
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    f.close()
+                    slot += 1
+            self._repair(f)
+            self.path = path
+            self._file = f
+            self._pending = self._count_pending(path)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="access-journal", daemon=True)
+            self._thread.start()
+        if self._pending:
+            logger.info(f"Replaying {self._pending} journaled access events from {path}")
+
+    def _repair(self, f):
+        # Drop a line torn by a crash mid-append, so new events start clean
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(max(0, size - 65536))
+        tail = f.read()
+        if not tail.endswith(b"\n"):
+            cut = tail.rfind(b"\n")
+            f.truncate(size - len(tail) + cut + 1 if cut >= 0 else 0)
+
+    def _count_pending(self, path):
+        count = 0
+        offset = read_offset(path)
+        while True:
+            events, offset = read_events(path, offset, self.batch_size)
+            if not events:
+                return count
+            count += len(events)
+
+    def record(self, lab_id, method, verified, user_id=None, reservation_id=None, message=None):
+        """Journal one access attempt; returns its event id once on disk.
+
+        A verified event with a ``reservation_id`` checks that reservation
+        in when it is flushed.
+        """
+        if self._file is None:
+            self.open()
+        event = {
+            "id": uuid.uuid4().hex,
+            "lab_id": str(lab_id),
+            "user_id": None if user_id is None else str(user_id),
+            "reservation_id": None if reservation_id is None else int(reservation_id),
+            "method": str(method),
+            "verified": bool(verified),
+            "message": None if message is None else str(message),
+            "at": datetime.datetime.now().isoformat(timespec="milliseconds"),
+        }
+        for field, limit in FIELD_LIMITS.items():
+            if event[field] is not None:
+                event[field] = event[field][:limit]
+        line = (json.dumps(event, separators=(",", ":")) + "\n").encode("utf-8")
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending += 1
+        self._wakeup.set()
+        return event["id"]
+
+    def pending(self):
+        return self._pending
+
+    def _write(self, events):
+        rows = [(e["id"], e["lab_id"], e["user_id"], e["reservation_id"], e["method"], e["verified"],
+                 e["message"], datetime.datetime.fromisoformat(e["at"])) for e in events]
+        check_ins = sorted({e["reservation_id"] for e in events if e["verified"] and e["reservation_id"]})
+        with self.connect() as connection:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.executemany(INSERT_EVENTS_QUERY, rows)
+                    if check_ins:
+                        placeholders = ", ".join(["%s"] * len(check_ins))
+                        cursor.execute(f"UPDATE reservations SET checked = 1 WHERE reservation_id IN ({placeholders})",
+                                       check_ins)
+                connection.commit()
+            except Exception as e:
+                raise RejectedBatch(e) from e
+
+    def _write_or_dead_letter(self, path, offset, events):
+        try:
+            self._write(events)
+            self._refused = None
+            return
+        except RejectedBatch:
+            attempts = 1
+            if self._refused is not None and self._refused[:2] == (path, offset):
+                attempts = self._refused[2] + 1
+            self._refused = (path, offset, attempts)
+            if attempts < self.max_attempts:
+                raise
+        # Find the events the DB refuses on their own; a connection error
+        # here leaves the batch to be retried as usual
+        dead = []
+        for event in events:
+            try:
+                self._write([event])
+            except RejectedBatch as e:
+                logger.error(f"Moving access event {event['id']} to the dead-letter log: {e}")
+                dead.append(event)
+        if dead:
+            with open(os.path.join(self.directory, "dead-letter.log"), "ab") as f:
+                f.write(b"".join((json.dumps(event, separators=(",", ":")) + "\n").encode("utf-8")
+                                 for event in dead))
+                f.flush()
+                os.fsync(f.fileno())
+        self._refused = None
+
+    def _flush(self, path, own):
+        offset = read_offset(path)
+        while not self._stop.is_set():
+            events, end = read_events(path, offset, self.batch_size)
+            if end == offset:
+                break
+            if events:
+                self._write_or_dead_letter(path, offset, events)
+            write_offset(path, end)
+            offset = end
+            if own:
+                with self._lock:
+                    self._pending -= len(events)
+        self._compact(path, offset, own)
+
+    def _compact(self, path, offset, own):
+        # Our own journal is kept until it grows past compact_bytes; one left
+        # by another process is emptied once written. The offset is reset
+        # first: a crash in between only replays events already written.
+        min_size = self.compact_bytes if own else 1
+        with self._lock:
+            if os.path.getsize(path) != offset or offset < min_size:
+                return
+            write_offset(path, 0)
+            with open(path, "r+b") as f:
+                f.truncate(0)
+
+    def _adopt(self):
+        for path in sorted(glob.glob(os.path.join(self.directory, "journal-*.log"))):
+            if path == self.path:
+                continue
+            with open(path, "a+b") as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Another live process owns it
+                    continue
+                self._repair(f)
+                self._flush(path, own=False)
+
+    def _run(self):
+        backoff = 1.0
+        while not self._stop.is_set():
+            # Cleared first, so an event recorded during the flush wakes the next one
+            self._wakeup.clear()
+            try:
+                self._flush(self.path, own=True)
+                self._adopt()
+                backoff = 1.0
+            except Exception as e:
+                logger.error(f"Failed to flush access journal, retrying in {backoff:.0f}s: {e}")
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            self._wakeup.wait(self.interval)
+
+    def close(self):
+        """Stop flushing; anything not yet written stays in the journal."""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(5)
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
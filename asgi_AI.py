@@ -0,0 +1,368 @@
+"""ASGI entry point for the face verification server.
+
+Serves the same ``/upload_image`` contract as flask_AI.py. Image decode,
+face detection and reservation loads run on a bounded thread pool, ArcFace
+batches are awaited through the shared MicroBatcher, and check-ins without
+write_behind go through aiomysql. The model, gallery, reservation cache and
+background jobs are the ones defined in flask_AI.py. Its throughput has not
+been measured against flask_AI.py; run both under the same load before
+switching a deployment.
+
+Run with a single worker process, since each process loads its own model:
+
+    uvicorn asgi_AI:app --host 0.0.0.0 --port 5000 --workers 1 \\
+        --loop uvloop --http httptools --limit-concurrency 64
+
+``inference_threads`` bounds CPU work in flight; requests past
+``max_pending`` wait for a slot instead of piling up in the thread pool.
+"""
+import asyncio
+import contextlib
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import aiomysql
+from pymysql.constants import CLIENT
+import cv2
+from starlette.applications import Starlette
+from starlette.formparsers import MultiPartException
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocketDisconnect
+
+import flask_AI as core
+from face_detection import parse_face_box
+from probe_protocol import decode_probe
+from verify_session import VerificationSession, frame_quality
+from reservation_cache import check_in_query
+
+inference_threads = 4
+max_pending = 32
+
+# /verify_stream: frames fused per session before giving up, and seconds
+# without a frame after which the session is decided on what it has
+stream_max_frames = 10
+stream_idle_timeout = 2.0
+
+executor = ThreadPoolExecutor(max_workers=inference_threads, thread_name_prefix="asgi-inference")
+pending = None
+db = None
+
+
+def aiomysql_config(config):
+    # aiomysql names the schema "db"; pymysql accepts both spellings
+    config = dict(config)
+    if "database" in config:
+        config["db"] = config.pop("database")
+    config["autocommit"] = True
+    # rowcount of the check-in UPDATE counts matched rows; see CHECK_IN_QUERY
+    config["client_flag"] = config.get("client_flag", 0) | CLIENT.FOUND_ROWS
+    return config
+
+
+async def run_blocking(fn, *args):
+    async with pending:
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+async def embed(*images):
+    futures = core.batcher.submit(images)
+    return await asyncio.gather(*(asyncio.wrap_future(f) for f in futures))
+
+
+def decode_and_prepare(image_data, face_box):
+    img = core.decode_image(image_data)
+    face = core.prepare_face(img, face_box)
+    if face is None:
+        return None, None
+    return face, cv2.flip(face, 1)
+
+
+async def lab_day(lab_id, date):
+    # A hit never leaves the event loop; a miss loads on the thread pool
+    day = core.reservation_cache.cached(lab_id, date)
+    if day is not None:
+        return day
+    return await run_blocking(core.reservation_cache.load, lab_id, date)
+
+
+async def check_in(lab_id, reservation, current_time):
+    if core.write_behind:
+        # No DB call; the journaled access event is the check-in
+        return core.check_in(lab_id, reservation, current_time)
+    # Same single conditional UPDATE as flask_AI.check_in
+    query, params = check_in_query(lab_id, reservation.reservation_id, current_time, core.reservation_window)
+    with core.db_seconds.labels(query="check_in").time():
+        async with db.acquire() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(query, params)
+                matched = cursor.rowcount
+    return core.checked_in(lab_id, reservation.reservation_id if matched else None, current_time)
+
+
+def decode_probe_and_prepare(body):
+    img, lab_id, face_box = decode_probe(body)
+    face = core.prepare_crop(img, face_box)
+    if face is None:
+        return lab_id, None, None
+    return lab_id, face, cv2.flip(face, 1)
+
+
+async def upload_image(request):
+    with core.request_seconds.time():
+        lab_id, response, status = await verify(request)
+    core.count_result(lab_id, response, status)
+    return JSONResponse(response, status_code=status)
+
+
+async def upload_probe(request):
+    # Compact probe_protocol envelope; see flask_AI.upload_probe
+    body = await request.body()
+    lab_id = None
+    with core.request_seconds.time():
+        try:
+            with core.stage_seconds.labels(stage="parse").time():
+                lab_id, face, mirr_face = await run_blocking(decode_probe_and_prepare, body)
+        except ValueError as e:
+            core.app.logger.error(f"ValueError: {e}")
+            response, status = {"error": str(e)}, 400
+        else:
+            response, status = await verify_face(lab_id, face, mirr_face)
+    core.count_result(lab_id, response, status)
+    return JSONResponse(response, status_code=status)
+
+
+async def verify(request):
+    """(lab_id, response, status) for an /upload_image request."""
+    stage = core.stage_seconds.labels
+    lab_id = None
+    try:
+        with stage(stage="parse").time():
+            form = await request.form()
+            file = form.get('image')
+            if file is None or not getattr(file, "filename", ""):
+                raise ValueError("No file part in form-data request")
+            lab_id = form.get('lab_id')
+            if not lab_id:
+                raise ValueError("Missing 'lab_id' in form-data request")
+            face_box = parse_face_box(form.get('face_box'))
+            image_data = await file.read()
+
+        with stage(stage="detect").time():
+            face, mirr_face = await run_blocking(decode_and_prepare, image_data, face_box)
+    except (ValueError, MultiPartException) as e:
+        core.app.logger.error(f"ValueError: {e}")
+        return lab_id, {"error": str(e)}, 400
+    except Exception as e:
+        core.app.logger.error(f"Unexpected error: {e}")
+        return lab_id, {"error": "An unexpected error occurred"}, 500
+    response, status = await verify_face(lab_id, face, mirr_face)
+    return lab_id, response, status
+
+
+async def verify_face(lab_id, face, mirr_face):
+    stage = core.stage_seconds.labels
+    try:
+        if face is None:
+            return {"verified": False, "message": "No face detected"}, 200
+        with stage(stage="embed").time():
+            key = core.probe_cache.key(face, core.model_name, lab_id)
+            features = core.probe_cache.get(key)
+            if features is None:
+                # The mirror pair always rides in the same batch
+                features = await embed(face, mirr_face)
+                if any(f is not None for f in features):
+                    core.probe_cache.put(key, features)
+        input_feature, mirr_input_feature = features
+        if input_feature is None and mirr_input_feature is None:
+            return {"error": "Feature extraction failed"}, 400
+
+        current_time = datetime.datetime.now()
+        with stage(stage="reservation").time():
+            day = await lab_day(lab_id, current_time.date())
+        with stage(stage="match").time():
+            response, reservation = core.match_reservation(day, input_feature, mirr_input_feature, current_time)
+        reservation_id = None
+        if reservation is not None:
+            with stage(stage="check_in").time():
+                reservation_id = await check_in(lab_id, reservation, current_time)
+            response = core.confirm_access(response, reservation_id)
+        await run_blocking(core.record_access, lab_id, "face", response, reservation_id)
+        return response, 200
+
+    except ValueError as e:
+        core.app.logger.error(f"ValueError: {e}")
+        return {"error": str(e)}, 400
+    except Exception as e:
+        core.app.logger.error(f"Unexpected error: {e}")
+        return {"error": "An unexpected error occurred"}, 500
+
+
+def decode_stream_frame(body):
+    _, face, mirr_face = decode_probe_and_prepare(body)
+    if face is None:
+        return None, None, 0.0
+    return face, mirr_face, frame_quality(face)
+
+
+async def verify_stream(websocket):
+    """Streaming verification: one WebSocket session per approach.
+
+    Connect with ``?lab_id=...`` and send probe_protocol envelopes as binary
+    messages while the face is in view. Each frame is answered with
+    ``{"status": "pending"}`` until the fused embedding is decisive; the
+    final message has the same body as /upload_image (plus ``frames``) and
+    the server closes the socket. Sending the text "end" asks for a decision
+    on the frames so far.
+    """
+    await websocket.accept()
+    lab_id = websocket.query_params.get("lab_id")
+    if not lab_id:
+        await websocket.send_json({"error": "Missing 'lab_id' query parameter"})
+        await websocket.close()
+        return
+    stage = core.stage_seconds.labels
+    try:
+        current_time = datetime.datetime.now()
+        # Reservations are read once per session, not once per frame
+        with stage(stage="reservation").time():
+            day = await lab_day(lab_id, current_time.date())
+        session = VerificationSession(core.gallery, day, core.threshold, core.reservation_window,
+                                      max_frames=stream_max_frames, current_time=current_time)
+        result = None
+        while result is None:
+            try:
+                message = await asyncio.wait_for(websocket.receive(), stream_idle_timeout)
+            except asyncio.TimeoutError:
+                result = session.finish()
+                break
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("bytes") is None:
+                if message.get("text") == "end":
+                    result = session.finish()
+                continue
+
+            try:
+                with stage(stage="detect").time():
+                    face, mirr_face, quality = await run_blocking(decode_stream_frame, message["bytes"])
+            except ValueError as e:
+                await websocket.send_json({"status": "pending", "frames": session.frames, "error": str(e)})
+                continue
+            if face is not None:
+                with stage(stage="embed").time():
+                    features = await embed(face, mirr_face)
+                with stage(stage="match").time():
+                    result = session.add(features, quality)
+            if result is None:
+                await websocket.send_json({"status": "pending", "frames": session.frames})
+
+        response, reservation = result
+        reservation_id = None
+        if reservation is not None:
+            with stage(stage="check_in").time():
+                reservation_id = await check_in(lab_id, reservation, datetime.datetime.now())
+            response = core.confirm_access(response, reservation_id)
+        await run_blocking(core.record_access, lab_id, "stream", response, reservation_id)
+        core.count_result(lab_id, response, 200)
+        await websocket.send_json(response)
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        core.app.logger.error(f"Unexpected error in stream: {e}")
+        core.count_result(lab_id, {}, 500)
+        await websocket.close(code=1011)
+
+
+async def verify_batch(request):
+    # Same request and response as flask_AI.verify_batch
+    try:
+        if request.headers.get("content-type", "").startswith("application/json"):
+            body = await request.json()
+            response = await run_blocking(core.verify_batch_json, body)
+        else:
+            form = await request.form()
+            image_datas = [await file.read() for file in form.getlist('images')]
+            response = await run_blocking(core.verify_batch_files, image_datas, form.get('k'))
+        return JSONResponse(response)
+    except ValueError as e:
+        core.app.logger.error(f"ValueError: {e}")
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except Exception as e:
+        core.app.logger.error(f"Unexpected error: {e}")
+        return JSONResponse({"error": "An unexpected error occurred"}, status_code=500)
+
+
+async def ready(request):
+    timings = {name: round(seconds, 3) for name, seconds in core.startup_timings.items()}
+    if not core.ready.is_set():
+        return JSONResponse({"ready": False, "timings": timings}, status_code=503)
+    return JSONResponse({"ready": True, "gallery_size": len(core.gallery), "timings": timings})
+
+
+async def metrics(request):
+    return PlainTextResponse(core.metrics.render(), media_type=core.metrics.content_type)
+
+
+async def sync_gallery(request):
+    # Same as flask_AI.sync_gallery_route; the DB reads stay off the
+    # inference threads
+    changed = await asyncio.get_running_loop().run_in_executor(None, core.sync_gallery)
+    if changed is None:
+        return JSONResponse({"error": "Gallery sync failed"}, status_code=500)
+    return JSONResponse({"changed": changed, "size": len(core.gallery)})
+
+
+async def stats(request):
+    return JSONResponse({
+        "probe_cache": core.probe_cache.stats(),
+        "reservation_cache": {"hits": core.reservation_cache.hits, "misses": core.reservation_cache.misses},
+        "db_pool": core.db_pool.stats(),
+        "access_journal": {"pending": core.access_journal.pending()},
+    })
+
+
+async def invalidate_reservations(request):
+    # lab_id as a form field or JSON key; without one every lab is dropped
+    if request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            body = await request.json()
+        except ValueError:
+            body = None
+        lab_id = body.get('lab_id') if isinstance(body, dict) else None
+    else:
+        lab_id = (await request.form()).get('lab_id')
+    core.reservation_cache.invalidate(lab_id)
+    return JSONResponse({"invalidated": lab_id or "all"})
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global pending, db
+    pending = asyncio.Semaphore(max_pending)
+    db = await aiomysql.create_pool(minsize=1, maxsize=8, pool_recycle=3600,
+                                    **aiomysql_config(core.db_config))
+    # Gallery load, sync timer and enrollment stay on their own threads;
+    # the model is warmed up before the first request is accepted
+    await asyncio.get_running_loop().run_in_executor(None, core.boot)
+    yield
+    db.close()
+    await db.wait_closed()
+    executor.shutdown(wait=False)
+
+
+app = Starlette(
+    routes=[
+        Route('/upload_image', upload_image, methods=['POST']),
+        Route('/upload_probe', upload_probe, methods=['POST']),
+        Route('/verify_batch', verify_batch, methods=['POST']),
+        WebSocketRoute('/verify_stream', verify_stream),
+        Route('/metrics', metrics, methods=['GET']),
+        Route('/sync_gallery', sync_gallery, methods=['POST']),
+        Route('/stats', stats, methods=['GET']),
+        Route('/invalidate_reservations', invalidate_reservations, methods=['POST']),
+        Route('/ready', ready, methods=['GET']),
+    ],
+    lifespan=lifespan,
+)
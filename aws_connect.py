@@ -1,10 +1,33 @@
 import pymysql
+from db_pool import ConnectionPool
+from reservation_cache import ReservationCache
+from access_journal import AccessJournal
+
+
+def _open_rds_connection():
+    return pymysql.connect(
+                           
+        autocommit=True,
+    )
+
+
+# Shared by every kiosk page so a QR verification reuses an open connection
+# instead of paying a new TLS + auth handshake to RDS
+rds_pool = ConnectionPool(_open_rds_connection, min_size=1, max_size=4, max_lifetime=1800)
+
 
 def connect_to_rds():
+    # The returned connection goes back to the pool on close()
     try:
-        conn = pymysql.connect(
-                           
-        )
+        conn = rds_pool.acquire()
         return conn
     except pymysql.MySQLError as e:
         raise Exception(f"Failed to connect to RDS: {str(e)}")
+
+
+# Today's verified reservations per lab, shared by the kiosk pages
+reservation_cache = ReservationCache(connect_to_rds, ttl=60)
+
+# QR check-ins are journaled locally and written to RDS in the background,
+# so the door opens without waiting on the database
+access_journal = AccessJournal("access_journal", connect_to_rds)
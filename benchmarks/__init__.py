@@ -0,0 +1,13 @@
+"""Offline benchmarks for the face verification server.
+
+Everything runs on one machine without network access. The scenarios
+drive flask_AI's own request handlers through the Flask test client; SQLite
+stands in for the RDS tables, a local directory for the S3 bucket, and a
+fixed random projection for ArcFace unless ``--model arcface`` (needs
+DeepFace with its weights already downloaded) or ``--model onnx`` (an
+exported graph) is given. Check-ins use the access journal, so its fsync is
+part of every verified request.
+
+    python -m benchmarks.synthetic --size 10000 --out bench_data
+    python -m benchmarks.scenarios --sizes 1000 10000 100000
+"""
@@ -0,0 +1,284 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+import embedding
+from access_journal import AccessJournal
+from db_pool import ConnectionPool
+from embedding import load_model, represent_batch
+from enrollment import EnrollmentPipeline
+from face_detection import FaceDetector
+from face_index import make_index
+from gallery import EmbeddingGallery
+from metrics import timed_connect
+from photo_store import PhotoCache
+from probe_cache import ProbeCache
+from reservation_cache import ReservationCache
+from benchmarks.standins import BoxCropper, RandomProjectionModel, SQLiteConnection, offline_config
+from benchmarks.synthetic import build_dataset
+
+# The stages flask_AI.verify_face times, in request order
+STAGES = ("parse", "detect", "embed", "reservation", "match", "check_in", "journal")
+
+
+class StageTimer:
+    """Collects per-stage and end-to-end durations from any number of threads.
+
+    Also stands in for flask_AI.stage_seconds (``labels(stage=...).time()``),
+    so the server's own stage timers report here.
+    """
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.samples[name].append(seconds)
+
+    def labels(self, stage):
+        return _Stage(self, stage)
+
+    def summary(self):
+        rows = {}
+        for name in (*STAGES, "total"):
+            values = np.array(self.samples.get(name, []), dtype=np.float64) * 1000
+            if len(values):
+                p50, p95, p99 = np.percentile(values, [50, 95, 99])
+                rows[name] = {"count": len(values), "p50_ms": p50, "p95_ms": p95, "p99_ms": p99}
+        return rows
+
+
+class _Stage:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def time(self):
+        return self.timer.stage(self.name)
+
+    def observe(self, seconds):
+        self.timer.add(self.name, seconds)
+
+
+def import_server(model):
+    """flask_AI, imported with ``model`` in place of its configured backend.
+
+    The server builds its model at import time, so load_model is swapped
+    for the import only. Without a config.py, placeholder credentials are
+    used; nothing here reaches AWS or RDS.
+    """
+    if "flask_AI" not in sys.modules:
+        try:
+            import config  # noqa: F401
+        except ImportError:
+            sys.modules["config"] = offline_config()
+        build_model = embedding.load_model
+        embedding.load_model = lambda *args, **kwargs: model
+        try:
+            import flask_AI  # noqa: F401
+        finally:
+            embedding.load_model = build_model
+    core = sys.modules["flask_AI"]
+    core.model = model
+    return core
+
+
+class BenchServer:
+    """flask_AI itself, with its model, RDS, S3 and journal directory
+    pointed at the stand-ins.
+
+    Probes are posted through the Flask test client to the real
+    /upload_image handler, so request parsing, the probe cache, the
+    MicroBatcher, the reservation cache, decide_access, the check-in and the
+    journal fsync are all measured as they run in the server. Only the
+    connections and the photo store are swapped; ``probe_cache=False``
+    measures every probe through the model.
+    """
+
+    def __init__(self, dataset, model, detector=None, index_backend="exact", reservation_ttl=60,
+                 probe_cache=True, work_dir=None):
+        core = import_server(model)
+        self.core = core
+        self.dataset = dataset
+        work_dir = work_dir or tempfile.mkdtemp(prefix="bench-server-")
+
+        def connect(query):
+            return timed_connect(core.db_pool.connection, core.db_seconds.labels(query=query))
+
+        core.face_detector = detector or BoxCropper()
+        core.db_pool = ConnectionPool(lambda: SQLiteConnection(dataset.db_path), min_size=1, max_size=8)
+        core.photo_cache = PhotoCache(dataset.store, os.path.join(work_dir, "photo_cache"))
+        core.gallery = EmbeddingGallery(index=make_index(index_backend), model_name=core.model_name)
+        # SQLite stores the binary embeddings as they are; no column to convert
+        core.binary_features = True
+        core.load_gallery()
+        core.reservation_cache = ReservationCache(connect("reservations"), ttl=reservation_ttl)
+        core.probe_cache = ProbeCache() if probe_cache else ProbeCache(max_entries=0)
+        core.access_journal = AccessJournal(os.path.join(work_dir, "access_journal"), connect("access_journal"))
+        core.access_journal.open()
+        core.enrollment = EnrollmentPipeline(
+            connect=connect("enrollment"),
+            fetch_image=core.download_photo,
+            embed=core.embed_photo,
+            encode=core.encode_feature,
+            on_embedded=core.gallery.apply_changes,
+        )
+        core.ready.set()
+
+    def upload_image(self, probe, timer):
+        self.core.stage_seconds = timer
+        start = time.perf_counter()
+        response = self.core.app.test_client().post("/upload_image", data={
+            "lab_id": probe.lab_id,
+            "face_box": ",".join(str(v) for v in probe.face_box),
+            "image": (io.BytesIO(probe.image_data), "probe.jpg"),
+        })
+        timer.add("total", time.perf_counter() - start)
+        return response.get_json()
+
+    def close(self):
+        self.core.access_journal.close()
+        self.core.db_pool.close()
+
+
+def run_sequential(server, probes, requests, warmup=8):
+    """One request at a time: the latency a lone student at the door sees."""
+    for probe in probes[:warmup]:
+        server.upload_image(probe, StageTimer())
+    timer = StageTimer()
+    verified = 0
+    start = time.perf_counter()
+    for i in range(requests):
+        verified += bool(server.upload_image(probes[i % len(probes)], timer).get("verified"))
+    return timer, requests / (time.perf_counter() - start), verified
+
+
+def run_concurrent(server, probes, requests, clients):
+    """``clients`` kiosks posting back to back: server throughput."""
+    timer = StageTimer()
+    counter = iter(range(requests))
+    lock = threading.Lock()
+    verified = [0]
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            if server.upload_image(probes[i % len(probes)], timer).get("verified"):
+                with lock:
+                    verified[0] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timer, requests / (time.perf_counter() - start), verified[0]
+
+
+def run_enrollment(dataset, server, timeout=300):
+    """The server's background enrollment of every photo without features,
+    read through its photo cache from the local store in place of S3."""
+    pipeline = server.core.enrollment
+    pipeline.start()
+    start = time.perf_counter()
+    pipeline.scan()
+    deadline = start + timeout
+    while pipeline.pending() and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    pipeline.stop()
+    return len(dataset.unenrolled) / elapsed
+
+
+def print_report(title, timer, throughput, verified, requests):
+    print(f"\n{title}: {throughput:.1f} req/s, {verified}/{requests} verified")
+    print(f"  {'stage':<12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, row in timer.summary().items():
+        print(f"  {name:<12}{row['p50_ms']:>10.3f}{row['p95_ms']:>10.3f}{row['p99_ms']:>10.3f}")
+
+
+def load_bench_model(name, onnx_path="arcface.onnx"):
+    if name == "arcface":
+        return load_model("deepface")
+    if name == "onnx":
+        return load_model("onnx", onnx_path=onnx_path)
+    return RandomProjectionModel()
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Benchmark flask_AI's /upload_image offline")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="gallery sizes to run")
+    parser.add_argument("--scenarios", nargs="+", default=["sequential", "concurrent", "enrollment"],
+                        choices=["sequential", "concurrent", "enrollment"])
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--unenrolled", type=int, default=200, help="photos for the enrollment scenario")
+    parser.add_argument("--model", choices=["projection", "arcface", "onnx"], default="projection")
+    parser.add_argument("--onnx", default="arcface.onnx", help="graph for --model onnx")
+    parser.add_argument("--detector", choices=["box", "mtcnn", "yunet"], default="box",
+                        help="'box' crops the face_box the kiosk sends instead of detecting")
+    parser.add_argument("--index", choices=["exact", "ivf"], default="exact")
+    parser.add_argument("--reservation-ttl", type=float, default=60,
+                        help="0 reloads the lab's reservations on every request")
+    parser.add_argument("--no-probe-cache", action="store_true",
+                        help="embed every probe; the synthetic probes repeat, so most would be cache hits")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file, for comparing runs")
+    args = parser.parse_args()
+
+    model = load_bench_model(args.model, args.onnx)
+    detector = FaceDetector(args.detector) if args.detector != "box" else None
+    results = []
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as root:
+            start = time.perf_counter()
+            dataset = build_dataset(root, size, lambda crops: represent_batch(model, crops, "skip"),
+                                    unenrolled=args.unenrolled if "enrollment" in args.scenarios else 0,
+                                    seed=args.seed)
+            server = BenchServer(dataset, model, detector, args.index, args.reservation_ttl,
+                                 not args.no_probe_cache, os.path.join(root, "server"))
+            print(f"\n== gallery of {size} ({time.perf_counter() - start:.1f}s to build and load)")
+
+            for scenario in args.scenarios:
+                if scenario == "enrollment":
+                    rate = run_enrollment(dataset, server)
+                    print(f"\nenrollment: {rate:.1f} photos/s")
+                    results.append({"size": size, "scenario": scenario, "photos_per_second": rate})
+                    continue
+                if scenario == "sequential":
+                    timer, throughput, verified = run_sequential(server, dataset.probes, args.requests)
+                else:
+                    timer, throughput, verified = run_concurrent(server, dataset.probes, args.requests,
+                                                                 args.clients)
+                print_report(scenario, timer, throughput, verified, args.requests)
+                results.append({"size": size, "scenario": scenario, "requests_per_second": throughput,
+                                "verified": verified, "stages": timer.summary()})
+            server.close()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
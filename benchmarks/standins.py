@@ -0,0 +1,182 @@
+import datetime
+import sqlite3
+import types
+
+import cv2
+import numpy as np
+
+from face_detection import FACE_SIZE, crop_box
+
+
+# The parts of the RDS schema the server reads and writes
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS user_img (
+        id TEXT PRIMARY KEY,
+        photo_path TEXT,
+        features BLOB
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS reservations (
+        reservation_id INTEGER PRIMARY KEY,
+        lab_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        date DATE NOT NULL,
+        time TEXT NOT NULL,
+        verified INTEGER NOT NULL DEFAULT 1,
+        checked INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS reservations_lab_date ON reservations (lab_id, date)",
+    """
+    CREATE TABLE IF NOT EXISTS user_img_changes (
+        change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS access_events (
+        event_id TEXT PRIMARY KEY,
+        lab_id TEXT NOT NULL,
+        user_id TEXT,
+        reservation_id INTEGER,
+        method TEXT NOT NULL,
+        verified INTEGER NOT NULL,
+        message TEXT,
+        created_at TIMESTAMP NOT NULL
+    )
+    """,
+]
+
+sqlite3.register_adapter(datetime.date, lambda d: d.isoformat())
+sqlite3.register_adapter(datetime.datetime, lambda d: d.isoformat(" "))
+sqlite3.register_converter("DATE", lambda value: datetime.date.fromisoformat(value.decode()))
+
+
+def sqlite_query(query):
+    # %s placeholders, and the journal's MySQL upsert in SQLite's syntax
+    return query.replace("%s", "?").replace("ON DUPLICATE KEY UPDATE", "ON CONFLICT DO UPDATE SET")
+
+
+class SQLiteCursor:
+    """pymysql-style cursor over sqlite3: ``%s`` placeholders, usable in ``with``."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._cursor.close()
+        return False
+
+    def execute(self, query, params=()):
+        self._cursor.execute(sqlite_query(query), params)
+
+    def executemany(self, query, rows):
+        self._cursor.executemany(sqlite_query(query), rows)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+
+class SQLiteConnection:
+    """Stand-in for a pymysql connection backed by a SQLite file; fits
+    db_pool.ConnectionPool like the real one."""
+
+    def __init__(self, path):
+        self._raw = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES,
+                                    check_same_thread=False, timeout=30)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._raw.rollback()
+        self.close()
+        return False
+
+    def cursor(self):
+        return SQLiteCursor(self._raw.cursor())
+
+    def commit(self):
+        self._raw.commit()
+
+    def rollback(self):
+        self._raw.rollback()
+
+    def ping(self, reconnect=False):
+        self._raw.execute("SELECT 1")
+
+    def close(self):
+        self._raw.close()
+
+
+def create_schema(path):
+    with SQLiteConnection(path) as connection:
+        with connection.cursor() as cursor:
+            for statement in SCHEMA:
+                cursor.execute(statement)
+        connection.commit()
+
+
+def offline_config():
+    """Stand-in for the server's config.py, whose AWS and RDS credentials are
+    never used offline: photos and the database are the stand-ins here."""
+    config = types.ModuleType("config")
+    config.AWS_ACCESS_KEY_ID = "offline"
+    config.AWS_SECRET_ACCESS_KEY = "offline"
+    config.AWS_REGION_NAME = "us-east-1"
+    config.S3_BUCKET_NAME = "offline"
+    config.DB_CONFIG = {}
+    return config
+
+
+class BoxCropper:
+    """Stand-in for face_detection.FaceDetector that trusts the kiosk's
+    face_box instead of detecting; a frame without one is used whole."""
+
+    backend = "box"
+    margin = 0.1
+
+    def detect(self, image):
+        return []
+
+    def extract(self, image, face_box=None):
+        if face_box is None:
+            return cv2.resize(image, (FACE_SIZE, FACE_SIZE))
+        return crop_box(image, face_box, self.margin)
+
+
+class RandomProjectionModel:
+    """Deterministic stand-in for ArcFace with the same input and output shape.
+
+    Average-pools the 112x112 input and projects it to 512 dimensions, so
+    identical crops map to identical vectors. Its cost is far below a real
+    forward pass; use it to watch the rest of the pipeline.
+    """
+
+    input_shape = (None, 112, 112, 3)
+
+    def __init__(self, dim=512, pool=4, seed=0):
+        self.pool = pool
+        size = (112 // pool) ** 2 * 3
+        rng = np.random.default_rng(seed)
+        self.weights = (rng.standard_normal((size, dim)) / np.sqrt(size)).astype(np.float32)
+
+    def predict_on_batch(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        side = 112 // self.pool
+        pooled = batch.reshape(len(batch), side, self.pool, side, self.pool, 3).mean(axis=(2, 4))
+        return pooled.reshape(len(batch), -1) @ self.weights
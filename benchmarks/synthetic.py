@@ -0,0 +1,126 @@
+import datetime
+import os
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from embedding_codec import encode_embedding
+from face_detection import crop_box
+from photo_store import LocalDirectoryStore
+from benchmarks.standins import SQLiteConnection, create_schema
+
+# Where the synthetic "face" sits in every probe frame; sent as face_box
+FACE_BOX = (240, 140, 160, 200)
+
+Probe = namedtuple("Probe", "lab_id user_id image_data face_box")
+Dataset = namedtuple("Dataset", "db_path store probes unenrolled date")
+
+
+def random_embeddings(n, dim=512, seed=0):
+    rng = np.random.default_rng(seed)
+    matrix = rng.standard_normal((n, dim)).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix
+
+
+def synthetic_frame(rng, height=480, width=640):
+    # Smooth random texture: compresses, decodes and resizes like a camera frame
+    small = rng.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+    frame = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    return cv2.GaussianBlur(frame, (0, 0), 3)
+
+
+def user_id(i):
+    return str(2024000000 + i)
+
+
+def build_dataset(root, gallery_size, embed, labs=4, probes=64, reservations_per_lab=40,
+                  unenrolled=0, seed=0, now=None):
+    """Write a synthetic gallery, reservations and photos under ``root``.
+
+    The first ``probes`` users get a kiosk frame whose face crop is embedded
+    with ``embed(crops)`` and enrolled, plus a reservation starting ``now`` in
+    their lab, so their probes are accepted. The rest of the gallery is random
+    unit vectors; every lab also gets ``reservations_per_lab`` reservations
+    spread over the day. ``unenrolled`` more users have a photo but no
+    features yet, for the enrollment scenario.
+    """
+    rng = np.random.default_rng(seed)
+    now = now or datetime.datetime.now()
+    today = now.date()
+    slot = now.strftime("%H:%M")
+    lab_ids = [str(101 + i) for i in range(labs)]
+    probes = min(probes, gallery_size)
+
+    db_path = os.path.join(root, "lab_access.sqlite3")
+    store = LocalDirectoryStore(os.path.join(root, "photos"))
+    create_schema(db_path)
+
+    probe_list = []
+    frames = []
+    for i in range(probes):
+        frame = synthetic_frame(rng)
+        _, encoded = cv2.imencode(".jpg", frame)
+        image_data = encoded.tobytes()
+        probe_list.append(Probe(lab_ids[i % labs], user_id(i), image_data, FACE_BOX))
+        frames.append(cv2.imdecode(encoded, cv2.IMREAD_COLOR))
+        store.put(f"users/{user_id(i)}.jpg", image_data)
+    probe_features = embed([crop_box(frame, FACE_BOX) for frame in frames]) if frames else []
+
+    others = random_embeddings(gallery_size - probes, seed=seed + 1)
+    users = [(p.user_id, f"users/{p.user_id}.jpg", encode_embedding(feature, "ArcFace"))
+             for p, feature in zip(probe_list, probe_features)]
+    users += [(user_id(probes + i), f"users/{user_id(probes + i)}.jpg", encode_embedding(vector, "ArcFace"))
+              for i, vector in enumerate(others)]
+
+    pending = []
+    for i in range(unenrolled):
+        uid = user_id(gallery_size + i)
+        store.put(f"users/{uid}.jpg", cv2.imencode(".jpg", synthetic_frame(rng))[1].tobytes())
+        pending.append(uid)
+        users.append((uid, f"users/{uid}.jpg", None))
+
+    reservations = [(p.lab_id, p.user_id, today, slot) for p in probe_list]
+    for lab_id in lab_ids:
+        for _ in range(reservations_per_lab):
+            hour, minute = rng.integers(8, 22), rng.choice([0, 30])
+            reservations.append((lab_id, user_id(int(rng.integers(0, gallery_size))), today,
+                                 f"{hour:02d}:{minute:02d}"))
+
+    with SQLiteConnection(db_path) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM user_img")
+            cursor.execute("DELETE FROM reservations")
+            cursor.executemany("INSERT INTO user_img (id, photo_path, features) VALUES (%s, %s, %s)", users)
+            cursor.executemany(
+                "INSERT INTO reservations (lab_id, user_id, date, time) VALUES (%s, %s, %s, %s)",
+                reservations
+            )
+        connection.commit()
+
+    return Dataset(db_path, store, probe_list, pending, today)
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    from embedding import represent_batch
+    from benchmarks.standins import RandomProjectionModel
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic gallery with SQLite and local photo stand-ins")
+    parser.add_argument("--size", type=int, default=10000, help="number of enrolled users")
+    parser.add_argument("--out", default="bench_data")
+    parser.add_argument("--labs", type=int, default=4)
+    parser.add_argument("--probes", type=int, default=64)
+    parser.add_argument("--unenrolled", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    model = RandomProjectionModel(seed=args.seed)
+    start = time.perf_counter()
+    dataset = build_dataset(args.out, args.size, lambda crops: represent_batch(model, crops, "skip"),
+                            args.labs, args.probes, unenrolled=args.unenrolled, seed=args.seed)
+    print(f"Wrote {args.size} users, {len(dataset.probes)} probes and {len(dataset.unenrolled)} "
+          f"unenrolled photos to {args.out} in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,191 @@
+import os
+import threading
+import time
+from collections import deque
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection:
+    """Proxy handed out by ConnectionPool.
+
+    Behaves like the wrapped connection, but ``close()`` (or leaving a
+    ``with`` block) returns it to the pool instead of closing the socket, so
+    existing ``conn.close()`` call sites work unchanged. Every checkout gets
+    a new proxy, so closing one again later cannot release the connection
+    while someone else holds it.
+    """
+
+    def __init__(self, pool, raw, created):
+        self._pool = pool
+        self._raw = raw
+        self._created = created
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            try:
+                self._raw.rollback()
+            except Exception:
+                self._pool._discard(self)
+                return False
+        self.close()
+        return False
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._pool._release(self)
+
+
+class ConnectionPool:
+    """Thread-safe pool of DB connections.
+
+    ``connect`` creates a raw connection (e.g. ``lambda: pymysql.connect(...)``).
+    Connections are pinged on checkout and replaced when the ping fails or
+    they are older than ``max_lifetime`` seconds. At most ``max_size`` are
+    open; callers beyond that wait up to ``timeout`` seconds. Created
+    connections should use autocommit so a reused connection never carries
+    an old read snapshot into the next request.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=8, max_lifetime=3600, timeout=10):
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self._idle = deque()
+        self._open = 0
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.created = 0
+        self.discarded = 0
+        self.failures = 0
+
+    def _create(self):
+        try:
+            raw = self._connect()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self.failures += 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.created += 1
+        return raw, time.monotonic()
+
+    def fill(self):
+        """Open connections up to ``min_size`` ahead of the first request."""
+        self._check_fork()
+        with self._cond:
+            missing = self.min_size - self._open
+            self._open += max(0, missing)
+        connections = [self._create() for _ in range(max(0, missing))]
+        with self._cond:
+            self._idle.extend(connections)
+            self._cond.notify_all()
+
+    def _check_fork(self):
+        # A forked worker must not share sockets with its parent: forget the
+        # inherited connections (without closing them) and start afresh
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = deque()
+            self._open = 0
+            self._cond = threading.Condition()
+
+    def acquire(self):
+        self._check_fork()
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._open >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(f"No free connection after {self.timeout}s")
+                    self._cond.wait(remaining)
+                if self._idle:
+                    idle = self._idle.popleft()
+                else:
+                    self._open += 1
+                    idle = None
+
+            if idle is None:
+                raw, created = self._create()
+            elif not self._healthy(*idle):
+                self._close_raw(idle[0])
+                continue
+            else:
+                raw, created = idle
+
+            waited = time.monotonic() - start
+            with self._cond:
+                self.checkouts += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            return PooledConnection(self, raw, created)
+
+    # Shorter name for ``with pool.connection() as conn:`` blocks
+    connection = acquire
+
+    def _healthy(self, raw, created):
+        if time.monotonic() - created > self.max_lifetime:
+            return False
+        try:
+            raw.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def _close_raw(self, raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._open -= 1
+            self.discarded += 1
+            self._cond.notify()
+
+    def _release(self, pooled):
+        with self._cond:
+            self._idle.append((pooled._raw, pooled._created))
+            self._cond.notify()
+
+    def _discard(self, pooled):
+        pooled._released = True
+        self._close_raw(pooled._raw)
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+        for raw, _ in idle:
+            self._close_raw(raw)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "open": self._open,
+                "idle": len(self._idle),
+                "checkouts": self.checkouts,
+                "wait_seconds_total": self.wait_seconds,
+                "wait_seconds_max": self.max_wait_seconds,
+                "created": self.created,
+                "discarded": self.discarded,
+                "connect_failures": self.failures,
+            }
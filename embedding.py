@@ -0,0 +1,214 @@
+import cv2
+import numpy as np
+
+
+def input_size(model):
+    # DeepFace returns either a keras model or a wrapper holding one in .model
+    keras_model = getattr(model, "model", model)
+    height, width = keras_model.input_shape[1:3]
+    return height, width
+
+
+def resize_with_padding(img, target_size):
+    """Fit ``img`` into ``target_size`` (height, width), keeping the aspect
+    ratio and zero-padding the rest, the same way DeepFace.represent does."""
+    factor = min(target_size[0] / img.shape[0], target_size[1] / img.shape[1])
+    dsize = (max(1, int(img.shape[1] * factor)), max(1, int(img.shape[0] * factor)))
+    img = cv2.resize(img, dsize)
+
+    diff_0 = target_size[0] - img.shape[0]
+    diff_1 = target_size[1] - img.shape[1]
+    img = np.pad(
+        img,
+        ((diff_0 // 2, diff_0 - diff_0 // 2), (diff_1 // 2, diff_1 - diff_1 // 2), (0, 0)),
+        "constant",
+    )
+    if img.shape[:2] != tuple(target_size):
+        img = cv2.resize(img, (target_size[1], target_size[0]))
+
+    img = img.astype(np.float32)
+    if img.max() > 1:
+        img /= 255.0
+    return img
+
+
+def preprocess(image, target_size, detector_backend="opencv"):
+    """Turn a BGR frame into one model input, as DeepFace.represent would
+    with ``enforce_detection=False``."""
+    if detector_backend == "skip":
+        # Already a face crop (e.g. from face_detection.py); DeepFace would
+        # only convert it to RGB and back
+        return resize_with_padding(image, target_size)
+    from deepface import DeepFace
+    faces = DeepFace.extract_faces(image, detector_backend=detector_backend,
+                                   enforce_detection=False, align=True)
+    # extract_faces hands back RGB; the model was trained on BGR input
+    face = faces[0]["face"][:, :, ::-1]
+    return resize_with_padding(face, target_size)
+
+
+def represent_batch(model, images, detector_backend="opencv"):
+    """Embed several BGR images with one forward pass.
+
+    Returns a list with one float32 vector per image, or None for images that
+    could not be preprocessed.
+    """
+    target_size = input_size(model)
+    inputs = []
+    rows = []
+    for i, image in enumerate(images):
+        try:
+            inputs.append(preprocess(image, target_size, detector_backend))
+            rows.append(i)
+        except Exception:
+            continue
+
+    results = [None] * len(images)
+    if not inputs:
+        return results
+
+    keras_model = getattr(model, "model", model)
+    embeddings = np.asarray(keras_model.predict_on_batch(np.stack(inputs)), dtype=np.float32)
+    for row, embedding in zip(rows, embeddings):
+        results[row] = embedding
+    return results
+
+
+class OnnxArcFace:
+    """ArcFace exported to ONNX (see ``python embedding.py export``), run
+    with ONNX Runtime instead of TensorFlow.
+
+    Offers the same ``input_shape`` and ``predict_on_batch`` as the Keras
+    model, so represent_batch and the batcher use it unchanged. Takes NHWC
+    float32 batches of aligned faces. ``intra_op_threads`` bounds the
+    threads one forward pass uses and ``inter_op_threads`` how many
+    independent operators run at once; 0 lets ONNX Runtime decide.
+    """
+
+    def __init__(self, path, intra_op_threads=0, inter_op_threads=0):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = (ort.ExecutionMode.ORT_PARALLEL if inter_op_threads > 1
+                                  else ort.ExecutionMode.ORT_SEQUENTIAL)
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.input_shape = (None, *model_input.shape[1:])
+
+    def predict_on_batch(self, batch):
+        return self.session.run(None, {self.input_name: np.asarray(batch, dtype=np.float32)})[0]
+
+
+def load_model(backend="deepface", model_name="ArcFace", onnx_path="arcface.onnx",
+               intra_op_threads=0, inter_op_threads=0):
+    """Build the embedding model for ``backend``: "deepface" or "onnx".
+
+    The ONNX backend does not import TensorFlow itself, but preprocess does
+    for any ``detector_backend`` other than "skip" (DeepFace's detection), and
+    MTCNN runs on it too; TensorFlow only stays out of the process with faces
+    cropped by YuNet.
+    """
+    if backend == "onnx":
+        return OnnxArcFace(onnx_path, intra_op_threads, inter_op_threads)
+    if backend != "deepface":
+        raise ValueError(f"Unknown embedding backend: {backend}")
+    from deepface import DeepFace
+    return DeepFace.build_model(model_name)
+
+
+def export_onnx(model, path, opset=13):
+    """Write a DeepFace/Keras model as an ONNX graph with a dynamic batch size."""
+    import tensorflow as tf
+    import tf2onnx
+    keras_model = getattr(model, "model", model)
+    height, width, channels = keras_model.input_shape[1:]
+    signature = (tf.TensorSpec((None, height, width, channels), tf.float32, name="input"),)
+    tf2onnx.convert.from_keras(keras_model, input_signature=signature, opset=opset, output_path=path)
+
+
+def max_rss_mb():
+    import resource
+    # Linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def sample_faces(directory=None, count=64, seed=0):
+    """Aligned-size face crops to compare backends on: the images in
+    ``directory`` resized to 112x112, or random textures without one."""
+    if directory:
+        import glob
+        import os
+        paths = sorted(p for p in glob.glob(os.path.join(directory, "*"))
+                       if p.lower().endswith((".jpg", ".jpeg", ".png")))[:count]
+        images = [cv2.imread(p, cv2.IMREAD_COLOR) for p in paths]
+        return [cv2.resize(img, (112, 112)) for img in images if img is not None]
+    rng = np.random.default_rng(seed)
+    return [cv2.GaussianBlur(rng.integers(0, 256, (112, 112, 3), dtype=np.uint8), (0, 0), 2)
+            for _ in range(count)]
+
+
+def time_per_face(model, faces, batch_size, repeats=3):
+    import time
+    represent_batch(model, faces[:batch_size], "skip")
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for i in range(0, len(faces), batch_size):
+            represent_batch(model, faces[i:i + batch_size], "skip")
+    return (time.perf_counter() - start) / (repeats * len(faces)) * 1000
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export ArcFace to ONNX and compare it with DeepFace")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="write the DeepFace model as an ONNX graph")
+    export.add_argument("--model-name", default="ArcFace")
+    export.add_argument("--out", default="arcface.onnx")
+    export.add_argument("--opset", type=int, default=13)
+    parity = commands.add_parser("parity", help="check ONNX embeddings against DeepFace on the same crops")
+    parity.add_argument("--onnx", default="arcface.onnx")
+    parity.add_argument("--images", help="directory of face crops (default: random textures)")
+    parity.add_argument("--tolerance", type=float, default=1e-4, help="largest allowed distance between the two")
+    bench = commands.add_parser("bench", help="per-face time and peak memory of one backend, on its own")
+    bench.add_argument("--backend", choices=["deepface", "onnx"], default="onnx")
+    bench.add_argument("--onnx", default="arcface.onnx")
+    for command in (parity, bench):
+        command.add_argument("--batch-size", type=int, default=2)
+        command.add_argument("--intra-op-threads", type=int, default=0)
+        command.add_argument("--inter-op-threads", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_onnx(load_model("deepface", args.model_name), args.out, args.opset)
+        print(f"Wrote {args.out}")
+
+    elif args.command == "parity":
+        faces = sample_faces(args.images)
+        reference = load_model("deepface")
+        candidate = load_model("onnx", onnx_path=args.onnx, intra_op_threads=args.intra_op_threads,
+                               inter_op_threads=args.inter_op_threads)
+        expected = np.vstack(represent_batch(reference, faces, "skip"))
+        actual = np.vstack(represent_batch(candidate, faces, "skip"))
+        unit = lambda m: m / np.linalg.norm(m, axis=1, keepdims=True)
+        # The distance the matching threshold is applied to
+        distances = np.linalg.norm(unit(expected) - unit(actual), axis=1)
+        print(f"{len(faces)} faces: max |diff| {np.abs(expected - actual).max():.2e}, "
+              f"max distance {distances.max():.2e}")
+        print(f"deepface {time_per_face(reference, faces, args.batch_size):.2f} ms/face, "
+              f"onnx {time_per_face(candidate, faces, args.batch_size):.2f} ms/face")
+        if distances.max() > args.tolerance:
+            raise SystemExit(f"FAILED: embeddings differ by more than {args.tolerance}")
+        print("OK: embeddings match within tolerance")
+
+    else:
+        faces = sample_faces()
+        before = max_rss_mb()
+        model = load_model(args.backend, onnx_path=args.onnx, intra_op_threads=args.intra_op_threads,
+                           inter_op_threads=args.inter_op_threads)
+        per_face = time_per_face(model, faces, args.batch_size)
+        print(f"{args.backend}: {per_face:.2f} ms/face at batch size {args.batch_size}, "
+              f"peak RSS {max_rss_mb():.0f} MB ({max_rss_mb() - before:.0f} MB for the model)")
@@ -0,0 +1,166 @@
+import json
+import struct
+import time
+import numpy as np
+
+
+# Binary layout of user_img.features (version 2):
+#   magic "FEMB" | version u8 | dtype u8 | dim u16 | name length u8 | model name
+#   | alignment length u8 | alignment | payload
+# The payload is the embedding as little-endian float32 or float16. The
+# alignment names the face detector the input was cropped with ("mtcnn",
+# "yunet", or "opencv" for DeepFace's own detection); vectors from different
+# detectors are not comparable. Version 1 rows have no alignment and are
+# still read, with the alignment unknown (None).
+MAGIC = b"FEMB"
+VERSION = 2
+VERSIONS = (1, 2)
+HEADER = struct.Struct("<4sBBHB")
+
+DTYPES = {
+    1: np.dtype("<f4"),
+    2: np.dtype("<f2"),
+}
+DTYPE_CODES = {dtype: code for code, dtype in DTYPES.items()}
+
+
+def encode_embedding(feature, model_name, dtype="float32", alignment=None):
+    dtype = np.dtype(dtype).newbyteorder("<")
+    if dtype not in DTYPE_CODES:
+        raise ValueError(f"Unsupported embedding dtype: {dtype}")
+    vector = np.asarray(feature, dtype=dtype).ravel()
+    name = model_name.encode("utf-8")
+    aligned_by = (alignment or "").encode("utf-8")
+    header = HEADER.pack(MAGIC, VERSION, DTYPE_CODES[dtype], len(vector), len(name))
+    return header + name + bytes([len(aligned_by)]) + aligned_by + vector.tobytes()
+
+
+def is_binary(value):
+    return isinstance(value, (bytes, bytearray, memoryview)) and bytes(value[:4]) == MAGIC
+
+
+def read_header(value):
+    """(model_name, alignment, dtype, dim, payload offset) of a binary embedding."""
+    magic, version, dtype_code, dim, name_length = HEADER.unpack_from(value)
+    if magic != MAGIC:
+        raise ValueError("Not a binary embedding")
+    if version not in VERSIONS:
+        raise ValueError(f"Unsupported embedding version: {version}")
+    if dtype_code not in DTYPES:
+        raise ValueError(f"Unsupported embedding dtype code: {dtype_code}")
+    offset = HEADER.size + name_length
+    model_name = bytes(value[HEADER.size:offset]).decode("utf-8")
+    alignment = None
+    if version >= 2:
+        alignment_length = value[offset]
+        alignment = bytes(value[offset + 1:offset + 1 + alignment_length]).decode("utf-8") or None
+        offset += 1 + alignment_length
+    return model_name, alignment, DTYPES[dtype_code], dim, offset
+
+
+def decode_embedding(value, alignment=None, model_name=None):
+    """Decode a stored embedding in either the binary or the legacy JSON format.
+
+    float32 payloads are returned as a zero-copy view over ``value``. With
+    ``model_name`` or ``alignment``, a binary embedding recorded under a
+    different model or face detector raises ValueError; rows that do not
+    record one (legacy JSON, version 1 alignment) are accepted.
+    """
+    if value is None:
+        return None
+    if is_binary(value):
+        recorded_model, recorded_alignment, dtype, dim, offset = read_header(value)
+        if model_name is not None and recorded_model != model_name:
+            raise ValueError(f"Embedding from model {recorded_model}, expected {model_name}")
+        if alignment is not None and recorded_alignment is not None and recorded_alignment != alignment:
+            raise ValueError(f"Embedding aligned with {recorded_alignment}, expected {alignment}")
+        vector = np.frombuffer(value, dtype=dtype, count=dim, offset=offset)
+        return vector if dtype == DTYPES[1] else vector.astype(np.float32)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = bytes(value).decode("utf-8")
+    return np.asarray(json.loads(value), dtype=np.float32)
+
+
+def ensure_blob_column(connection):
+    # Binary payloads need a binary column; JSON text stays readable in a BLOB
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT DATA_TYPE FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'user_img' AND COLUMN_NAME = 'features'
+        """)
+        row = cursor.fetchone()
+        if row and row[0].lower() not in ("blob", "mediumblob", "longblob"):
+            print(f"Converting user_img.features from {row[0]} to MEDIUMBLOB")
+            cursor.execute("ALTER TABLE user_img MODIFY features MEDIUMBLOB NULL")
+    connection.commit()
+
+
+def migrate(connection, model_name, dtype="float32", batch_size=500, pause=0.1, alignment=None):
+    """Rewrite JSON rows in user_img.features to the binary format.
+
+    Walks the table by primary key in small batches and commits after each,
+    so readers (which understand both formats) are never blocked for long.
+    Each update only applies if the row still holds the JSON it was read
+    with, so concurrent enrollments are not overwritten.
+    """
+    last_id = None
+    converted = 0
+    while True:
+        with connection.cursor() as cursor:
+            if last_id is None:
+                cursor.execute(
+                    "SELECT id, features FROM user_img WHERE features IS NOT NULL ORDER BY id LIMIT %s",
+                    (batch_size,)
+                )
+            else:
+                cursor.execute(
+                    "SELECT id, features FROM user_img WHERE features IS NOT NULL AND id > %s ORDER BY id LIMIT %s",
+                    (last_id, batch_size)
+                )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for user_id, features in rows:
+                if is_binary(features):
+                    continue
+                try:
+                    vector = decode_embedding(features)
+                except ValueError:
+                    print(f"Skipping unreadable features for user {user_id}")
+                    continue
+                updates.append((encode_embedding(vector, model_name, dtype, alignment), user_id, features))
+
+            if updates:
+                cursor.executemany(
+                    "UPDATE user_img SET features = %s WHERE id = %s AND features = %s",
+                    updates
+                )
+            connection.commit()
+
+        converted += len(updates)
+        last_id = rows[-1][0]
+        print(f"Converted {converted} rows (last id {last_id})")
+        time.sleep(pause)
+    return converted
+
+
+if __name__ == '__main__':
+    import argparse
+    import pymysql
+    from config import DB_CONFIG
+
+    parser = argparse.ArgumentParser(description="Convert JSON embeddings in user_img to the binary format")
+    parser.add_argument("--model-name", default="ArcFace")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--pause", type=float, default=0.1, help="seconds to sleep between batches")
+    parser.add_argument("--alignment", choices=["opencv", "mtcnn", "yunet"],
+                        help="face detector the JSON embeddings were made with, if known")
+    args = parser.parse_args()
+
+    with pymysql.connect(**DB_CONFIG) as connection:
+        ensure_blob_column(connection)
+        total = migrate(connection, args.model_name, args.dtype, args.batch_size, args.pause, args.alignment)
+    print(f"Done, converted {total} rows")
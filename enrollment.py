@@ -0,0 +1,150 @@
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class EnrollmentPipeline:
+    """Background pipeline that fills in missing ``user_img.features``.
+
+    A scheduler thread periodically looks for rows with a photo but no
+    features and hands them to a bounded pool of download threads. Decoded
+    photos go through a bounded queue to a single inference thread, so
+    enrollment never runs more than one forward pass at a time, and results
+    are written back in batches.
+    Nothing here runs on the request path.
+
+    ``connect`` returns a new DB connection, ``fetch_image(photo_path)``
+    returns a decoded BGR image or None, ``embed(image)`` returns a feature
+    vector or None, ``encode(feature)`` turns it into the stored column value
+    and ``on_embedded({user_id: feature})`` is called after each committed
+    batch (e.g. to update the gallery).
+    """
+
+    def __init__(self, connect, fetch_image, embed, encode, on_embedded=None,
+                 interval=10, download_workers=8, queue_size=64,
+                 batch_size=32, flush_interval=1.0):
+        self.connect = connect
+        self.fetch_image = fetch_image
+        self.embed = embed
+        self.encode = encode
+        self.on_embedded = on_embedded
+        self.interval = interval
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._downloads = ThreadPoolExecutor(max_workers=download_workers,
+                                             thread_name_prefix="enroll-download")
+        self._images = queue.Queue(maxsize=queue_size)
+        self._in_flight = set()
+        self._in_flight_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for target, name in ((self._schedule, "enroll-scheduler"),
+                             (self._consume, "enroll-inference")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        self._downloads.shutdown(wait=False)
+
+    def trigger(self):
+        # Ask for a scan right away instead of waiting for the next tick
+        self._wakeup.set()
+
+    def pending(self):
+        with self._in_flight_lock:
+            return len(self._in_flight)
+
+    def _schedule(self):
+        while not self._stop.is_set():
+            try:
+                self.scan()
+            except Exception as e:
+                logger.error(f"Enrollment scan failed: {e}")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def scan(self):
+        with self.connect() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT id, photo_path FROM user_img WHERE features IS NULL AND photo_path IS NOT NULL")
+                missing_features = cursor.fetchall()
+
+        submitted = 0
+        for user_id, photo_path in missing_features:
+            with self._in_flight_lock:
+                if user_id in self._in_flight:
+                    continue
+                self._in_flight.add(user_id)
+            self._downloads.submit(self._download, user_id, photo_path)
+            submitted += 1
+        if submitted:
+            logger.info(f"Queued {submitted} photos for enrollment")
+        return submitted
+
+    def _download(self, user_id, photo_path):
+        try:
+            img = self.fetch_image(photo_path)
+        except Exception as e:
+            logger.error(f"Failed to download photo for user {user_id}: {e}")
+            img = None
+        if img is None:
+            logger.warning(f"Failed to decode image for user {user_id}")
+            self._done(user_id)
+            return
+        # Blocks when inference falls behind, which throttles the downloads
+        self._images.put((user_id, img))
+
+    def _done(self, *user_ids):
+        with self._in_flight_lock:
+            self._in_flight.difference_update(user_ids)
+
+    def _consume(self):
+        batch = {}
+        while not self._stop.is_set():
+            try:
+                user_id, img = self._images.get(timeout=self.flush_interval)
+            except queue.Empty:
+                user_id = None
+
+            if user_id is not None:
+                try:
+                    feature = self.embed(img)
+                except Exception as e:
+                    # One bad photo must not take down the inference thread
+                    logger.error(f"Failed to embed photo for user {user_id}: {e}")
+                    feature = None
+                if feature is None:
+                    self._done(user_id)
+                else:
+                    batch[user_id] = feature
+
+            if batch and (user_id is None or len(batch) >= self.batch_size):
+                self._write(batch)
+                batch = {}
+
+    def _write(self, batch):
+        try:
+            with self.connect() as connection:
+                with connection.cursor() as cursor:
+                    cursor.executemany(
+                        "UPDATE user_img SET features = %s WHERE id = %s AND features IS NULL",
+                        [(self.encode(feature), user_id) for user_id, feature in batch.items()]
+                    )
+                connection.commit()
+            logger.info(f"Stored features for {len(batch)} users")
+            if self.on_embedded:
+                self.on_embedded(batch)
+        except Exception as e:
+            logger.error(f"Failed to store enrollment batch: {e}")
+        finally:
+            self._done(*batch)
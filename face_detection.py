@@ -0,0 +1,120 @@
+import threading
+import cv2
+import numpy as np
+
+
+# Landmark positions of the standard ArcFace 112x112 crop: left eye, right
+# eye, nose tip, left and right mouth corner (as seen in the image)
+ARCFACE_TEMPLATE = np.array([
+    [38.2946, 51.6963],
+    [73.5318, 51.5014],
+    [56.0252, 71.7366],
+    [41.5493, 92.3655],
+    [70.7299, 92.2041],
+], dtype=np.float32)
+
+FACE_SIZE = 112
+
+
+class FaceDetector:
+    """Long-lived face detector that returns aligned 112x112 face crops.
+
+    ``backend`` is "mtcnn" or "yunet" (OpenCV's FaceDetectorYN, much lighter
+    on a Raspberry Pi; needs the ONNX file at ``yunet_model``). The detector
+    is built once and reused for every frame.
+    """
+
+    def __init__(self, backend="mtcnn", yunet_model="face_detection_yunet_2023mar.onnx",
+                 score_threshold=0.8, margin=0.1):
+        self.backend = backend
+        self.margin = margin
+        # Detectors keep per-call state (YuNet's input size), so one frame at a time
+        self._lock = threading.Lock()
+        if backend == "mtcnn":
+            from mtcnn import MTCNN
+            self._detector = MTCNN()
+        elif backend == "yunet":
+            self._detector = cv2.FaceDetectorYN.create(yunet_model, "", (320, 320), score_threshold)
+        else:
+            raise ValueError(f"Unknown face detector backend: {backend}")
+
+    def detect(self, image):
+        """Return a list of (box, landmarks) for a BGR image.
+
+        ``box`` is (x, y, w, h); ``landmarks`` is a 5x2 array in template order.
+        """
+        with self._lock:
+            return self._detect(image)
+
+    def _detect(self, image):
+        if self.backend == "mtcnn":
+            results = self._detector.detect_faces(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+            faces = []
+            for result in results:
+                points = result["keypoints"]
+                landmarks = np.array([points["left_eye"], points["right_eye"], points["nose"],
+                                      points["mouth_left"], points["mouth_right"]], dtype=np.float32)
+                faces.append((tuple(result["box"]), landmarks))
+            return faces
+
+        height, width = image.shape[:2]
+        self._detector.setInputSize((width, height))
+        _, results = self._detector.detect(image)
+        if results is None:
+            return []
+        # YuNet rows: box, then right eye, left eye, nose, right and left mouth
+        # corner of the subject, i.e. image-left first like the template
+        return [(tuple(int(v) for v in row[:4]), row[4:14].reshape(5, 2).astype(np.float32))
+                for row in results]
+
+    def largest(self, image):
+        faces = self.detect(image)
+        if not faces:
+            return None
+        return max(faces, key=lambda face: face[0][2] * face[0][3])
+
+    def extract(self, image, face_box=None):
+        """Return the aligned 112x112 crop of the largest face, or None.
+
+        With ``face_box`` (x, y, w, h), e.g. from the kiosk's own detector,
+        detection is skipped and the box is cropped and resized instead.
+        """
+        if face_box is not None:
+            return crop_box(image, face_box, self.margin)
+        face = self.largest(image)
+        if face is None:
+            return None
+        return align(image, face[1])
+
+
+def align(image, landmarks):
+    # Similarity transform (rotation, uniform scale, shift) onto the template
+    matrix, _ = cv2.estimateAffinePartial2D(landmarks, ARCFACE_TEMPLATE, method=cv2.LMEDS)
+    if matrix is None:
+        return None
+    return cv2.warpAffine(image, matrix, (FACE_SIZE, FACE_SIZE), borderValue=0)
+
+
+def crop_box(image, face_box, margin=0.1):
+    x, y, w, h = face_box
+    # Square crop around the box centre, slightly enlarged
+    side = int(max(w, h) * (1 + 2 * margin))
+    cx, cy = x + w // 2, y + h // 2
+    x0, y0 = max(0, cx - side // 2), max(0, cy - side // 2)
+    x1, y1 = min(image.shape[1], x0 + side), min(image.shape[0], y0 + side)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return cv2.resize(image[y0:y1, x0:x1], (FACE_SIZE, FACE_SIZE))
+
+
+def parse_face_box(value):
+    """Parse an "x,y,w,h" form value; None when absent."""
+    if not value:
+        return None
+    try:
+        x, y, w, h = (int(float(v)) for v in value.split(","))
+    except ValueError:
+        raise ValueError("'face_box' must be 'x,y,w,h'")
+    if w <= 0 or h <= 0:
+        raise ValueError("'face_box' must have a positive size")
+    return x, y, w, h
@@ -0,0 +1,592 @@
+import os
+import tempfile
+import threading
+import numpy as np
+
+
+def normalize_rows(matrix):
+    # L2-normalize each row; zero rows stay zero instead of becoming NaN
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float32))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def similarity_to_distance(similarity):
+    # For unit vectors ||a - b||^2 = 2 - 2 a.b
+    return np.sqrt(np.maximum(0.0, 2.0 - 2.0 * similarity))
+
+
+def as_id_array(ids):
+    array = np.empty(len(ids), dtype=object)
+    array[:] = list(ids)
+    return array
+
+
+def top_k(ids, similarity, k):
+    """Best ``k`` (ids, distances) per query from a (rows, queries) similarity matrix."""
+    k = min(k, similarity.shape[0])
+    if k == 0:
+        empty = np.empty((similarity.shape[1], 0))
+        return as_id_array([]).reshape(similarity.shape[1], 0), empty
+    part = np.argpartition(-similarity, k - 1, axis=0)[:k]
+    scores = np.take_along_axis(similarity, part, axis=0)
+    order = np.argsort(-scores, axis=0)
+    part = np.take_along_axis(part, order, axis=0)
+    scores = np.take_along_axis(scores, order, axis=0)
+    return ids[part].T, similarity_to_distance(scores).T
+
+
+class FaceIndex:
+    """Interface shared by the gallery search backends.
+
+    Vectors are L2-normalized on the way in and distances are euclidean
+    distances between unit vectors, the same metric ``threshold`` is set for.
+    """
+
+    kind = None
+
+    def __init__(self, dim=512):
+        self.dim = dim
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def replace(self, ids, vectors):
+        raise NotImplementedError
+
+    def add(self, ids, vectors):
+        raise NotImplementedError
+
+    def remove(self, ids):
+        raise NotImplementedError
+
+    def search(self, queries, k=1):
+        """Return (ids, distances), each shaped (len(queries), k), closest first."""
+        raise NotImplementedError
+
+    def vectors(self):
+        """Return (ids, matrix) for every stored vector."""
+        raise NotImplementedError
+
+    def get(self, ids):
+        """Return (ids, matrix) for the stored vectors among ``ids``."""
+        raise NotImplementedError
+
+    def search_subset(self, queries, ids, k=1):
+        """Exact search restricted to ``ids``, for small candidate sets."""
+        found_ids, matrix = self.get(ids)
+        queries = normalize_rows(queries).reshape(-1, self.dim)
+        return top_k(found_ids, matrix @ queries.T, k)
+
+    def save(self, path):
+        ids, matrix = self.vectors()
+        np.savez(path, kind=self.kind, dim=self.dim, ids=ids, matrix=matrix, **self._extra_state())
+
+    def _extra_state(self):
+        return {}
+
+    @staticmethod
+    def load(path, **options):
+        """Rebuild a saved index; ``options`` are settings that are not saved
+        with it, e.g. ``spill_dir`` for a quantized index."""
+        with np.load(path, allow_pickle=True) as data:
+            kind = str(data["kind"])
+            index = INDEX_TYPES[kind]._from_state(data, **options)
+        return index
+
+
+class ExactIndex(FaceIndex):
+    """Exhaustive search: one matrix product over the whole gallery."""
+
+    kind = "exact"
+
+    def __init__(self, dim=512):
+        super().__init__(dim)
+        self._lock = threading.Lock()
+        self._ids = as_id_array([])
+        self._matrix = np.empty((0, dim), dtype=np.float32)
+        self._rows = {}
+
+    @classmethod
+    def _from_state(cls, data):
+        index = cls(int(data["dim"]))
+        index.replace(data["ids"], data["matrix"])
+        return index
+
+    def __len__(self):
+        return len(self._ids)
+
+    def vectors(self):
+        # ids and matrix are swapped together, never mutated in place
+        with self._lock:
+            return self._ids, self._matrix
+
+    def replace(self, ids, vectors):
+        ids = as_id_array(ids)
+        matrix = np.ascontiguousarray(normalize_rows(vectors).reshape(len(ids), self.dim))
+        with self._lock:
+            self._swap(ids, matrix)
+
+    def _swap(self, ids, matrix):
+        rows = {user_id: row for row, user_id in enumerate(ids)}
+        self._ids, self._matrix, self._rows = ids, matrix, rows
+
+    def add(self, ids, vectors):
+        ids = as_id_array(ids)
+        rows = normalize_rows(vectors).reshape(len(ids), self.dim)
+        with self._lock:
+            self._swap(np.concatenate([self._ids, ids]),
+                       np.ascontiguousarray(np.vstack([self._matrix, rows])))
+
+    def remove(self, ids):
+        ids = set(ids)
+        with self._lock:
+            keep = np.array([user_id not in ids for user_id in self._ids], dtype=bool)
+            self._swap(self._ids[keep], self._matrix[keep])
+
+    def get(self, ids):
+        with self._lock:
+            all_ids, matrix, positions = self._ids, self._matrix, self._rows
+        rows = [positions[user_id] for user_id in ids if user_id in positions]
+        return all_ids[rows], matrix[rows]
+
+    @property
+    def nbytes(self):
+        return self._matrix.nbytes
+
+    def search(self, queries, k=1):
+        ids, matrix = self.vectors()
+        queries = normalize_rows(queries).reshape(-1, self.dim)
+        return top_k(ids, matrix @ queries.T, k)
+
+
+class IVFIndex(FaceIndex):
+    """Inverted-file index: vectors are bucketed by their nearest k-means
+    centroid and a query only scans the ``nprobe`` closest buckets.
+
+    Lookups cost about ``nprobe / nlist`` of an exact scan. Buckets are
+    replaced as whole (ids, matrix) tuples so searches never see a half
+    updated bucket. Centroids are trained once the gallery holds
+    ``train_factor * nlist`` vectors, on the ``replace`` or ``add`` that gets
+    it there; until then every vector sits in one bucket and searches are
+    exact. Trained centroids are kept (and persisted); call ``train`` again
+    if the gallery drifts far from the data they were trained on.
+    """
+
+    kind = "ivf"
+
+    def __init__(self, dim=512, nlist=64, nprobe=8, iterations=20, seed=0, train_factor=4):
+        super().__init__(dim)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_factor = train_factor
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = None
+        self._lists = []
+        self._where = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _from_state(cls, data):
+        index = cls(int(data["dim"]), int(data["nlist"]), int(data["nprobe"]))
+        if data["centroids"].dtype != object:
+            index.centroids = data["centroids"]
+            index.nlist = len(index.centroids)
+        index.replace(data["ids"], data["matrix"])
+        return index
+
+    def _extra_state(self):
+        return {"nlist": self.nlist, "nprobe": self.nprobe, "centroids": self.centroids}
+
+    def __len__(self):
+        return len(self._where)
+
+    def train(self, vectors):
+        # Spherical k-means on the unit sphere, which matches the metric
+        vectors = normalize_rows(vectors)
+        nlist = max(1, min(self.nlist, len(vectors)))
+        rng = np.random.default_rng(self.seed)
+        centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+        for _ in range(self.iterations):
+            assignment = np.argmax(vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, vectors)
+            empty = ~np.bincount(assignment, minlength=nlist).astype(bool)
+            sums[empty] = centroids[empty]
+            centroids = normalize_rows(sums)
+        self.centroids = centroids
+        self.nlist = nlist
+
+    def _assign(self, vectors):
+        return np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def vectors(self):
+        with self._lock:
+            lists = list(self._lists)
+        if not lists:
+            return as_id_array([]), np.empty((0, self.dim), dtype=np.float32)
+        return (np.concatenate([ids for ids, _ in lists]),
+                np.vstack([matrix for _, matrix in lists]))
+
+    def replace(self, ids, vectors):
+        ids = as_id_array(ids)
+        vectors = normalize_rows(vectors).reshape(len(ids), self.dim)
+        if self.centroids is None and len(vectors) >= self.train_factor * self.nlist:
+            self.train(vectors)
+        if self.centroids is None:
+            # Too few vectors for nlist useful buckets: one exact bucket
+            with self._lock:
+                self._lists = [(ids, np.ascontiguousarray(vectors))]
+                self._where = {user_id: 0 for user_id in ids}
+            return
+        assignment = self._assign(vectors)
+        lists = []
+        where = {}
+        for bucket in range(self.nlist):
+            rows = np.flatnonzero(assignment == bucket)
+            lists.append((ids[rows], np.ascontiguousarray(vectors[rows])))
+            for user_id in ids[rows]:
+                where[user_id] = bucket
+        with self._lock:
+            self._lists, self._where = lists, where
+
+    def add(self, ids, vectors):
+        ids = as_id_array(ids)
+        vectors = normalize_rows(vectors).reshape(len(ids), self.dim)
+        if self.centroids is None:
+            existing_ids, existing = self.vectors()
+            self.replace(np.concatenate([existing_ids, ids]), np.vstack([existing, vectors]))
+            return
+        assignment = self._assign(vectors)
+        with self._lock:
+            for bucket in np.unique(assignment):
+                rows = np.flatnonzero(assignment == bucket)
+                bucket_ids, bucket_matrix = self._lists[bucket]
+                self._lists[bucket] = (np.concatenate([bucket_ids, ids[rows]]),
+                                       np.vstack([bucket_matrix, vectors[rows]]))
+                for user_id in ids[rows]:
+                    self._where[user_id] = bucket
+
+    def get(self, ids):
+        with self._lock:
+            lists, where = list(self._lists), dict(self._where)
+        found_ids = []
+        rows = []
+        for user_id in ids:
+            bucket = where.get(user_id)
+            if bucket is None:
+                continue
+            bucket_ids, bucket_matrix = lists[bucket]
+            positions = np.flatnonzero(bucket_ids == user_id)
+            if len(positions):
+                found_ids.append(user_id)
+                rows.append(bucket_matrix[positions[0]])
+        matrix = np.vstack(rows) if rows else np.empty((0, self.dim), dtype=np.float32)
+        return as_id_array(found_ids), matrix
+
+    def remove(self, ids):
+        with self._lock:
+            buckets = {}
+            for user_id in ids:
+                bucket = self._where.pop(user_id, None)
+                if bucket is not None:
+                    buckets.setdefault(bucket, set()).add(user_id)
+            for bucket, removed in buckets.items():
+                bucket_ids, bucket_matrix = self._lists[bucket]
+                keep = np.array([user_id not in removed for user_id in bucket_ids], dtype=bool)
+                self._lists[bucket] = (bucket_ids[keep], bucket_matrix[keep])
+
+    def search(self, queries, k=1):
+        queries = normalize_rows(queries).reshape(-1, self.dim)
+        with self._lock:
+            lists = list(self._lists)
+        out_ids = np.empty((len(queries), k), dtype=object)
+        out_distances = np.full((len(queries), k), np.inf)
+        if not lists:
+            return out_ids, out_distances
+
+        if self.centroids is None:
+            probes = np.zeros((len(queries), 1), dtype=np.int64)
+        else:
+            nprobe = min(self.nprobe, len(lists))
+            probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+        for q, buckets in enumerate(probes):
+            ids = np.concatenate([lists[b][0] for b in buckets])
+            matrix = np.vstack([lists[b][1] for b in buckets])
+            found_ids, found_distances = top_k(ids, matrix @ queries[q:q + 1].T, k)
+            n = found_ids.shape[1]
+            out_ids[q, :n] = found_ids[0]
+            out_distances[q, :n] = found_distances[0]
+        return out_ids, out_distances
+
+
+class QuantizedIndex(ExactIndex):
+    """Exhaustive search over a float16 or int8 copy of the gallery.
+
+    ``dtype="float16"`` halves the resident matrix; ``"int8"`` stores each
+    vector as int8 codes with its own float32 scale, about a quarter of the
+    float32 size. The scan runs on the quantized rows, converted to float32 a
+    chunk at a time. The original float32 vectors are kept in a memory-mapped
+    file under ``spill_dir`` (the system temp directory by default; it has to
+    be on disk, a tmpfs keeps them in memory after all), so only the pages of
+    the best ``rerank`` rows per query are read back; those rows are scored
+    again exactly, and the distances that reach ``threshold`` are the same
+    as with ExactIndex. Quantization can only change which rows make the
+    shortlist.
+
+    The file only grows: ``add`` appends the new rows after the last one
+    written and ``remove`` just forgets rows, so searches reading an older
+    snapshot never see a row change under them. Once the file is full the
+    live rows are copied to a new one twice their size.
+    """
+
+    kind = "quantized"
+
+    def __init__(self, dim=512, dtype="int8", rerank=8, chunk_rows=4096, spill_dir=None):
+        if dtype not in ("float16", "int8"):
+            raise ValueError(f"Unsupported quantized dtype: {dtype}")
+        super().__init__(dim)
+        self.dtype = dtype
+        self.rerank = rerank
+        self.chunk_rows = chunk_rows
+        self.spill_dir = spill_dir
+        self._matrix = np.empty((0, dim), dtype=dtype)
+        self._scales = np.empty(0, dtype=np.float32)
+        # Float32 rows on disk; row i of the index is _full[_slots[i]]
+        self._full = np.empty((0, dim), dtype=np.float32)
+        self._slots = np.empty(0, dtype=np.int64)
+        # Rows of _full written so far; only writers, one at a time, use it
+        self._used = 0
+        self._write_lock = threading.Lock()
+
+    @classmethod
+    def _from_state(cls, data, spill_dir=None):
+        index = cls(int(data["dim"]), str(data["dtype"]), int(data["rerank"]), spill_dir=spill_dir)
+        index.replace(data["ids"], data["matrix"])
+        return index
+
+    def _extra_state(self):
+        return {"dtype": self.dtype, "rerank": self.rerank}
+
+    def quantize(self, matrix):
+        if self.dtype == "float16":
+            return matrix.astype(np.float16), np.ones(len(matrix), dtype=np.float32)
+        # Symmetric per-vector scale: the largest component maps to +-127
+        scales = np.abs(matrix).max(axis=1) / 127
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    @staticmethod
+    def dequantize(codes, scales):
+        return normalize_rows(codes.astype(np.float32) * scales[:, None])
+
+    @property
+    def nbytes(self):
+        # Resident size; the float32 copy is paged in from disk on demand
+        return self._matrix.nbytes + self._scales.nbytes
+
+    def _spill_file(self, rows):
+        # The file is gone from disk once the last mapping of it is, so
+        # searches still reading a replaced file keep it until they finish
+        if self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        with tempfile.TemporaryFile(dir=self.spill_dir, prefix="quantized-") as f:
+            return np.memmap(f, dtype=np.float32, mode="w+", shape=(rows, self.dim))
+
+    def _append(self, full, slots, rows):
+        """Write ``rows`` to ``full`` after the rows at ``slots``; returns
+        (full, slots) for the kept and the new rows. Callers hold _write_lock
+        but not _lock: rows past _used belong to no snapshot yet."""
+        used = self._used
+        if len(full) < used + len(rows):
+            live = len(slots) + len(rows)
+            moved = self._spill_file(max(2 * live, self.chunk_rows))
+            for start in range(0, len(slots), self.chunk_rows):
+                part = slots[start:start + self.chunk_rows]
+                moved[start:start + len(part)] = full[part]
+            full, used, slots = moved, len(slots), np.arange(len(slots), dtype=np.int64)
+        full[used:used + len(rows)] = rows
+        self._used = used + len(rows)
+        return full, np.concatenate([slots, np.arange(used, used + len(rows), dtype=np.int64)])
+
+    def _snapshot(self):
+        with self._lock:
+            return self._ids, self._matrix, self._scales, self._full, self._slots
+
+    def vectors(self):
+        with self._lock:
+            ids, full, slots = self._ids, self._full, self._slots
+        return ids, np.asarray(full[slots])
+
+    def replace(self, ids, vectors):
+        ids = as_id_array(ids)
+        rows = normalize_rows(vectors).reshape(len(ids), self.dim)
+        codes, scales = self.quantize(rows)
+        empty = np.empty(0, dtype=np.int64)
+        with self._write_lock:
+            self._used = 0
+            full, slots = self._append(np.empty((0, self.dim), dtype=np.float32), empty, rows)
+            with self._lock:
+                self._swap(ids, codes, scales, full, slots)
+
+    def _swap(self, ids, matrix, scales=None, full=None, slots=None):
+        super()._swap(ids, np.ascontiguousarray(matrix))
+        self._scales = scales if scales is not None else np.ones(len(ids), dtype=np.float32)
+        if full is None:
+            full, slots = self.dequantize(self._matrix, self._scales), np.arange(len(ids), dtype=np.int64)
+        self._full, self._slots = full, slots
+
+    def add(self, ids, vectors):
+        ids = as_id_array(ids)
+        rows = normalize_rows(vectors).reshape(len(ids), self.dim)
+        codes, scales = self.quantize(rows)
+        with self._write_lock:
+            # Only writers change the state, so it can be read without _lock
+            full, slots = self._append(self._full, self._slots, rows)
+            state = (np.concatenate([self._ids, ids]), np.vstack([self._matrix, codes]),
+                     np.concatenate([self._scales, scales]), full, slots)
+            with self._lock:
+                self._swap(*state)
+
+    def remove(self, ids):
+        ids = set(ids)
+        with self._write_lock:
+            keep = np.array([user_id not in ids for user_id in self._ids], dtype=bool)
+            if keep.all():
+                return
+            state = (self._ids[keep], self._matrix[keep], self._scales[keep], self._full, self._slots[keep])
+            with self._lock:
+                self._swap(*state)
+
+    def get(self, ids):
+        with self._lock:
+            all_ids, full, slots, positions = self._ids, self._full, self._slots, self._rows
+        rows = [positions[user_id] for user_id in ids if user_id in positions]
+        return all_ids[rows], np.asarray(full[slots[rows]])
+
+    def scores(self, codes, scales, queries):
+        """Approximate similarities, (rows, queries), computed on the codes."""
+        similarity = np.empty((len(codes), len(queries)), dtype=np.float32)
+        for start in range(0, len(codes), self.chunk_rows):
+            chunk = codes[start:start + self.chunk_rows]
+            similarity[start:start + len(chunk)] = chunk.astype(np.float32) @ queries.T
+        if self.dtype == "int8":
+            similarity *= scales[:, None]
+        return similarity
+
+    def search(self, queries, k=1):
+        ids, codes, scales, full, slots = self._snapshot()
+        queries = normalize_rows(queries).reshape(-1, self.dim)
+        shortlist = min(max(k, self.rerank), len(ids))
+        rows, _ = top_k(np.arange(len(ids)), self.scores(codes, scales, queries), shortlist)
+        out_ids = np.empty((len(queries), min(k, len(ids))), dtype=object)
+        out_distances = np.empty(out_ids.shape)
+        for q, candidates in enumerate(rows):
+            candidates = candidates.astype(np.int64)
+            exact = np.asarray(full[slots[candidates]]) @ queries[q:q + 1].T
+            found_ids, found_distances = top_k(ids[candidates], exact, k)
+            out_ids[q], out_distances[q] = found_ids[0], found_distances[0]
+        return out_ids, out_distances
+
+
+INDEX_TYPES = {
+    ExactIndex.kind: ExactIndex,
+    IVFIndex.kind: IVFIndex,
+    QuantizedIndex.kind: QuantizedIndex,
+}
+
+
+def make_index(kind="exact", dim=512, **options):
+    return INDEX_TYPES[kind](dim, **options)
+
+
+def measure_recall(exact, approx, queries, threshold, k=1):
+    """Compare an approximate index against exact search on ``queries``.
+
+    ``recall`` is the fraction of queries whose exact top-k ids within
+    ``threshold`` are also returned by ``approx``; ``agreement`` is how often
+    both indexes reach the same match/no-match decision at ``threshold``;
+    ``distance_error_*`` compare the two top-1 distances.
+    """
+    exact_ids, exact_distances = exact.search(queries, k)
+    approx_ids, approx_distances = approx.search(queries, k)
+
+    hits = 0
+    relevant = 0
+    agree = 0
+    errors = np.abs(np.asarray(exact_distances[:, 0], dtype=np.float64)
+                    - np.asarray(approx_distances[:, 0], dtype=np.float64)) if k else np.zeros(0)
+    for q in range(len(exact_ids)):
+        wanted = {user_id for user_id, d in zip(exact_ids[q], exact_distances[q]) if d < threshold}
+        found = {user_id for user_id, d in zip(approx_ids[q], approx_distances[q]) if d < threshold}
+        relevant += len(wanted)
+        hits += len(wanted & found)
+        exact_match = exact_ids[q][0] if exact_distances[q][0] < threshold else None
+        approx_match = approx_ids[q][0] if approx_distances[q][0] < threshold else None
+        agree += exact_match == approx_match
+    return {
+        "recall": hits / relevant if relevant else 1.0,
+        "agreement": agree / len(exact_ids) if len(exact_ids) else 1.0,
+        "distance_error_mean": float(errors.mean()) if len(errors) else 0.0,
+        "distance_error_max": float(errors.max()) if len(errors) else 0.0,
+        "queries": len(exact_ids),
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Measure IVF or quantized recall against exact search")
+    parser.add_argument("--backend", choices=["ivf", "quantized"], default="ivf")
+    parser.add_argument("--size", type=int, default=20000, help="synthetic gallery size (ignored with --from-db)")
+    parser.add_argument("--from-db", action="store_true", help="use the enrolled embeddings in user_img")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--noise", type=float, default=0.03, help="stddev of the noise added to probes")
+    parser.add_argument("--nlist", type=int, default=128)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--dtype", choices=["int8", "float16"], default="int8", help="quantized storage type")
+    parser.add_argument("--rerank", type=int, default=8, help="rows re-scored in float32 per query")
+    parser.add_argument("--threshold", type=float, default=1.0)
+    parser.add_argument("--save", help="write the built index to this .npz path")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.from_db:
+        import pymysql
+        from config import DB_CONFIG
+        from gallery import EmbeddingGallery
+        source = EmbeddingGallery()
+        with pymysql.connect(**DB_CONFIG) as connection:
+            source.load(connection)
+        ids, matrix = source.index.vectors()
+    else:
+        ids = as_id_array(range(args.size))
+        matrix = normalize_rows(rng.standard_normal((args.size, 512)))
+
+    exact = ExactIndex(matrix.shape[1])
+    exact.replace(ids, matrix)
+    if args.backend == "ivf":
+        approx = IVFIndex(matrix.shape[1], nlist=args.nlist, nprobe=args.nprobe)
+    else:
+        approx = QuantizedIndex(matrix.shape[1], dtype=args.dtype, rerank=args.rerank)
+    approx.replace(ids, matrix)
+
+    picks = rng.choice(len(ids), min(args.queries, len(ids)), replace=False)
+    queries = normalize_rows(matrix[picks] + args.noise * rng.standard_normal((len(picks), matrix.shape[1])))
+
+    print(measure_recall(exact, approx, queries, args.threshold))
+    if args.backend == "quantized":
+        print(f"memory: {exact.nbytes / 2**20:.1f} MiB float32, "
+              f"{approx.nbytes / 2**20:.1f} MiB {args.dtype} ({exact.nbytes / approx.nbytes:.1f}x less)")
+    for name, index in (("exact", exact), (args.backend, approx)):
+        start = time.perf_counter()
+        for q in queries:
+            index.search(q)
+        elapsed = (time.perf_counter() - start) / len(queries) * 1000
+        print(f"{name}: {elapsed:.3f} ms/query")
+    if args.save:
+        approx.save(args.save)
@@ -11,33 +11,53 @@ import numpy as np
 import aiohttp
 import asyncio
 from queue import Queue
+from probe_protocol import crop_probe, encode_probe
 
 class Worker(QThread):
     find_signal = pyqtSignal(str)
     error_signal = pyqtSignal(str)
 
+    # Seconds without a new face before a stream session asks for a decision
+    STREAM_IDLE = 1.5
+
     def __init__(self):
         super().__init__()
         self.is_running = False
         self.loop = asyncio.new_event_loop() 
+        # Latest frame waiting for the stream session; older ones are dropped
+        self.frames = asyncio.Queue(maxsize=1)
+
+    def report(self, response_data):
+        if response_data.get('verified') and response_data.get('student_id'):
+            self.find_signal.emit(response_data['student_id'])
+        else:
+            self.error_signal.emit(response_data.get('message', 'Verification failed'))
 
-    async def send_request(self, lab_id, image):
+    async def send_request(self, lab_id, image, face_box=None, compact=False):
         self.is_running = True
         try:
-            _, img_encoded = cv2.imencode('.jpg', image)
-            img_bytes = img_encoded.tobytes()
-            data = aiohttp.FormData()
-            data.add_field('image', img_bytes, filename='image.jpg', content_type='image/jpeg')
-            data.add_field('lab_id', lab_id)
+            if compact:
+                # Only a small crop around the face, in a binary envelope
+                crop, crop_box = crop_probe(image, face_box)
+                url = 'http://localhost:5000/upload_probe'
+                request = {'data': encode_probe(crop, lab_id, crop_box),
+                           'headers': {'Content-Type': 'application/octet-stream'}}
+            else:
+                _, img_encoded = cv2.imencode('.jpg', image)
+                img_bytes = img_encoded.tobytes()
+                data = aiohttp.FormData()
+                data.add_field('image', img_bytes, filename='image.jpg', content_type='image/jpeg')
+                data.add_field('lab_id', lab_id)
+                if face_box is not None:
+                    # Lets the server skip its own face detection
+                    data.add_field('face_box', ','.join(str(int(v)) for v in face_box))
+                url = 'http://localhost:5000/upload_image'
+                request = {'data': data}
 
             async with aiohttp.ClientSession() as session:
-                async with session.post('http://localhost:5000/upload_image', data=data) as response:
+                async with session.post(url, **request) as response:
                     if response.status == 200:
-                        response_data = await response.json()
-                        if response_data.get('verified') and response_data.get('student_id'):
-                            self.find_signal.emit(response_data['student_id'])
-                        else:
-                            self.error_signal.emit(response_data.get('message', 'Verification failed'))
+                        self.report(await response.json())
                     else:
                         self.error_signal.emit(f"Request failed with status code {response.status}")
         except Exception as e:
@@ -45,9 +65,50 @@ class Worker(QThread):
         finally:
             self.is_running = False
 
-    def run_task(self, lab_id, image):
+    async def stream_session(self, lab_id):
+        # One /verify_stream session per approach: frames go out one at a
+        # time as they are captured until the server has decided
+        try:
+            async with aiohttp.ClientSession() as session:
+                url = f'ws://localhost:5000/verify_stream?lab_id={lab_id}'
+                async with session.ws_connect(url) as ws:
+                    while True:
+                        try:
+                            image, face_box = await asyncio.wait_for(self.frames.get(), self.STREAM_IDLE)
+                        except asyncio.TimeoutError:
+                            await ws.send_str("end")
+                        else:
+                            crop, crop_box = crop_probe(image, face_box)
+                            await ws.send_bytes(encode_probe(crop, lab_id, crop_box))
+                        response_data = await ws.receive_json()
+                        if response_data.get('status') == 'pending':
+                            continue
+                        if 'error' in response_data:
+                            self.error_signal.emit(response_data['error'])
+                        else:
+                            self.report(response_data)
+                        break
+        except Exception as e:
+            self.error_signal.emit(f"Error occurred: {str(e)}")
+        finally:
+            while not self.frames.empty():
+                self.frames.get_nowait()
+            self.is_running = False
+
+    def offer_frame(self, frame):
+        if self.frames.full():
+            self.frames.get_nowait()
+        self.frames.put_nowait(frame)
+
+    def run_task(self, lab_id, image, face_box=None, compact=False, stream=False):
+        if stream:
+            self.loop.call_soon_threadsafe(self.offer_frame, (image, face_box))
+            if not self.is_running:
+                self.is_running = True
+                asyncio.run_coroutine_threadsafe(self.stream_session(lab_id), self.loop)
+            return
         if not self.is_running:  
-            asyncio.run_coroutine_threadsafe(self.send_request(lab_id, image), self.loop)
+            asyncio.run_coroutine_threadsafe(self.send_request(lab_id, image, face_box, compact), self.loop)
 
     def run(self):
         asyncio.set_event_loop(self.loop)
@@ -59,6 +120,17 @@ class Worker(QThread):
 
 
 class CameraWindow(QMainWindow):
+    # Send the Haar cascade box along with the frame so the server can skip
+    # detection. Off by default: the box is not landmark-aligned, which costs
+    # some matching accuracy.
+    SEND_FACE_BOX = False
+    # Post a 160x160 crop around the face to /upload_probe instead of the
+    # whole frame: a few KB per attempt and no full-frame decode on the server
+    COMPACT_PROBE = False
+    # Stream frames over one /verify_stream session per approach (asgi_AI.py
+    # only); the server fuses them and answers as soon as it is confident
+    STREAM_FRAMES = False
+
     def __init__(self, lab_id, lab_name):
         super().__init__()
         self.setWindowTitle("Face_Camera")
@@ -163,10 +235,18 @@ class CameraWindow(QMainWindow):
         
         if len(faces) > 0:
             self.status_label.setText("Face detected. Identifying...") 
+            # Send the frame before the boxes are drawn on it
+            largest_face = max(faces, key=lambda face: face[2] * face[3])
+            if self.STREAM_FRAMES:
+                self.worker.run_task(self.lab_id, frame.copy(), largest_face, stream=True)
+            elif self.COMPACT_PROBE:
+                self.worker.run_task(self.lab_id, frame.copy(), largest_face, compact=True)
+            else:
+                face_box = largest_face if self.SEND_FACE_BOX else None
+                self.worker.run_task(self.lab_id, frame.copy(), face_box)
             for (x, y, w, h) in faces:
                 cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
-        
-            self.worker.run_task(self.lab_id, frame) 
+
         else:
             self.status_label.setText("Please show your face") 
             #if not self.task_queue.full():  # Avoid queue overflow
@@ -1,30 +1,83 @@
+import time
+import contextlib
+import logging
+
+# Startup phases are timed from here, before the heavy imports below
+boot_started = time.perf_counter()
+startup_timings = {}
+
 from flask import Flask, request, jsonify
-from deepface import DeepFace
 import boto3
-from mtcnn import MTCNN
 import pymysql
+from pymysql.constants import CLIENT
 import cv2
 import numpy as np
 import datetime
-import requests
-from botocore.exceptions import ClientError
 from flask_cors import CORS
 from config import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION_NAME, S3_BUCKET_NAME, DB_CONFIG
+from gallery import EmbeddingGallery, install_change_log, prune_change_log
+from face_index import FaceIndex, make_index
+from enrollment import EnrollmentPipeline
+from embedding_codec import encode_embedding, ensure_blob_column
+from embedding import load_model, represent_batch
+from face_detection import FACE_SIZE, FaceDetector, crop_box, parse_face_box
+from probe_protocol import decode_probe
+from inference_scheduler import MicroBatcher
+from db_pool import ConnectionPool
+from reservation_cache import ReservationCache, check_in_query, decide_access, install_reservation_index
+from probe_cache import ProbeCache
+from photo_store import PhotoCache, S3Store, s3_config
+from metrics import Registry, timed_connect
+from access_journal import AccessJournal, install_access_events_table
+import threading
 import json
+import os
+
+startup_timings["imports"] = time.perf_counter() - boot_started
 
 app = Flask(__name__)
 CORS(app)
 
+
+@contextlib.contextmanager
+def startup_phase(name):
+    start = time.perf_counter()
+    yield
+    startup_timings[name] = time.perf_counter() - start
+    app.logger.info(f"Startup: {name} took {startup_timings[name]:.2f}s")
+
+
+# Set once the gallery is loaded and the model has run; see /ready
+ready = threading.Event()
+
+# Embedding backend: "deepface" (TensorFlow/Keras), or "onnx" to run the
+# same ArcFace weights exported with `python embedding.py export` through ONNX
+# Runtime. Check parity with `python embedding.py parity` before switching.
+# TensorFlow is still loaded unless face_detector_backend is "yunet": with
+# None, DeepFace's opencv detection (and with it TensorFlow) crops the faces,
+# and MTCNN runs on TensorFlow itself.
+embedding_backend = "deepface"
+onnx_model_path = "arcface.onnx"
+onnx_intra_op_threads = 4
+onnx_inter_op_threads = 1
+
 # Initialize ArcFace model
 model_name = "ArcFace"
-model = DeepFace.build_model(model_name)
-
-# S3 client
+with startup_phase("model"):
+    model = load_model(embedding_backend, model_name, onnx_model_path,
+                       onnx_intra_op_threads, onnx_inter_op_threads)
+
+# S3 client; its connection pool is shared by the enrollment download threads
+s3_max_pool_connections = 16
+s3_connect_timeout = 5
+s3_read_timeout = 10
+s3_max_attempts = 3
 s3_client = boto3.client(
     's3',
     aws_access_key_id=AWS_ACCESS_KEY_ID,
     aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    region_name=AWS_REGION_NAME
+    region_name=AWS_REGION_NAME,
+    config=s3_config(s3_max_pool_connections, s3_connect_timeout, s3_read_timeout, s3_max_attempts)
 )
 
 bucket_name = S3_BUCKET_NAME
@@ -32,47 +85,189 @@ bucket_name = S3_BUCKET_NAME
 # Database configuration
 db_config = DB_CONFIG
 
+# Shared connections for requests and background jobs; autocommit keeps a
+# reused connection from reading through an old transaction snapshot
+db_pool = ConnectionPool(
+    lambda: pymysql.connect(**{**db_config, "autocommit": True,
+                               "client_flag": db_config.get("client_flag", 0) | CLIENT.FOUND_ROWS}),
+    min_size=2,
+    max_size=8,
+    max_lifetime=3600,
+)
+
+# Prometheus metrics, served on /metrics
+metrics = Registry()
+stage_seconds = metrics.histogram(
+    "verify_stage_seconds", "Time spent in each stage of /upload_image", ["stage"])
+request_seconds = metrics.histogram(
+    "verify_request_seconds", "End-to-end /upload_image latency")
+results_total = metrics.counter(
+    "verify_results_total", "Verification outcomes by lab", ["lab_id", "result"])
+db_seconds = metrics.histogram(
+    "db_query_seconds", "Time a DB connection is held, by caller", ["query"])
+s3_seconds = metrics.histogram(
+    "s3_request_seconds", "S3 call latency", ["operation"])
+
+# Enrollment photos are kept in a content-addressed disk cache shared by all
+# workers, so re-embedding the gallery (reembed.py --cache-dir) reads them
+# from local disk; fill it ahead of time with `python photo_store.py`
+photo_cache_dir = "photo_cache"
+photo_cache_max_bytes = 2 * 1024 ** 3
+photo_cache = PhotoCache(S3Store(s3_client, bucket_name, s3_seconds.labels(operation="get_object")),
+                         photo_cache_dir, photo_cache_max_bytes)
+
 # Matching threshold
 threshold = 1
 
+# Minutes either side of the reservation time during which the door opens
+reservation_window = 5
+
+# Search the students whose reservation is open right now before the full
+# gallery. The full-gallery match decides on its own (a closer enrolled
+# lookalike is never let in under a reserved student's identity), so this
+# only adds searches and stays off
+candidate_matching = False
+
+# Gallery search backend: "exact", "ivf" for large multi-lab galleries, or
+# "quantized" to hold the gallery as int8/float16 on small hosts (the float32
+# vectors for re-ranking stay on disk, in index_spill_dir), e.g.
+# index_options = {"dtype": "int8", "rerank": 8}; check the setting with
+# python face_index.py --backend quantized --from-db first.
+# A non-exact index is persisted to index_path and reused at startup.
+index_backend = "exact"
+index_options = {}
+index_path = "gallery_index.npz"
+# Must be on disk: under a tmpfs (often /tmp) the "spilled" vectors stay in RAM
+index_spill_dir = "gallery_spill"
+
+
+def make_gallery():
+    options = {"spill_dir": index_spill_dir} if index_backend == "quantized" else {}
+    if index_backend != "exact" and os.path.exists(index_path):
+        try:
+            return EmbeddingGallery(index=FaceIndex.load(index_path, **options), alignment=face_alignment,
+                                    model_name=model_name)
+        except Exception as e:
+            app.logger.warning(f"Ignoring unreadable index file {index_path}: {e}")
+    return EmbeddingGallery(index=make_index(index_backend, **{**options, **index_options}),
+                            alignment=face_alignment, model_name=model_name)
+
+
+# Face detection/alignment before embedding: "mtcnn", "yunet" or None to
+# hand the whole frame to DeepFace's opencv detector as before. Aligned crops
+# embed faster and match more tightly, so threshold can be lowered once the
+# gallery has been re-embedded with the same detector (reembed.py --detector).
+# Stored embeddings record the detector they were made with, and the gallery
+# leaves out those made with another one.
+face_detector_backend = None
+face_alignment = face_detector_backend or "opencv"
+with startup_phase("face_detector"):
+    face_detector = FaceDetector(face_detector_backend) if face_detector_backend else None
+
+# Concurrent requests share ArcFace forward passes: pending images are
+# collected for up to max_wait_ms or until max_batch_size is reached
+batcher = MicroBatcher(
+    lambda images: represent_batch(model, images,
+                                   detector_backend="skip" if face_detector else "opencv"),
+    max_batch_size=16,
+    max_wait_ms=5,
+)
 
-def generate_presigned_url(s3_client, bucket_name, object_key, expiration=3600):
+# Embeddings of recent probes: near-identical consecutive kiosk frames from the
+# same lab reuse them instead of running ArcFace again. The gallery match is
+# always redone.
+probe_cache = ProbeCache(max_entries=256, ttl=5.0, max_distance=4, max_pixel_diff=6.0)
+
+# Each lab's verified reservations for today, reloaded after ttl seconds or
+# when the reservation site posts to /invalidate_reservations
+reservation_cache = ReservationCache(
+    timed_connect(db_pool.connection, db_seconds.labels(query="reservations")), ttl=60)
+
+# Resident copy of the enrolled embeddings, loaded once at startup
+gallery = make_gallery()
+
+# /verify_batch limits: probes per request and largest k. Its faces go
+# through the batcher as background work, batch_probes_in_flight pairs at a
+# time, so the kiosks' requests keep the front of the queue.
+max_batch_probes = 64
+max_batch_k = 50
+batch_probes_in_flight = 4
+
+# Seconds between incremental gallery syncs against user_img_changes
+gallery_sync_interval = 30
+# Rows of user_img_changes older than this are pruned once a day
+change_log_keep_days = 7
+change_log_prune_interval = 24 * 3600
+
+metrics.gauge("gallery_size", "Embeddings in the resident gallery", lambda: len(gallery))
+metrics.gauge("probe_cache_hits_total", "Probes served from the embedding cache",
+              lambda: probe_cache.hits, kind="counter")
+metrics.gauge("probe_cache_misses_total", "Probes that needed ArcFace",
+              lambda: probe_cache.misses, kind="counter")
+metrics.gauge("reservation_cache_hits_total", "Reservation lookups served from memory",
+              lambda: reservation_cache.hits, kind="counter")
+metrics.gauge("reservation_cache_misses_total", "Reservation lookups that queried the DB",
+              lambda: reservation_cache.misses, kind="counter")
+metrics.gauge("photo_cache_bytes", "Size of the enrollment photo cache on disk",
+              lambda: photo_cache.stats()["bytes"])
+metrics.gauge("access_journal_pending", "Journaled access events not yet written to the DB",
+              lambda: access_journal.pending())
+metrics.gauge("db_pool_open_connections", "Open DB connections", lambda: db_pool.stats()["open"])
+
+
+def prepare_face(image, face_box=None):
+    """Return the model input for a frame: the aligned 112x112 face crop, or
+    the frame itself when DeepFace does its own detection."""
+    if face_detector is None:
+        return image
+    return face_detector.extract(image, face_box)
+
+
+def prepare_crop(crop, face_box=None):
+    """Model input for a face the kiosk already cropped (see probe_protocol)."""
+    if face_detector is None:
+        return crop
+    if face_box is not None:
+        return crop_box(crop, face_box, face_detector.margin)
+    return cv2.resize(crop, (FACE_SIZE, FACE_SIZE))
+
+
+def calculate_features(*images):
+    """Embed ``images`` (e.g. a probe and its mirror) in one shared batch.
+
+    Returns one vector per image, None where extraction failed.
+    """
     try:
-        response = s3_client.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": bucket_name, "Key": object_key},
-            ExpiresIn=expiration
-        )
-        return response
-    except ClientError as e:
-        app.logger.error(f"Error generating presigned URL: {e}")
-        return None
+        return batcher.run(*images)
+    except Exception as e:
+        app.logger.error(f"Error calculating feature: {e}")
+        return [None] * len(images)
+
+
+def probe_features(face, lab_id):
+    """Embeddings of a probe face and its mirror, reused from probe_cache for
+    a near-duplicate of a recent frame at the same lab."""
+    key = probe_cache.key(face, model_name, lab_id)
+    features = probe_cache.get(key)
+    if features is None:
+        # The mirror pair always rides in the same batch
+        features = calculate_features(face, cv2.flip(face, 1))
+        if any(f is not None for f in features):
+            probe_cache.put(key, features)
+    return features
 
-def crop_face(image):
-    detector = MTCNN()
-    results = detector.detect_faces(image)
-    if results:
-        largest_face = max(results,key=lambda x: x['box'][2] * x['box'][3])
-        x,y,width,height = largest_face['box']
-        x,y = max(0,x), max(0,y)
-        cropped_face = image[y:y + height, x:x + width]
-        return cv2.resize(cropped_face, (112,112))
-    return None
 
 def calculate_feature(image):
-    try:
-        #cropped_face = crop_face(image)
-        #if cropped_face is None:
-            #app.logger.warning("No face detected in the image")
-            #return None
-        embedding = DeepFace.represent(image, model_name=model_name, enforce_detection=False)
-        if isinstance(embedding, list) and len(embedding) > 0:
-            return np.array(embedding[0]["embedding"], dtype=np.float32) 
-        else:
-            raise ValueError("Invalid embedding format")
-    except Exception as e:
-        app.logger.error(f"Error calculating feature: {e}")
-        return None
+    return calculate_features(image)[0]
+
+
+def decode_image(image_data):
+    np_arr = np.frombuffer(image_data, np.uint8)
+    img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+
+    if img is None:
+        raise ValueError("Failed to decode image")
+    return img
 
 
 def parse_from_request(request):
@@ -85,317 +280,332 @@ def parse_from_request(request):
         lab_id = request.form.get('lab_id')
         if not lab_id:
             raise ValueError("Missing 'lab_id' in form-data request")
+        face_box = parse_face_box(request.form.get('face_box'))
 
-        np_arr = np.frombuffer(image_data, np.uint8)
-        img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-
-        if img is None:
-            raise ValueError("Failed to decode image")
-
-        return img, lab_id
+        img = decode_image(image_data)
+        return img, lab_id, face_box
     except Exception as e:
         app.logger.error(f"Error parsing request: {e}")
         raise
 
 
-def update_missing_features():
-    try:
-        with pymysql.connect(**db_config) as connection:
-            with connection.cursor() as cursor:
-                cursor.execute("SELECT id, photo_path FROM user_img WHERE features IS NULL AND photo_path IS NOT NULL")
-                missing_features = cursor.fetchall()
-
-                for user_id, photo_path in missing_features:
-                    presigned_url = generate_presigned_url(s3_client, bucket_name, photo_path)
-                    if not presigned_url:
-                        continue
-
-                    response = requests.get(presigned_url)
-                    img_array = np.asarray(bytearray(response.content), dtype=np.uint8)
-                    img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-
-                    if img is None:
-                        app.logger.warning(f"Failed to decode image for user {user_id}")
-                        continue
-
-                    feature = calculate_feature(img)
-                    if feature is not None:
-                        feature_json = json.dumps(feature.tolist())
-                        cursor.execute("UPDATE user_img SET features = %s WHERE id = %s", (feature_json, user_id))
-                        connection.commit()
-    except pymysql.MySQLError as e:
-        app.logger.error(f"Database error: {e}")
+def download_photo(photo_path):
+    # A photo waiting for enrollment may have been re-uploaded under the same
+    # key, so it is always read from S3; the cached copy serves re-embedding
+    data = photo_cache.get(photo_path, refresh=True)
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
 
-@app.route('/upload_image', methods=['POST'])
-def upload_image():
-    try:
-        update_missing_features()
-        img, lab_id = parse_from_request(request)
-        mirr_img = cv2.flip(img,1)
-        # Extract embedding from the uploaded image
-        input_feature = calculate_feature(img)
-        mirr_input_feature = calculate_feature(mirr_img)
-        if input_feature is None and mirr_input_feature is None:
-            return jsonify({"error": "Feature extraction failed"}), 400
-
-        matched_student_id = None
-        min_distance = float("inf")
-
-        with pymysql.connect(**db_config) as connection:
-            with connection.cursor() as cursor:
-                # Query all stored features
-                cursor.execute("SELECT id, features FROM user_img WHERE features IS NOT NULL")
-                students = cursor.fetchall()
-
-                for student_id, features_json in students:
-                    # Load features directly from JSON array
-                    db_feature = np.array(json.loads(features_json), dtype=np.float32)
-                    input_feature = input_feature / np.linalg.norm(input_feature)
-                    db_feature = db_feature / np.linalg.norm(db_feature)
-                    distance = np.linalg.norm(input_feature - db_feature)
-                    mirr_distance = np.linalg.norm(mirr_input_feature - db_feature)
-                    #distance = np.dot(input_feature, db_feature)
-                    #mirr_distance = np.dot(mirr_input_feature, db_feature)
-                    best_distance = min(distance, mirr_distance)
-                    print(best_distance)
-                    if best_distance < min_distance and best_distance < threshold:
-                        min_distance = distance
-                        matched_student_id = student_id
-
-                today_date = datetime.date.today()
-                cursor.execute("""
-                    SELECT user_id, reservation_id, date, time FROM reservations
-                    WHERE lab_id = %s AND date = %s AND verified = 1
-                """, (lab_id, today_date))
-                reservations = cursor.fetchall()
-                print(reservations)
-                if matched_student_id:
-                    print(matched_student_id)
-                    for user_id, reservation_id, date, time in reservations:
-                        if user_id == matched_student_id:
-                            reservation_time = datetime.datetime.strptime(
-                                f"{date.strftime('%Y-%m-%d')} {time}", "%Y-%m-%d %H:%M")
-                            current_time = datetime.datetime.now()
-                            time_diff = abs((current_time - reservation_time).total_seconds()) / 60
-
-                            if time_diff <= 5:
-                                cursor.execute(
-                                    "UPDATE reservations SET checked = 1 WHERE reservation_id = %s",
-                                    (reservation_id,)
-                                )
-                                connection.commit()
-                                return jsonify({"verified": True, "student_id": matched_student_id})
-                            else:
-                                return jsonify({"verified": False, "message": "Outside the reservation time window"})
-                else:
-                    return jsonify({"verified": False, "message": "No matching student"})              
-
-        return jsonify({"verified": False, "message": "No upcoming reservation found"})
 
-    except ValueError as e:
-        app.logger.error(f"ValueError: {e}")
-        return jsonify({"error": str(e)}), 400
-    except Exception as e:
-        app.logger.error(f"Unexpected error: {e}")
-        return jsonify({"error": "An unexpected error occurred"}), 500
+def embed_photo(img):
+    face = prepare_face(img)
+    if face is None:
+        return None
+    return calculate_feature(face)
 
 
-if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=5000, debug=True)
-from flask import Flask, request, jsonify
-from deepface import DeepFace
-import boto3
-from mtcnn import MTCNN
-import pymysql
-import cv2
-import numpy as np
-import datetime
-import requests
-from botocore.exceptions import ClientError
-from flask_cors import CORS
-from config import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION_NAME, S3_BUCKET_NAME, DB_CONFIG
-import json
+# Binary embeddings only once user_img.features is known to be a BLOB column
+# (start_services converts it); until then new rows keep the JSON format
+binary_features = False
 
-app = Flask(__name__)
-CORS(app)
 
-# Initialize ArcFace model
-model_name = "ArcFace"
-model = DeepFace.build_model(model_name)
+def encode_feature(feature):
+    if not binary_features:
+        return json.dumps(np.asarray(feature, dtype=np.float32).tolist())
+    return encode_embedding(feature, model_name, alignment=face_alignment)
 
-# S3 client
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    region_name=AWS_REGION_NAME
-)
 
-bucket_name = S3_BUCKET_NAME
+# Fills in user_img.features in the background; see enrollment.py
+enrollment = EnrollmentPipeline(
+    connect=timed_connect(db_pool.connection, db_seconds.labels(query="enrollment")),
+    fetch_image=download_photo,
+    embed=embed_photo,
+    encode=encode_feature,
+    on_embedded=gallery.apply_changes,
+)
 
-# Database configuration
-db_config = DB_CONFIG
 
-# Matching threshold
-threshold = 1
+def update_missing_features():
+    # Enrollment runs off the request path; this only requests an early scan
+    enrollment.trigger()
+
+
+# Check-ins go through the access journal: the door opens once the event is
+# on local disk and access_journal writes it to RDS in the background, so a
+# DB outage does not block students whose reservations are cached. With
+# False, check_in waits on one conditional UPDATE that re-checks the slot.
+write_behind = True
+access_journal = AccessJournal(
+    "access_journal",
+    timed_connect(db_pool.connection, db_seconds.labels(query="access_journal")),
+)
 
 
-def generate_presigned_url(s3_client, bucket_name, object_key, expiration=3600):
-    try:
-        response = s3_client.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": bucket_name, "Key": object_key},
-            ExpiresIn=expiration
-        )
-        return response
-    except ClientError as e:
-        app.logger.error(f"Error generating presigned URL: {e}")
+def check_in(lab_id, reservation, current_time):
+    """Check the student in to their open reservation. Returns the
+    reservation id, or None if no slot is open any more (e.g. cancelled
+    since the day was cached; only detected without write_behind)."""
+    if write_behind:
+        # The journaled access event is the check-in; see record_access
+        return checked_in(lab_id, reservation.reservation_id, current_time)
+    query, params = check_in_query(lab_id, reservation.reservation_id, current_time, reservation_window)
+    with db_seconds.labels(query="check_in").time(), db_pool.connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            matched = cursor.rowcount
+        connection.commit()
+    return checked_in(lab_id, reservation.reservation_id if matched else None, current_time)
+
+
+def checked_in(lab_id, reservation_id, current_time):
+    # Keeps the cached day in step with the outcome of a check-in query
+    if not reservation_id:
+        reservation_cache.invalidate(lab_id)
         return None
+    reservation_cache.mark_checked(lab_id, reservation_id, current_time.date())
+    return reservation_id
 
-def crop_face(image):
-    detector = MTCNN()
-    results = detector.detect_faces(image)
-    if results:
-        largest_face = max(results,key=lambda x: x['box'][2] * x['box'][3])
-        x,y,width,height = largest_face['box']
-        x,y = max(0,x), max(0,y)
-        cropped_face = image[y:y + height, x:x + width]
-        return cv2.resize(cropped_face, (112,112))
-    return None
 
-def calculate_feature(image):
-    try:
-        #cropped_face = crop_face(image)
-        #if cropped_face is None:
-            #app.logger.warning("No face detected in the image")
-            #return None
-        embedding = DeepFace.represent(image, model_name=model_name, enforce_detection=False)
-        if isinstance(embedding, list) and len(embedding) > 0:
-            return np.array(embedding[0]["embedding"], dtype=np.float32) 
-        else:
-            raise ValueError("Invalid embedding format")
-    except Exception as e:
-        app.logger.error(f"Error calculating feature: {e}")
-        return None
+def record_access(lab_id, method, response, reservation_id=None):
+    # On disk before the response goes out; with a reservation id a verified
+    # event also checks the reservation in when it is flushed
+    with stage_seconds.labels(stage="journal").time():
+        access_journal.record(lab_id, method, response.get("verified", False), response.get("student_id"),
+                              reservation_id, response.get("message"))
 
 
-def parse_from_request(request):
-    try:
-        file = request.files.get('image')
-        if not file or file.filename == '':
-            raise ValueError("No file part in form-data request")
+def confirm_access(response, reservation_id):
+    # The door opens only if the check-in found the slot still open
+    if reservation_id is None:
+        return {"verified": False, "message": "Outside the reservation time window"}
+    return response
 
-        image_data = file.read()
-        lab_id = request.form.get('lab_id')
-        if not lab_id:
-            raise ValueError("Missing 'lab_id' in form-data request")
 
-        np_arr = np.frombuffer(image_data, np.uint8)
-        img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+def match_reservation(lab_day, input_feature, mirr_input_feature, current_time):
+    """Decide the door outcome for a probe; see reservation_cache.decide_access."""
+    return decide_access(gallery, lab_day, (input_feature, mirr_input_feature), current_time,
+                         threshold, reservation_window, candidate_matching)
 
-        if img is None:
-            raise ValueError("Failed to decode image")
 
-        return img, lab_id
-    except Exception as e:
-        app.logger.error(f"Error parsing request: {e}")
-        raise
+def count_result(lab_id, response, status):
+    if status != 200:
+        result = "error"
+    elif response.get("verified"):
+        result = "match"
+    elif response.get("message") == "No face detected":
+        result = "no_face"
+    else:
+        result = "no_match"
+    results_total.labels(lab_id=lab_id or "unknown", result=result).inc()
 
 
-def update_missing_features():
-    try:
-        with pymysql.connect(**db_config) as connection:
-            with connection.cursor() as cursor:
-                cursor.execute("SELECT id, photo_path FROM user_img WHERE features IS NULL AND photo_path IS NOT NULL")
-                missing_features = cursor.fetchall()
-
-                for user_id, photo_path in missing_features:
-                    presigned_url = generate_presigned_url(s3_client, bucket_name, photo_path)
-                    if not presigned_url:
-                        continue
-
-                    response = requests.get(presigned_url)
-                    img_array = np.asarray(bytearray(response.content), dtype=np.uint8)
-                    img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-
-                    if img is None:
-                        app.logger.warning(f"Failed to decode image for user {user_id}")
-                        continue
-
-                    feature = calculate_feature(img)
-                    if feature is not None:
-                        feature_json = json.dumps(feature.tolist())
-                        cursor.execute("UPDATE user_img SET features = %s WHERE id = %s", (feature_json, user_id))
-                        connection.commit()
-    except pymysql.MySQLError as e:
-        app.logger.error(f"Database error: {e}")
+def not_ready():
+    # While the server boots the gallery may be empty or partly loaded, so a
+    # verification would turn enrolled students away (and journal the denial)
+    return jsonify({"error": "Server is starting, try again shortly"}), 503
+
 
 @app.route('/upload_image', methods=['POST'])
 def upload_image():
+    if not ready.is_set():
+        return not_ready()
+    with request_seconds.time():
+        response, status = verify_request()
+    count_result(request.form.get('lab_id'), response, status)
+    return jsonify(response), status
+
+
+@app.route('/upload_probe', methods=['POST'])
+def upload_probe():
+    """Compact variant of /upload_image: the body is a probe_protocol
+    envelope holding an already cropped face, so there is no full-frame
+    decode and no detection."""
+    if not ready.is_set():
+        return not_ready()
+    lab_id = None
+    with request_seconds.time():
+        try:
+            with stage_seconds.labels(stage="parse").time():
+                img, lab_id, face_box = decode_probe(request.get_data())
+        except ValueError as e:
+            app.logger.error(f"ValueError: {e}")
+            response, status = {"error": str(e)}, 400
+        else:
+            response, status = verify_face(lab_id, lambda: prepare_crop(img, face_box))
+    count_result(lab_id, response, status)
+    return jsonify(response), status
+
+
+def verify_request():
+    try:
+        with stage_seconds.labels(stage="parse").time():
+            img, lab_id, face_box = parse_from_request(request)
+    except ValueError as e:
+        app.logger.error(f"ValueError: {e}")
+        return {"error": str(e)}, 400
+    except Exception as e:
+        app.logger.error(f"Unexpected error: {e}")
+        return {"error": "An unexpected error occurred"}, 500
+    return verify_face(lab_id, lambda: prepare_face(img, face_box))
+
+
+def verify_face(lab_id, extract_face):
     try:
-        update_missing_features()
-        img, lab_id = parse_from_request(request)
-        mirr_img = cv2.flip(img,1)
-        # Extract embedding from the uploaded image
-        input_feature = calculate_feature(img)
-        mirr_input_feature = calculate_feature(mirr_img)
+        with stage_seconds.labels(stage="detect").time():
+            face = extract_face()
+        if face is None:
+            return {"verified": False, "message": "No face detected"}, 200
+        with stage_seconds.labels(stage="embed").time():
+            input_feature, mirr_input_feature = probe_features(face, lab_id)
         if input_feature is None and mirr_input_feature is None:
-            return jsonify({"error": "Feature extraction failed"}), 400
-
-        matched_student_id = None
-        min_distance = float("inf")
-
-        with pymysql.connect(**db_config) as connection:
-            with connection.cursor() as cursor:
-                # Query all stored features
-                cursor.execute("SELECT id, features FROM user_img WHERE features IS NOT NULL")
-                students = cursor.fetchall()
-
-                for student_id, features_json in students:
-                    # Load features directly from JSON array
-                    db_feature = np.array(json.loads(features_json), dtype=np.float32)
-                    input_feature = input_feature / np.linalg.norm(input_feature)
-                    db_feature = db_feature / np.linalg.norm(db_feature)
-                    distance = np.linalg.norm(input_feature - db_feature)
-                    mirr_distance = np.linalg.norm(mirr_input_feature - db_feature)
-                    #distance = np.dot(input_feature, db_feature)
-                    #mirr_distance = np.dot(mirr_input_feature, db_feature)
-                    best_distance = min(distance, mirr_distance)
-                    print(best_distance)
-                    if best_distance < min_distance and best_distance < threshold:
-                        min_distance = distance
-                        matched_student_id = student_id
-
-                today_date = datetime.date.today()
-                cursor.execute("""
-                    SELECT user_id, reservation_id, date, time FROM reservations
-                    WHERE lab_id = %s AND date = %s AND verified = 1
-                """, (lab_id, today_date))
-                reservations = cursor.fetchall()
-                print(reservations)
-                if matched_student_id:
-                    print(matched_student_id)
-                    for user_id, reservation_id, date, time in reservations:
-                        if user_id == matched_student_id:
-                            reservation_time = datetime.datetime.strptime(
-                                f"{date.strftime('%Y-%m-%d')} {time}", "%Y-%m-%d %H:%M")
-                            current_time = datetime.datetime.now()
-                            time_diff = abs((current_time - reservation_time).total_seconds()) / 60
-
-                            if time_diff <= 5:
-                                cursor.execute(
-                                    "UPDATE reservations SET checked = 1 WHERE reservation_id = %s",
-                                    (reservation_id,)
-                                )
-                                connection.commit()
-                                return jsonify({"verified": True, "student_id": matched_student_id})
-                            else:
-                                return jsonify({"verified": False, "message": "Outside the reservation time window"})
-                else:
-                    return jsonify({"verified": False, "message": "No matching student"})              
-
-        return jsonify({"verified": False, "message": "No upcoming reservation found"})
+            return {"error": "Feature extraction failed"}, 400
+
+        current_time = datetime.datetime.now()
+        with stage_seconds.labels(stage="reservation").time():
+            lab_day = reservation_cache.get(lab_id, current_time.date())
+        with stage_seconds.labels(stage="match").time():
+            response, reservation = match_reservation(lab_day, input_feature, mirr_input_feature, current_time)
+        reservation_id = None
+        if reservation is not None:
+            with stage_seconds.labels(stage="check_in").time():
+                reservation_id = check_in(lab_id, reservation, current_time)
+            response = confirm_access(response, reservation_id)
+        record_access(lab_id, "face", response, reservation_id)
+        return response, 200
 
+    except ValueError as e:
+        app.logger.error(f"ValueError: {e}")
+        return {"error": str(e)}, 400
+    except Exception as e:
+        app.logger.error(f"Unexpected error: {e}")
+        return {"error": "An unexpected error occurred"}, 500
+
+
+def rank_probes(probe_features, k):
+    """Top-``k`` [(student_id, distance)] per probe from one gallery search.
+
+    ``probe_features`` holds the vectors of each probe (e.g. the face and its
+    mirror, None where extraction failed); a student's distance is the
+    closest of them.
+    """
+    rows, owners = [], []
+    for owner, features in enumerate(probe_features):
+        for feature in features:
+            if feature is not None:
+                rows.append(feature)
+                owners.append(owner)
+    best = [{} for _ in probe_features]
+    if rows:
+        ids, distances = gallery.search(np.vstack(rows), k)
+        for owner, row_ids, row_distances in zip(owners, ids, distances):
+            for student_id, distance in zip(row_ids, row_distances):
+                if student_id is not None and distance < best[owner].get(student_id, float("inf")):
+                    best[owner][student_id] = float(distance)
+    return [sorted(found.items(), key=lambda item: item[1])[:k] for found in best]
+
+
+def batch_response(probe_features, errors, k):
+    with stage_seconds.labels(stage="batch_search").time():
+        ranked = rank_probes(probe_features, k)
+    results = []
+    for index, (matches, error) in enumerate(zip(ranked, errors)):
+        if error:
+            results.append({"index": index, "error": error})
+            continue
+        results.append({
+            "index": index,
+            "verified": bool(matches) and matches[0][1] < threshold,
+            "matches": [{"student_id": student_id, "distance": distance} for student_id, distance in matches],
+        })
+    return {"k": k, "threshold": threshold, "results": results}
+
+
+def verify_batch_images(image_datas, k):
+    """Top-k matches for many encoded images: the faces go through the
+    batcher as background work and all of them are searched together."""
+    faces, errors = [], []
+    with stage_seconds.labels(stage="batch_decode").time():
+        for image_data in image_datas:
+            try:
+                face = prepare_face(decode_image(image_data))
+            except ValueError as e:
+                face, error = None, str(e)
+            else:
+                error = None if face is not None else "No face detected"
+            faces.append(face)
+            errors.append(error)
+
+    with stage_seconds.labels(stage="batch_embed").time():
+        probe_features = []
+        for start in range(0, len(faces), batch_probes_in_flight):
+            futures = [batcher.submit((face, cv2.flip(face, 1)), background=True) if face is not None else None
+                       for face in faces[start:start + batch_probes_in_flight]]
+            for index, pair in enumerate(futures, start):
+                try:
+                    probe_features.append([f.result() for f in pair] if pair else [])
+                except Exception as e:
+                    app.logger.error(f"Error calculating feature: {e}")
+                    probe_features.append([])
+                if pair and not any(f is not None for f in probe_features[-1]):
+                    errors[index] = "Feature extraction failed"
+    return batch_response(probe_features, errors, k)
+
+
+def verify_batch_embeddings(embeddings, k):
+    probe_features, errors = [], []
+    for embedding in embeddings:
+        vector = np.asarray(embedding, dtype=np.float32)
+        if vector.shape != (gallery.dim,):
+            probe_features.append([])
+            errors.append(f"Embedding must have {gallery.dim} values")
+        else:
+            probe_features.append([vector])
+            errors.append(None)
+    return batch_response(probe_features, errors, k)
+
+
+def verify_batch_json(body):
+    embeddings = body.get("embeddings") if isinstance(body, dict) else None
+    if not isinstance(embeddings, list) or not embeddings:
+        raise ValueError("'embeddings' must be a non-empty list")
+    if len(embeddings) > max_batch_probes:
+        raise ValueError(f"At most {max_batch_probes} probes per request")
+    return verify_batch_embeddings(embeddings, batch_k(body.get("k")))
+
+
+def verify_batch_files(image_datas, k):
+    if not image_datas:
+        raise ValueError("No 'images' files or 'embeddings' in request")
+    if len(image_datas) > max_batch_probes:
+        raise ValueError(f"At most {max_batch_probes} probes per request")
+    return verify_batch_images(image_datas, batch_k(k))
+
+
+def batch_k(value):
+    try:
+        k = int(value) if value is not None else 5
+    except (TypeError, ValueError):
+        raise ValueError("'k' must be an integer")
+    if not 1 <= k <= max_batch_k:
+        raise ValueError(f"'k' must be between 1 and {max_batch_k}")
+    return k
+
+
+@app.route('/verify_batch', methods=['POST'])
+def verify_batch():
+    """Top-k matches with distances for many probes in one request.
+
+    Either multipart ``images`` files (full frames, detected and embedded in
+    shared batches) or a JSON body ``{"embeddings": [[...], ...]}``; ``k``
+    as a form field or JSON key. Nothing is checked in.
+    """
+    if not ready.is_set():
+        return not_ready()
+    try:
+        body = request.get_json(silent=True)
+        if body is not None:
+            return jsonify(verify_batch_json(body))
+        files = request.files.getlist('images')
+        return jsonify(verify_batch_files([file.read() for file in files], request.form.get('k')))
     except ValueError as e:
         app.logger.error(f"ValueError: {e}")
         return jsonify({"error": str(e)}), 400
@@ -404,5 +614,152 @@ def upload_image():
         return jsonify({"error": "An unexpected error occurred"}), 500
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    return metrics.render(), 200, {"Content-Type": metrics.content_type}
+
+
+@app.route('/sync_gallery', methods=['POST'])
+def sync_gallery_route():
+    if gallery.index.kind == "shared":
+        # A pre-fork worker only reads the segment its owner process publishes
+        return jsonify({"error": "This worker's gallery is synced by the gallery owner process"}), 409
+    changed = sync_gallery()
+    if changed is None:
+        return jsonify({"error": "Gallery sync failed"}), 500
+    return jsonify({"changed": changed, "size": len(gallery)})
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        "probe_cache": probe_cache.stats(),
+        "reservation_cache": {"hits": reservation_cache.hits, "misses": reservation_cache.misses},
+        "db_pool": db_pool.stats(),
+        "access_journal": {"pending": access_journal.pending()},
+    })
+
+
+@app.route('/invalidate_reservations', methods=['POST'])
+def invalidate_reservations():
+    lab_id = request.form.get('lab_id') or (request.get_json(silent=True) or {}).get('lab_id')
+    reservation_cache.invalidate(lab_id)
+    return jsonify({"invalidated": lab_id or "all"})
+
+
+def load_gallery():
+    try:
+        with db_seconds.labels(query="gallery_load").time(), db_pool.connection() as connection:
+            gallery.load(connection)
+        app.logger.info(f"Loaded {len(gallery)} embeddings into the gallery")
+        if index_backend != "exact":
+            gallery.index.save(index_path)
+    except pymysql.MySQLError as e:
+        app.logger.error(f"Database error while loading gallery: {e}")
+
+
+def sync_gallery():
+    try:
+        with db_seconds.labels(query="gallery_sync").time(), db_pool.connection() as connection:
+            changed = gallery.sync(connection)
+        if changed:
+            app.logger.info(f"Gallery sync applied {changed} changes")
+        return changed
+    except pymysql.MySQLError as e:
+        app.logger.error(f"Database error while syncing gallery: {e}")
+        return None
+
+
+def prune_gallery_changes():
+    try:
+        with db_pool.connection() as connection:
+            prune_change_log(connection, change_log_keep_days)
+    except pymysql.MySQLError as e:
+        app.logger.error(f"Database error while pruning the gallery change log: {e}")
+
+
+def start_gallery_sync(interval=gallery_sync_interval):
+    stop_event = threading.Event()
+
+    def run():
+        pruned_at = time.monotonic()
+        while not stop_event.wait(interval):
+            sync_gallery()
+            if time.monotonic() - pruned_at >= change_log_prune_interval:
+                prune_gallery_changes()
+                pruned_at = time.monotonic()
+
+    threading.Thread(target=run, name="gallery-sync", daemon=True).start()
+    return stop_event
+
+
+def start_services():
+    # Shared by every server entry point (this file and asgi_AI.py)
+    global binary_features
+    with startup_phase("db_pool"):
+        try:
+            db_pool.fill()
+            with db_pool.connection() as connection:
+                install_reservation_index(connection)
+                install_access_events_table(connection)
+        except pymysql.MySQLError as e:
+            app.logger.error(f"Database error while opening connections: {e}")
+        try:
+            with db_pool.connection() as connection:
+                install_change_log(connection)
+        except pymysql.MySQLError as e:
+            # Creating triggers needs the TRIGGER privilege; without the log
+            # every gallery sync is a full reload
+            app.logger.error(f"Database error while installing the gallery change log: {e}")
+        try:
+            with db_pool.connection() as connection:
+                ensure_blob_column(connection)
+            binary_features = True
+        except pymysql.MySQLError as e:
+            # Without ALTER the column may still be TEXT; keep writing JSON
+            app.logger.error(f"Database error while converting user_img.features to a BLOB: {e}")
+    with startup_phase("gallery"):
+        load_gallery()
+    start_gallery_sync()
+    enrollment.start()
+    access_journal.open()
+
+
+def warm_up():
+    """Run every stage of a verification once on dummy input, so the first
+    real request does not pay for graph building and lazy initialization."""
+    with startup_phase("warm_up_detector"):
+        if face_detector is not None:
+            face_detector.detect(np.zeros((480, 640, 3), dtype=np.uint8))
+    with startup_phase("warm_up_model"):
+        face = np.zeros((FACE_SIZE, FACE_SIZE, 3), dtype=np.uint8)
+        # A lone probe with its mirror, and a single enrollment photo
+        calculate_features(face, face)
+        calculate_features(face)
+    with startup_phase("warm_up_match"):
+        gallery.match(np.ones(gallery.dim, dtype=np.float32))
+
+
+def boot():
+    start_services()
+    warm_up()
+    startup_timings["total"] = time.perf_counter() - boot_started
+    ready.set()
+    app.logger.info(f"Ready after {startup_timings['total']:.2f}s")
+
+
+@app.route('/ready', methods=['GET'])
+def ready_route():
+    timings = {name: round(seconds, 3) for name, seconds in startup_timings.items()}
+    if not ready.is_set():
+        return jsonify({"ready": False, "timings": timings}), 503
+    return jsonify({"ready": True, "gallery_size": len(gallery), "timings": timings})
+
+
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    logging.basicConfig(level=logging.INFO)
+    # Serve right away so /ready answers 503 while the gallery loads and the
+    # model warms up
+    threading.Thread(target=boot, name="boot", daemon=True).start()
+    # No reloader: it would start a second process that loads the model again
+    app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=False)
@@ -0,0 +1,256 @@
+import logging
+import threading
+import numpy as np
+from embedding_codec import decode_embedding
+from face_index import ExactIndex, as_id_array
+
+logger = logging.getLogger(__name__)
+
+# Change log filled by triggers on user_img. Every insert, delete and update
+# of the features or the id appends one row (a new photo only shows up once
+# its features are rewritten), so the server can pull only what changed since
+# its last sync by walking the primary key. AUTO_INCREMENT ids
+# are handed out at insert but become visible at commit, so a sync re-reads a
+# trailing window of ids to pick up entries committed out of order.
+CHANGE_LOG_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS user_img_changes (
+        change_id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        user_id VARCHAR(64) NOT NULL,
+        changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "DROP TRIGGER IF EXISTS user_img_after_insert",
+    """
+    CREATE TRIGGER user_img_after_insert AFTER INSERT ON user_img FOR EACH ROW
+        INSERT INTO user_img_changes (user_id) VALUES (NEW.id)
+    """,
+    "DROP TRIGGER IF EXISTS user_img_after_update",
+    """
+    CREATE TRIGGER user_img_after_update AFTER UPDATE ON user_img FOR EACH ROW
+    BEGIN
+        IF NOT (OLD.features <=> NEW.features) OR OLD.id <> NEW.id THEN
+            INSERT INTO user_img_changes (user_id) VALUES (NEW.id);
+        END IF;
+        IF OLD.id <> NEW.id THEN
+            INSERT INTO user_img_changes (user_id) VALUES (OLD.id);
+        END IF;
+    END
+    """,
+    "DROP TRIGGER IF EXISTS user_img_after_delete",
+    """
+    CREATE TRIGGER user_img_after_delete AFTER DELETE ON user_img FOR EACH ROW
+        INSERT INTO user_img_changes (user_id) VALUES (OLD.id)
+    """,
+]
+
+
+def install_change_log(connection):
+    with connection.cursor() as cursor:
+        for statement in CHANGE_LOG_DDL:
+            cursor.execute(statement)
+    connection.commit()
+
+
+def prune_change_log(connection, keep_days=7):
+    # Servers that were offline longer than keep_days fall back to a full load
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM user_img_changes WHERE changed_at < NOW() - INTERVAL %s DAY",
+            (keep_days,)
+        )
+    connection.commit()
+
+
+class EmbeddingGallery:
+    """Resident copy of all enrolled embeddings.
+
+    Embeddings live in a search index from face_index.py; the default
+    ExactIndex keeps them as one pre-normalized float32 matrix with an aligned
+    id array, so a lookup is a single matrix-vector product instead of a
+    per-row loop over the database. ``sync`` keeps the copy current by reading
+    only the ``user_img_changes`` rows past the last seen ``change_id``, less
+    ``lookback`` ids so an entry committed after a higher one is not lost.
+
+    With ``model_name`` or ``alignment`` set, embeddings recorded under a
+    different model or face detector (see embedding_codec.py) are left out
+    like unreadable rows.
+    """
+
+    def __init__(self, dim=512, index=None, lookback=1000, alignment=None, model_name=None):
+        self.dim = dim
+        self.index = index if index is not None else ExactIndex(dim)
+        self.lookback = lookback
+        self.alignment = alignment
+        self.model_name = model_name
+        self.last_change_id = None
+        # Change ids applied within the trailing window
+        self._seen = set()
+        # Bumped on every change so copies (e.g. shared memory) know to refresh
+        self.version = 0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.index)
+
+    def _decode(self, features):
+        # Accepts both the binary format and legacy JSON rows
+        try:
+            vector = decode_embedding(features, self.alignment, self.model_name)
+        except ValueError:
+            return None
+        if vector is None or vector.shape != (self.dim,):
+            return None
+        return vector
+
+    def load(self, connection):
+        with self._sync_lock:
+            with connection.cursor() as cursor:
+                # Read the high-water mark first: changes racing with the full
+                # scan are replayed by the next sync, which is idempotent.
+                try:
+                    cursor.execute("SELECT COALESCE(MAX(change_id), 0) FROM user_img_changes")
+                    last_change_id = cursor.fetchone()[0]
+                    cursor.execute("SELECT change_id FROM user_img_changes WHERE change_id > %s",
+                                   (last_change_id - self.lookback,))
+                    seen = {change_id for change_id, in cursor.fetchall()}
+                except Exception as e:
+                    logger.warning(f"No user_img_changes change log, every sync will reload the gallery: {e}")
+                    last_change_id = None
+                    seen = set()
+                cursor.execute("SELECT id, features FROM user_img WHERE features IS NOT NULL")
+                rows = cursor.fetchall()
+
+            ids = []
+            vectors = []
+            for user_id, features in rows:
+                vector = self._decode(features)
+                if vector is None:
+                    continue
+                ids.append(user_id)
+                vectors.append(vector)
+            if len(ids) < len(rows):
+                logger.warning(f"Skipped {len(rows) - len(ids)} unreadable or mismatched embeddings")
+
+            matrix = np.vstack(vectors) if vectors else np.empty((0, self.dim), dtype=np.float32)
+            self.replace(ids, matrix)
+            self.last_change_id = last_change_id
+            self._seen = seen
+
+    def sync(self, connection):
+        """Apply rows added, changed or deleted since the last sync.
+
+        Returns the number of users touched. Without a change log (or before
+        the first load) this falls back to a full ``load``.
+        """
+        if self.last_change_id is None:
+            self.load(connection)
+            return len(self)
+
+        with self._sync_lock:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT change_id FROM user_img_changes WHERE change_id > %s ORDER BY change_id",
+                    (self.last_change_id - self.lookback,)
+                )
+                change_ids = [change_id for change_id, in cursor.fetchall() if change_id not in self._seen]
+                if not change_ids:
+                    return 0
+                placeholders = ", ".join(["%s"] * len(change_ids))
+                cursor.execute(f"""
+                    SELECT c.change_id, c.user_id, u.features
+                    FROM user_img_changes c
+                    LEFT JOIN user_img u ON u.id = c.user_id
+                    WHERE c.change_id IN ({placeholders})
+                    ORDER BY c.change_id
+                """, change_ids)
+                rows = cursor.fetchall()
+
+            # The join returns the current row, so only the latest state of
+            # each user matters no matter how many log entries it has.
+            upserts = {}
+            removals = set()
+            for change_id, user_id, features in rows:
+                vector = self._decode(features)
+                if vector is None:
+                    upserts.pop(user_id, None)
+                    removals.add(user_id)
+                else:
+                    removals.discard(user_id)
+                    upserts[user_id] = vector
+
+            self.apply_changes(upserts, removals)
+            last_change_id = max(self.last_change_id, change_ids[-1])
+            self._seen = {change_id for change_id in self._seen if change_id > last_change_id - self.lookback}
+            self._seen.update(change_ids)
+            self.last_change_id = last_change_id
+            return len(upserts) + len(removals)
+
+    def replace(self, ids, matrix):
+        with self._lock:
+            self.index.replace(list(ids), np.asarray(matrix, dtype=np.float32).reshape(len(ids), self.dim))
+            self.version += 1
+
+    def apply_changes(self, upserts, removals=()):
+        """Insert/overwrite ``upserts`` ({user_id: vector}) and drop ``removals``."""
+        with self._lock:
+            touched = set(upserts) | set(removals)
+            if touched:
+                self.index.remove(touched)
+            if upserts:
+                self.index.add(list(upserts), np.vstack(list(upserts.values())))
+            if touched:
+                self.version += 1
+
+    def upsert(self, user_id, vector):
+        self.apply_changes({user_id: np.asarray(vector, dtype=np.float32)})
+
+    def search(self, queries, k=1):
+        """Top-``k`` (ids, distances) for every row of ``queries``, closest
+        first, with one search over the whole gallery."""
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        if len(self.index) == 0 or len(queries) == 0:
+            return as_id_array([]).reshape(len(queries), 0), np.empty((len(queries), 0))
+        return self.index.search(queries, k)
+
+    def match(self, *queries, candidates=None):
+        """Return (user_id, distance) of the closest enrolled face.
+
+        Each query (e.g. the probe and its mirrored copy) is normalized once and
+        all of them are searched together; with the exact index that is one
+        matrix product. Distances are euclidean between unit vectors, the
+        metric ``threshold`` was tuned for.
+
+        With ``candidates`` only those user ids are compared, which turns the
+        gallery scan into a comparison against a handful of vectors.
+        """
+        probes = [q for q in queries if q is not None]
+        if len(self.index) == 0 or not probes:
+            return None, float("inf")
+
+        if candidates is not None:
+            ids, distances = self.index.search_subset(np.vstack(probes), list(candidates), k=1)
+        else:
+            ids, distances = self.index.search(np.vstack(probes), k=1)
+        if distances.shape[1] == 0:
+            return None, float("inf")
+        best = int(np.argmin(distances[:, 0]))
+        return ids[best, 0], float(distances[best, 0])
+
+
+if __name__ == '__main__':
+    import sys
+    import pymysql
+    from config import DB_CONFIG
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "install"
+    with pymysql.connect(**DB_CONFIG) as connection:
+        if command == "install":
+            install_change_log(connection)
+            print("Installed user_img_changes table and triggers")
+        elif command == "prune":
+            prune_change_log(connection)
+            print("Pruned old user_img_changes rows")
+        else:
+            print("Usage: python gallery.py [install|prune]")
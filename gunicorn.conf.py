@@ -0,0 +1,29 @@
+# Pre-fork deployment of the verification server; see prefork_AI.py
+import multiprocessing
+
+wsgi_app = "prefork_AI:app"
+bind = "0.0.0.0:5000"
+
+# One process per core; a few threads each so requests can share batches
+workers = multiprocessing.cpu_count()
+worker_class = "gthread"
+threads = 4
+timeout = 60
+
+# Load the model once in the master so workers share it copy-on-write
+preload_app = True
+
+
+def on_starting(server):
+    import prefork_AI
+    prefork_AI.start_owner()
+
+
+def post_fork(server, worker):
+    import prefork_AI
+    prefork_AI.attach_worker()
+
+
+def on_exit(server):
+    import prefork_AI
+    prefork_AI.stop_owner()
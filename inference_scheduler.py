@@ -0,0 +1,93 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """Collects embedding requests from concurrent callers into batches.
+
+    ``submit`` enqueues a group of images (e.g. a probe and its mirror) and
+    returns one future per image. A single worker thread waits until either
+    ``max_batch_size`` images are pending or the oldest request has waited
+    ``max_wait_ms``, then runs ``batch_fn`` once on everything it took and
+    resolves the futures. Groups are never split across batches.
+
+    Groups submitted with ``background=True`` (bulk work such as
+    /verify_batch) only fill the room live requests leave in a batch, so a
+    live request waits behind at most one batch, never behind a backlog.
+
+    ``batch_fn(images)`` must return one result per image, in order.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=16, max_wait_ms=5):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.items = 0
+        self._pending = deque()
+        self._background = deque()
+        self._pending_count = 0
+        self._cond = threading.Condition()
+        self._pid = None
+
+    def _ensure_worker(self):
+        # Started lazily, and again in a forked child, which inherits the
+        # object but not the thread
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="inference-batcher", daemon=True).start()
+
+    def submit(self, images, background=False):
+        futures = [Future() for _ in images]
+        with self._cond:
+            self._ensure_worker()
+            queue = self._background if background else self._pending
+            queue.append((time.monotonic(), list(images), futures))
+            self._pending_count += len(futures)
+            self._cond.notify()
+        return futures
+
+    def run(self, *images):
+        """Embed ``images`` as one group and wait for the results."""
+        return [future.result() for future in self.submit(images)]
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._pending and not self._background:
+                self._cond.wait()
+            oldest = (self._pending or self._background)[0][0]
+            deadline = oldest + self.max_wait
+            while self._pending_count < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            groups = []
+            size = 0
+            for queue in (self._pending, self._background):
+                while queue and (not groups or size + len(queue[0][1]) <= self.max_batch_size):
+                    group = queue.popleft()
+                    groups.append(group)
+                    size += len(group[1])
+            self._pending_count -= size
+            return groups
+
+    def _run(self):
+        while True:
+            groups = self._take_batch()
+            images = [image for _, group_images, _ in groups for image in group_images]
+            futures = [future for _, _, group_futures in groups for future in group_futures]
+            try:
+                results = self.batch_fn(images)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(images)
+            for future, result in zip(futures, results):
+                future.set_result(result)
@@ -8,6 +8,7 @@ from qr_verify_page import QR_CameraWindow
 from face_verify_page import CameraWindow
 #from stream_page import StreamWindow
 from setting_page import LAbSetWindow
+from aws_connect import access_journal
 
 class MainWindow(QMainWindow):
     def __init__(self, lab_id=None, lab_name=None):
@@ -109,6 +110,8 @@ class MainWindow(QMainWindow):
         QApplication.quit()
 
 if __name__ == "__main__":
+    # Writes out check-ins journaled while RDS was unreachable last run
+    access_journal.open()
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
@@ -0,0 +1,269 @@
+import contextlib
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class S3Store:
+    """Enrollment photos in the S3 bucket.
+
+    Reads go through ``get_object`` on one shared boto3 client, so every
+    download thread reuses its pooled connections; build the client with
+    ``s3_config`` to size the pool and bound each request. ``timer`` is an
+    optional histogram (see metrics.py) each request is observed in.
+    """
+
+    def __init__(self, client, bucket, timer=None):
+        self.client = client
+        self.bucket = bucket
+        self.timer = timer
+
+    def _timed(self):
+        return self.timer.time() if self.timer is not None else contextlib.nullcontext()
+
+    def get(self, key):
+        with self._timed():
+            return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+    def put(self, key, data):
+        with self._timed():
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+
+def s3_config(pool_size=16, connect_timeout=5, read_timeout=10, max_attempts=3):
+    """Client config for the photo bucket: a pool shared by ``pool_size``
+    threads, and timeouts so a stalled request fails instead of holding a
+    download thread (and its pooled connection) indefinitely."""
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=pool_size,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        retries={"max_attempts": max_attempts, "mode": "standard"},
+    )
+
+
+class LocalDirectoryStore:
+    """Photos as files under ``root``, keyed like the S3 bucket; stands in
+    for S3 in benchmarks and offline runs."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        with open(self.path(key), "rb") as f:
+            return f.read()
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+class PhotoCache:
+    """Content-addressed disk cache in front of a store.
+
+    Photo bytes are kept once per SHA-256 under ``root/objects``, and
+    ``root/refs`` maps each key to the digest of its content, so a cached
+    read is checked against its name. Files are written through a temp
+    file and rename, so several processes (server workers, reembed.py) can
+    share one directory. Reads refresh a file's mtime; once the objects
+    pass ``max_bytes`` the least recently used are removed down to 90%.
+    """
+
+    def __init__(self, store, root, max_bytes=2 * 1024 ** 3):
+        self.store = store
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._objects = os.path.join(root, "objects")
+        self._refs = os.path.join(root, "refs")
+        os.makedirs(self._objects, exist_ok=True)
+        os.makedirs(self._refs, exist_ok=True)
+        self._lock = threading.Lock()
+        self._bytes = sum(size for _, size, _ in self._scan())
+
+    def _ref_path(self, key):
+        return os.path.join(self._refs, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects, digest[:2], digest)
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+    def _read(self, key):
+        ref_path = self._ref_path(key)
+        try:
+            with open(ref_path) as f:
+                digest = f.read().strip()
+            path = self._object_path(digest)
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if hashlib.sha256(data).hexdigest() != digest:
+            logger.warning(f"Dropping corrupt cache entry for {key}")
+            with contextlib.suppress(OSError):
+                os.remove(path)
+                with self._lock:
+                    self._bytes -= len(data)
+            return None
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        return data
+
+    def _store(self, key, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if os.path.exists(path):
+            with contextlib.suppress(OSError):
+                os.utime(path)
+        else:
+            self._write(path, data)
+            with self._lock:
+                self._bytes += len(data)
+        self._write(self._ref_path(key), digest.encode("ascii"))
+        if self._bytes > self.max_bytes:
+            self.evict()
+
+    def get(self, key, refresh=False):
+        """Photo bytes for ``key``, from disk when cached.
+
+        ``refresh`` always reads the store (e.g. for a photo that may have
+        been re-uploaded under the same key) and caches the result.
+        """
+        if not refresh:
+            data = self._read(key)
+            if data is not None:
+                self.hits += 1
+                return data
+        self.misses += 1
+        data = self.store.get(key)
+        self._store(key, data)
+        return data
+
+    def contains(self, key):
+        try:
+            with open(self._ref_path(key)) as f:
+                return os.path.exists(self._object_path(f.read().strip()))
+        except FileNotFoundError:
+            return False
+
+    def _scan(self):
+        for shard in os.scandir(self._objects):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.startswith(".tmp-"):
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    stat = entry.stat()
+                    yield stat.st_mtime, stat.st_size, entry.path
+
+    def evict(self):
+        # Rescan: other processes sharing the directory add and remove files
+        with self._lock:
+            entries = sorted(self._scan())
+            total = sum(size for _, size, _ in entries)
+            target = self.max_bytes * 0.9
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                total -= size
+            self._bytes = total
+        # Refs to removed objects read as misses and are rewritten on the next fetch
+
+    def prefetch(self, keys, workers=16):
+        """Download every uncached key on ``workers`` threads; returns
+        (fetched, already cached, failed)."""
+        counts = {"fetched": 0, "cached": 0, "failed": 0}
+        lock = threading.Lock()
+
+        def fetch(key):
+            if self.contains(key):
+                outcome = "cached"
+            else:
+                try:
+                    self.get(key, refresh=True)
+                    outcome = "fetched"
+                except Exception as e:
+                    logger.error(f"Failed to fetch {key}: {e}")
+                    outcome = "failed"
+            with lock:
+                counts[outcome] += 1
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="photo-prefetch") as pool:
+            list(pool.map(fetch, keys))
+        return counts["fetched"], counts["cached"], counts["failed"]
+
+    def stats(self):
+        return {"bytes": self._bytes, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+
+
+def open_store(cache_dir=None, cache_max_bytes=2 * 1024 ** 3, photos_dir=None, pool_size=16):
+    """The S3 bucket from config.py, or ``photos_dir`` in its place, behind
+    a PhotoCache when ``cache_dir`` is given; for the command line tools."""
+    if photos_dir:
+        store = LocalDirectoryStore(photos_dir)
+    else:
+        import boto3
+        from config import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION_NAME, S3_BUCKET_NAME
+        client = boto3.client(
+            's3',
+            aws_access_key_id=AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+            region_name=AWS_REGION_NAME,
+            config=s3_config(pool_size)
+        )
+        store = S3Store(client, S3_BUCKET_NAME)
+    return PhotoCache(store, cache_dir, cache_max_bytes) if cache_dir else store
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Fill the local photo cache with every user_img photo")
+    parser.add_argument("--cache-dir", default="photo_cache")
+    parser.add_argument("--max-gb", type=float, default=2.0, help="cache size cap")
+    parser.add_argument("--photos-dir", help="read photos from this directory instead of S3")
+    parser.add_argument("--workers", type=int, default=32, help="concurrent downloads")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    import pymysql
+    from config import DB_CONFIG
+
+    with pymysql.connect(**DB_CONFIG) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT photo_path FROM user_img WHERE photo_path IS NOT NULL")
+            keys = [photo_path for photo_path, in cursor.fetchall()]
+
+    cache = open_store(args.cache_dir, int(args.max_gb * 1024 ** 3), args.photos_dir, args.workers)
+    start = time.perf_counter()
+    fetched, cached, failed = cache.prefetch(keys, args.workers)
+    seconds = time.perf_counter() - start
+    print(f"{fetched} fetched, {cached} already cached, {failed} failed in {seconds:.1f}s; "
+          f"cache holds {cache.stats()['bytes'] / 1024 ** 2:.0f} MB")
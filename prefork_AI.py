@@ -0,0 +1,75 @@
+"""Pre-fork deployment of the face verification server.
+
+The gunicorn master imports this module once (``preload_app``), so the
+ArcFace model and face detector are loaded before fork and their memory is
+shared copy-on-write by every worker. A single owner process loads the
+gallery, runs the incremental sync and the enrollment pipeline and publishes
+the embedding matrix to shared memory; workers search that segment directly
+and pick up new generations without touching the database.
+
+    gunicorn -c gunicorn.conf.py
+
+The shared segment always holds the float32 matrix and workers search it
+exactly; an "ivf" or "quantized" index_backend only applies inside the
+owner. /sync_gallery on a worker answers 409, since the owner syncs on its
+own schedule.
+
+No inference may run in the master before it forks: TensorFlow's thread
+pools do not survive fork. Each worker warms up right after fork, before it
+accepts requests, and then reports ready on /ready.
+"""
+import multiprocessing
+
+import flask_AI as core
+from gallery import EmbeddingGallery
+from shared_gallery import SharedGalleryPublisher, SharedIndex
+
+shared_name = "lab_gallery"
+publish_interval = 1.0
+
+app = core.app
+owner = None
+
+
+def run_owner(ready):
+    if core.index_backend != "exact":
+        core.app.logger.warning(f"Workers search the shared float32 gallery exactly; "
+                                f"index_backend {core.index_backend!r} only applies to the owner")
+    core.start_services()
+    publisher = SharedGalleryPublisher(core.gallery, shared_name)
+    publisher.publish()
+    ready.set()
+    try:
+        publisher.publish_changes(publish_interval).wait()
+    finally:
+        publisher.close()
+
+
+def start_owner(timeout=300):
+    # Called from the master before any worker is forked
+    global owner
+    context = multiprocessing.get_context("fork")
+    ready = context.Event()
+    owner = context.Process(target=run_owner, args=(ready,), name="gallery-owner", daemon=True)
+    owner.start()
+    if not ready.wait(timeout):
+        raise RuntimeError("Gallery owner did not publish the gallery in time")
+
+
+def attach_worker():
+    # Called in each worker right after fork: search the shared copy instead
+    # of keeping a private gallery. The master runs no resource tracker, so
+    # each worker starts its own; SharedIndex unregisters the segments from
+    # it, or a worker's exit would unlink them under the owner.
+    core.gallery = EmbeddingGallery(index=SharedIndex(shared_name))
+    # Inference is safe from here on; warm up before taking requests
+    core.warm_up()
+    # Each worker journals its own check-ins
+    core.access_journal.open()
+    core.ready.set()
+
+
+def stop_owner():
+    if owner is not None and owner.is_alive():
+        owner.terminate()
+        owner.join(5)
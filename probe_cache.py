@@ -0,0 +1,130 @@
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+def perceptual_hash(image, size=16):
+    """Difference hash of an image as a packed bit array.
+
+    The image is shrunk to (size + 1) x size grey pixels and each bit records
+    whether a pixel is brighter than its right neighbour, so small shifts,
+    noise and exposure changes between camera frames flip only a few bits.
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(image, (size + 1, size), interpolation=cv2.INTER_AREA)
+    return np.packbits(small[:, 1:] > small[:, :-1])
+
+
+def hamming(a, b):
+    return int(np.unpackbits(a ^ b).sum())
+
+
+def thumbnail(image, size=32):
+    """Small grey copy of an image for confirming a hash match pixel by pixel."""
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+class ProbeCache:
+    """Short-lived LRU cache of probe embeddings, keyed by perceptual hash.
+
+    The kiosk keeps sending frames while a face is in view, and consecutive
+    frames of the same person differ by a few hash bits at most. A probe
+    from the same ``scope`` (the lab, i.e. the same kiosk camera) whose hash
+    is within ``max_distance`` bits of a cached one (for the same model)
+    reuses that entry's embeddings instead of running ArcFace again.
+
+    Aligned face crops all share one geometry, so the hashes of two
+    different people can be close; a hash match is only a hit when the
+    mean absolute difference of the two grey thumbnails is also at most
+    ``max_pixel_diff`` grey levels. Entries expire ``ttl`` seconds after
+    they were stored, so a new person in front of the camera never inherits
+    an old probe for long.
+    """
+
+    def __init__(self, max_entries=256, ttl=5.0, max_distance=4, hash_size=16, max_pixel_diff=6.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self.max_pixel_diff = max_pixel_diff
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, image, model_name, scope=None):
+        return model_name, scope, perceptual_hash(image, self.hash_size), thumbnail(image)
+
+    def _expire(self, now):
+        # Hits reorder entries, so expiry has to look at all of them
+        stale = [key for key, (stored_at, _, _) in self._entries.items() if now - stored_at >= self.ttl]
+        for key in stale:
+            del self._entries[key]
+        self.expired += len(stale)
+
+    def get(self, key):
+        """Cached features for a probe near ``key``, or None."""
+        model_name, scope, probe_hash, probe_thumbnail = key
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            best, best_distance = None, self.max_distance + 1
+            for cached_key, (_, _, cached_thumbnail) in self._entries.items():
+                if cached_key[:2] != (model_name, scope):
+                    continue
+                distance = hamming(np.frombuffer(cached_key[2], dtype=np.uint8), probe_hash)
+                if distance >= best_distance:
+                    continue
+                if np.abs(cached_thumbnail - probe_thumbnail).mean() > self.max_pixel_diff:
+                    continue
+                best, best_distance = cached_key, distance
+                if distance == 0:
+                    break
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best)
+            return self._entries[best][1]
+
+    def put(self, key, features):
+        model_name, scope, probe_hash, probe_thumbnail = key
+        cached_key = (model_name, scope, probe_hash.tobytes())
+        with self._lock:
+            self._entries.pop(cached_key, None)
+            self._entries[cached_key] = (time.monotonic(), tuple(features), probe_thumbnail)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def nbytes(self):
+        with self._lock:
+            total = 0
+            for (_, _, probe_hash), (_, features, probe_thumbnail) in self._entries.items():
+                total += len(probe_hash) + probe_thumbnail.nbytes
+                total += sum(f.nbytes for f in features if f is not None)
+            return total
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "bytes": self.nbytes(),
+        }
@@ -0,0 +1,111 @@
+import struct
+
+import cv2
+import numpy as np
+
+
+# Compact probe envelope posted to /upload_probe as application/octet-stream:
+#   magic "FPRB" | version u8 | format u8 | width u16 | height u16 | flags u8 |
+#   lab_id length u8 | lab_id | [face box: 4 x u16] | payload
+# The payload is a small pre-cropped face region, so the server neither
+# decodes a full frame nor runs detection. With the face box flag set, the
+# box locates the face inside the crop; otherwise the whole crop is the face.
+MAGIC = b"FPRB"
+VERSION = 1
+HEADER = struct.Struct("<4sBBHHBB")
+BOX = struct.Struct("<4H")
+
+FORMAT_BGR = 1
+FORMAT_GRAY = 2
+FORMAT_JPEG = 3
+FORMATS = {"bgr": FORMAT_BGR, "gray": FORMAT_GRAY, "jpeg": FORMAT_JPEG}
+
+FLAG_FACE_BOX = 1
+
+# Largest crop a client may send; larger probes belong on /upload_image
+MAX_SIDE = 512
+
+
+def crop_probe(frame, face_box, size=160, margin=0.25):
+    """Cut a square ``size`` x ``size`` region around ``face_box`` out of a
+    frame; returns the crop and the face box in crop coordinates."""
+    x, y, w, h = (int(v) for v in face_box)
+    side = int(max(w, h) * (1 + 2 * margin))
+    cx, cy = x + w // 2, y + h // 2
+    x0 = min(max(0, cx - side // 2), max(0, frame.shape[1] - side))
+    y0 = min(max(0, cy - side // 2), max(0, frame.shape[0] - side))
+    region = frame[y0:y0 + side, x0:x0 + side]
+    scale = size / max(region.shape[:2])
+    crop = cv2.resize(region, (size, size))
+    box = (int((x - x0) * scale), int((y - y0) * scale), int(w * scale), int(h * scale))
+    return crop, box
+
+
+def encode_probe(crop, lab_id, face_box=None, format="jpeg", quality=90):
+    code = FORMATS[format]
+    if code == FORMAT_GRAY and crop.ndim == 3:
+        crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    height, width = crop.shape[:2]
+    if code == FORMAT_JPEG:
+        ok, encoded = cv2.imencode(".jpg", crop, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise ValueError("Failed to encode probe")
+        payload = encoded.tobytes()
+    else:
+        payload = np.ascontiguousarray(crop, dtype=np.uint8).tobytes()
+
+    lab = str(lab_id).encode("utf-8")
+    flags = FLAG_FACE_BOX if face_box is not None else 0
+    header = HEADER.pack(MAGIC, VERSION, code, width, height, flags, len(lab))
+    box = BOX.pack(*(max(0, int(v)) for v in face_box)) if face_box is not None else b""
+    return header + lab + box + payload
+
+
+def decode_probe(data):
+    """Return (BGR image, lab_id, face_box or None) from an envelope.
+
+    Raises ValueError for anything malformed.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("Probe envelope is truncated")
+    magic, version, code, width, height, flags, lab_length = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a probe envelope")
+    if version != VERSION:
+        raise ValueError(f"Unsupported probe version: {version}")
+    if not 0 < width <= MAX_SIDE or not 0 < height <= MAX_SIDE:
+        raise ValueError(f"Probe must be at most {MAX_SIDE}x{MAX_SIDE}")
+
+    offset = HEADER.size + lab_length
+    if flags & FLAG_FACE_BOX:
+        offset += BOX.size
+    if len(data) <= offset:
+        raise ValueError("Probe envelope is truncated")
+    lab_id = bytes(data[HEADER.size:HEADER.size + lab_length]).decode("utf-8")
+    if not lab_id:
+        raise ValueError("Missing 'lab_id' in probe")
+    face_box = None
+    if flags & FLAG_FACE_BOX:
+        face_box = BOX.unpack_from(data, offset - BOX.size)
+        if face_box[2] == 0 or face_box[3] == 0:
+            raise ValueError("'face_box' must have a positive size")
+
+    payload = memoryview(data)[offset:]
+    if code == FORMAT_JPEG:
+        try:
+            img = cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_COLOR)
+        except cv2.error:
+            img = None
+        if img is None:
+            raise ValueError("Failed to decode image")
+    elif code in (FORMAT_BGR, FORMAT_GRAY):
+        channels = 3 if code == FORMAT_BGR else 1
+        if len(payload) != width * height * channels:
+            raise ValueError("Probe payload does not match its size")
+        img = np.frombuffer(payload, np.uint8).reshape(height, width, channels)
+        if code == FORMAT_GRAY:
+            # The model takes three channels
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    else:
+        raise ValueError(f"Unsupported probe format: {code}")
+    return img, lab_id, face_box
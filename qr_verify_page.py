@@ -8,7 +8,8 @@ from libcamera import controls
 from pyzbar.pyzbar import decode
 from custom_button import CustomButton2, CustomButton2_false
 import datetime
-from aws_connect import connect_to_rds
+from aws_connect import access_journal, connect_to_rds, reservation_cache
+from reservation_cache import minutes_away
 from unlock_page import UnlockWindow
 import numpy as np
 import cv2
@@ -153,71 +154,35 @@ class QR_CameraWindow(QMainWindow):
 
     def verify_reservation(self, reservation_id):
         try:
-            # Connect to database
-            db_conn = connect_to_rds()
-            cursor = db_conn.cursor()
-
-            # Query the reservations table for the reservation_id
-            cursor.execute("SELECT * FROM reservations WHERE reservation_id = %s", (reservation_id,))
-            reservation = cursor.fetchone()
-
-            if not reservation:
-                QMessageBox.warning(self, "Error", "No reservation found for this ID.")
-                self.status_label.setText("Please show your QR code") 
-                return
-
-            # Extract reservation details
-            lab_id_db, user_id, reservation_date, time, verified = reservation[1], reservation[2], reservation[3], reservation[4], reservation[5]
-
-            # Check if the reservation is verified
-            if verified != 1:
-                QMessageBox.warning(self, "Unverified Reservation", "This reservation is not verified.")
-                self.status_label.setText("Please show your QR code") 
-                return
-
-            # Check if the lab_id matches
-            if lab_id_db != self.lab_id:
-                QMessageBox.warning(self, "Wrong Lab", "The reservation is for a different lab.")
-                self.status_label.setText("Please show your QR code") 
-                return
-            # Check if the reservation date is valid
-            current_date = datetime.date.today()
-            #reservation_date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
-            print(reservation_date)
-            if reservation_date != current_date:
-                if reservation_date < current_date:
-                    QMessageBox.warning(self, "Past Reservation", "This reservation date has passed.")
-                else:
-                    QMessageBox.warning(self, "Future Reservation", "This reservation is for a future date.")
-                self.status_label.setText("Please show your QR code") 
+            # Today's verified reservations for this lab are cached, so a valid
+            # QR code is resolved without a database round trip
+            reservation = reservation_cache.find(self.lab_id, reservation_id)
+            if reservation is None and self.explain_rejected_reservation(reservation_id):
+                # Booked after the cache was loaded; reload this lab's day once
+                reservation_cache.invalidate(self.lab_id)
+                reservation = reservation_cache.find(self.lab_id, reservation_id)
+            if reservation is None:
                 return
 
-            # Check if the current time is within 5 minutes of the reservation time
-            current_time = datetime.datetime.now().strftime("%H:%M")
-            reservation_time = time
-
-            current_time_obj = datetime.datetime.strptime(current_time, "%H:%M")
-            reservation_time_obj = datetime.datetime.strptime(reservation_time, "%H:%M")
             # Allow a 5-minute window before and after the reservation time
-            time_diff = abs((current_time_obj - reservation_time_obj).total_seconds()) / 60
+            time_diff = minutes_away(reservation, datetime.datetime.now())
 
             if time_diff <= 5:
-                # Step 9: Unlock window and update 'checked' to 1
+                # Step 9: Journal the check-in ('checked' is set to 1 in the
+                # background) and unlock
+                access_journal.record(self.lab_id, "qr", True, reservation.user_id, reservation_id)
+                reservation_cache.mark_checked(self.lab_id, reservation_id)
                 if self.picam2:
                     self.picam2.stop()
                     self.picam2.close()
                     self.picam2 = None
                 self.timer.stop()
-                self.unlock_window = UnlockWindow(self.lab_id, self.lab_name, user_id)
+                self.unlock_window = UnlockWindow(self.lab_id, self.lab_name, reservation.user_id)
                 self.unlock_window.show()
                 self.close()
-                
-                cursor.execute(
-                    "UPDATE reservations SET checked = 1 WHERE reservation_id = %s",
-                    (reservation_id,)
-                )
-                db_conn.commit()
             else:
+                access_journal.record(self.lab_id, "qr", False, reservation.user_id,
+                                      message="Outside the reservation time window")
                 QMessageBox.warning(self, "Not Now","Outside the reservation time window")
                 self.status_label.setText("Please show your QR code") 
             
@@ -225,8 +190,44 @@ class QR_CameraWindow(QMainWindow):
             QMessageBox.critical(self, "Database Error", f"An error occurred: {str(e)}")
         finally:
             self.is_qr_processed = False
-            if 'db_conn' in locals() and db_conn:
-                db_conn.close()
+
+    def explain_rejected_reservation(self, reservation_id):
+        # Not in the cache; look the reservation up to tell the student why.
+        # Returns True if it is in fact valid for this lab today.
+        db_conn = connect_to_rds()
+        try:
+            cursor = db_conn.cursor()
+
+            # Query the reservations table for the reservation_id
+            cursor.execute("SELECT lab_id, date, verified FROM reservations WHERE reservation_id = %s",
+                           (reservation_id,))
+            reservation = cursor.fetchone()
+
+            if not reservation:
+                QMessageBox.warning(self, "Error", "No reservation found for this ID.")
+                self.status_label.setText("Please show your QR code") 
+                return False
+
+            # Extract reservation details
+            lab_id_db, reservation_date, verified = reservation
+
+            # Check if the reservation is verified
+            if verified != 1:
+                QMessageBox.warning(self, "Unverified Reservation", "This reservation is not verified.")
+            # Check if the lab_id matches
+            elif lab_id_db != self.lab_id:
+                QMessageBox.warning(self, "Wrong Lab", "The reservation is for a different lab.")
+            # Check if the reservation date is valid
+            elif reservation_date == datetime.date.today():
+                return True
+            elif reservation_date < datetime.date.today():
+                QMessageBox.warning(self, "Past Reservation", "This reservation date has passed.")
+            else:
+                QMessageBox.warning(self, "Future Reservation", "This reservation is for a future date.")
+            self.status_label.setText("Please show your QR code") 
+            return False
+        finally:
+            db_conn.close()
 
     def start_face_detection(self):
         from face_verify_page import CameraWindow
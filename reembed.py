@@ -0,0 +1,244 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from embedding_codec import encode_embedding, read_header
+
+logger = logging.getLogger(__name__)
+
+
+# Embeddings per model version. A re-embedding run writes here under its own
+# tag, so the features the server uses today stay untouched until the new
+# set is complete and promoted into user_img.features.
+EMBEDDINGS_DDL = """
+    CREATE TABLE IF NOT EXISTS user_img_embeddings (
+        user_id VARCHAR(64) NOT NULL,
+        model_tag VARCHAR(64) NOT NULL,
+        features MEDIUMBLOB NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (model_tag, user_id)
+    )
+"""
+
+
+def install_embeddings_table(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(EMBEDDINGS_DDL)
+    connection.commit()
+
+
+class Checkpoint:
+    """Progress of one re-embedding run, kept in a small JSON file.
+
+    Written after every committed chunk (via a temp file and rename, so a
+    crash never leaves it half written); a restarted run continues after
+    ``last_id``.
+    """
+
+    def __init__(self, path, model_tag):
+        self.path = path
+        self.model_tag = model_tag
+        self.last_id = None
+        self.embedded = 0
+        self.failed = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state.get("model_tag") != model_tag:
+                raise ValueError(f"{path} belongs to model tag {state.get('model_tag')!r}, not {model_tag!r}")
+            self.last_id = state["last_id"]
+            self.embedded = state["embedded"]
+            self.failed = state["failed"]
+
+    def save(self):
+        state = {"model_tag": self.model_tag, "last_id": self.last_id,
+                 "embedded": self.embedded, "failed": self.failed}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+
+def fetch_chunk(connection, last_id, chunk_size):
+    # Keyset pagination: every chunk is an index range scan, however far in
+    with connection.cursor() as cursor:
+        if last_id is None:
+            cursor.execute(
+                "SELECT id, photo_path FROM user_img WHERE photo_path IS NOT NULL ORDER BY id LIMIT %s",
+                (chunk_size,)
+            )
+        else:
+            cursor.execute(
+                "SELECT id, photo_path FROM user_img WHERE photo_path IS NOT NULL AND id > %s ORDER BY id LIMIT %s",
+                (last_id, chunk_size)
+            )
+        return cursor.fetchall()
+
+
+def reembed(connection, fetch_image, embed_batch, model_name, alignment, model_tag, checkpoint,
+            chunk_size=256, batch_size=32, download_workers=16, dtype="float32"):
+    """Embed every user_img photo into user_img_embeddings under ``model_tag``.
+
+    ``fetch_image(photo_path)`` returns a decoded BGR image or None and runs
+    on ``download_workers`` threads; the next chunk is downloaded while the
+    current one is embedded. ``embed_batch(images)`` returns one vector (or
+    None) per image. Each chunk is committed before the checkpoint moves on.
+    Vectors are stored with ``alignment``, the detector ``embed_batch`` uses.
+    """
+    started = time.monotonic()
+    done_this_run = 0
+
+    with ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="reembed-download") as downloads:
+        def download(rows):
+            return rows, [downloads.submit(fetch_image, photo_path) for _, photo_path in rows]
+
+        def image_or_none(future, user_id):
+            try:
+                return future.result()
+            except Exception as e:
+                logger.error(f"Failed to download photo for user {user_id}: {e}")
+                return None
+
+        rows = fetch_chunk(connection, checkpoint.last_id, chunk_size)
+        pending = download(rows) if rows else None
+        while pending is not None:
+            rows, futures = pending
+            next_rows = fetch_chunk(connection, rows[-1][0], chunk_size)
+            pending = download(next_rows) if next_rows else None
+
+            images = [(user_id, image_or_none(future, user_id)) for (user_id, _), future in zip(rows, futures)]
+            images = [(user_id, img) for user_id, img in images if img is not None]
+            values = []
+            for start in range(0, len(images), batch_size):
+                batch = images[start:start + batch_size]
+                features = embed_batch([img for _, img in batch])
+                values.extend((user_id, model_tag, encode_embedding(feature, model_name, dtype, alignment))
+                              for (user_id, _), feature in zip(batch, features) if feature is not None)
+
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    "INSERT INTO user_img_embeddings (user_id, model_tag, features) VALUES (%s, %s, %s) "
+                    "ON DUPLICATE KEY UPDATE features = VALUES(features), created_at = CURRENT_TIMESTAMP",
+                    values
+                )
+            connection.commit()
+
+            checkpoint.last_id = rows[-1][0]
+            checkpoint.embedded += len(values)
+            checkpoint.failed += len(rows) - len(values)
+            checkpoint.save()
+
+            done_this_run += len(rows)
+            rate = done_this_run / max(time.monotonic() - started, 1e-9)
+            logger.info(f"{checkpoint.embedded} embedded, {checkpoint.failed} failed "
+                        f"(last id {checkpoint.last_id}, {rate:.1f} images/s)")
+
+    return done_this_run, time.monotonic() - started
+
+
+def promote(connection, model_tag, alignment):
+    """Copy the ``model_tag`` embeddings into user_img.features.
+
+    The change-log triggers pick the rows up, so running servers switch over
+    on their next gallery sync; they must already be running the new model.
+    ``alignment`` is the server's face alignment: servers drop embeddings
+    aligned by another detector, so a tag embedded with a different one is
+    refused (ValueError) rather than emptying their galleries.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT features FROM user_img_embeddings WHERE model_tag = %s LIMIT 1", (model_tag,))
+        row = cursor.fetchone()
+        if row is None:
+            return 0
+        recorded = read_header(row[0])[1]
+        if recorded != alignment:
+            raise ValueError(f"{model_tag} was aligned with {recorded}, the server aligns with {alignment}")
+        cursor.execute(
+            "UPDATE user_img u JOIN user_img_embeddings e ON e.user_id = u.id AND e.model_tag = %s "
+            "SET u.features = e.features",
+            (model_tag,)
+        )
+        promoted = cursor.rowcount
+    connection.commit()
+    return promoted
+
+
+if __name__ == '__main__':
+    import argparse
+    import cv2
+    import numpy as np
+    import pymysql
+    from config import DB_CONFIG
+    from embedding import load_model, represent_batch
+    from face_detection import FaceDetector
+    from photo_store import open_store
+
+    parser = argparse.ArgumentParser(description="Re-embed every user_img photo under a model version tag")
+    parser.add_argument("--model-name", default="ArcFace")
+    parser.add_argument("--backend", choices=["deepface", "onnx"], default="deepface",
+                        help="embedding backend; use the server's embedding_backend")
+    parser.add_argument("--onnx-model", default="arcface.onnx", help="ONNX graph for --backend onnx")
+    parser.add_argument("--onnx-threads", type=int, default=0, help="ONNX Runtime intra-op threads (0: auto)")
+    parser.add_argument("--model-tag", help="version tag for the new embeddings (default: model name and detector)")
+    parser.add_argument("--detector", choices=["mtcnn", "yunet", "none"], default="none",
+                        help="face alignment before embedding; must match the server's face_detector_backend "
+                             "(none: DeepFace's opencv detection, the server default)")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--download-workers", type=int, default=16)
+    parser.add_argument("--cache-dir", default="photo_cache",
+                        help="local photo cache shared with the server; '' reads S3 directly")
+    parser.add_argument("--cache-max-gb", type=float, default=2.0)
+    parser.add_argument("--photos-dir", help="read photos from this directory instead of S3")
+    parser.add_argument("--checkpoint", help="progress file (default: reembed_<tag>.json)")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    parser.add_argument("--promote", action="store_true",
+                        help="copy the tagged embeddings into user_img.features and exit")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    model_tag = args.model_tag or f"{args.model_name}-{args.detector}"
+    alignment = args.detector if args.detector != "none" else "opencv"
+    checkpoint_path = args.checkpoint or f"reembed_{model_tag}.json"
+
+    with pymysql.connect(**DB_CONFIG) as connection:
+        install_embeddings_table(connection)
+        if args.promote:
+            try:
+                print(f"Promoted {promote(connection, model_tag, alignment)} rows of {model_tag}")
+            except ValueError as e:
+                raise SystemExit(f"Not promoted: {e}; pass the server's --detector")
+            raise SystemExit
+
+        # With a warm cache every photo is read from local disk
+        photos = open_store(args.cache_dir, int(args.cache_max_gb * 1024 ** 3), args.photos_dir,
+                            args.download_workers)
+
+        def fetch_image(photo_path):
+            body = photos.get(photo_path)
+            return cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR)
+
+        model = load_model(args.backend, args.model_name, args.onnx_model, args.onnx_threads)
+        detector = FaceDetector(args.detector) if args.detector != "none" else None
+
+        def embed_batch(images):
+            if detector is None:
+                return represent_batch(model, images, detector_backend="opencv")
+            faces = [detector.extract(img) for img in images]
+            found = [face for face in faces if face is not None]
+            features = iter(represent_batch(model, found, detector_backend="skip") if found else [])
+            return [next(features) if face is not None else None for face in faces]
+
+        if args.restart and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        checkpoint = Checkpoint(checkpoint_path, model_tag)
+        if checkpoint.last_id is not None:
+            print(f"Resuming {model_tag} after id {checkpoint.last_id}")
+
+        total, seconds = reembed(connection, fetch_image, embed_batch, args.model_name, alignment, model_tag,
+                                 checkpoint, args.chunk_size, args.batch_size, args.download_workers, args.dtype)
+    print(f"Done, {total} images in {seconds:.0f}s ({total / max(seconds, 1e-9):.1f} images/s); "
+          f"{checkpoint.embedded} embedded, {checkpoint.failed} failed under {model_tag}")
@@ -0,0 +1,246 @@
+import datetime
+import threading
+import time
+from collections import namedtuple
+
+
+RESERVATIONS_QUERY = """
+    SELECT reservation_id, user_id, date, time, checked FROM reservations
+    WHERE lab_id = %s AND date = %s AND verified = 1
+"""
+
+# Every query on reservations matches lab and day for equality (the check-in
+# goes by primary key), so those two columns are all the index needs
+RESERVATION_INDEX = "reservations_lab_date"
+RESERVATION_INDEX_DDL = f"CREATE INDEX {RESERVATION_INDEX} ON reservations (lab_id, date)"
+
+# Check-in in one round trip: the UPDATE of the cached reservation re-checks
+# its slot against the time window, and cursor.rowcount says whether it still
+# matched. ``time`` is compared as TIME, so "9:30" and "09:30" are the same
+# slot, as for parse_start. Connections must set CLIENT.FOUND_ROWS, or a
+# reservation that is already checked in counts as no match.
+CHECK_IN_QUERY = """
+    UPDATE reservations SET checked = 1
+    WHERE reservation_id = %s AND lab_id = %s AND date = %s AND verified = 1
+        AND CAST(time AS TIME) BETWEEN %s AND %s
+"""
+
+Reservation = namedtuple("Reservation", "reservation_id lab_id user_id date time start checked")
+
+
+def parse_start(date, time_text):
+    return datetime.datetime.combine(date, datetime.datetime.strptime(str(time_text), "%H:%M").time())
+
+
+def minutes_away(reservation, current_time):
+    return abs((current_time - reservation.start).total_seconds()) / 60
+
+
+def window_bounds(current_time, window):
+    """Earliest and latest slot time within ``window`` minutes of
+    ``current_time`` on the same day; agrees with minutes_away."""
+    day_start = datetime.datetime.combine(current_time.date(), datetime.time())
+    delta = datetime.timedelta(minutes=window)
+    earliest = max(current_time - delta, day_start)
+    latest = min(current_time + delta, datetime.datetime.combine(current_time.date(), datetime.time.max))
+    return earliest.time(), latest.time()
+
+
+def check_in_query(lab_id, reservation_id, current_time, window):
+    """(query, params) checking in a reservation if its slot is within
+    ``window`` minutes of ``current_time``."""
+    earliest, latest = window_bounds(current_time, window)
+    return CHECK_IN_QUERY, (reservation_id, lab_id, current_time.date(), earliest, latest)
+
+
+def install_reservation_index(connection):
+    # Any index that starts with (lab_id, date) will do, including the wider
+    # one earlier versions created
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.statistics a "
+            "JOIN information_schema.statistics b ON b.table_schema = a.table_schema "
+            "AND b.table_name = a.table_name AND b.index_name = a.index_name "
+            "WHERE a.table_schema = DATABASE() AND a.table_name = 'reservations' "
+            "AND a.seq_in_index = 1 AND a.column_name = 'lab_id' "
+            "AND b.seq_in_index = 2 AND b.column_name = 'date'"
+        )
+        if cursor.fetchone()[0] == 0:
+            cursor.execute(RESERVATION_INDEX_DDL)
+    connection.commit()
+
+
+class LabDay:
+    """Verified reservations of one lab on one day, indexed both ways."""
+
+    def __init__(self, lab_id, date, reservations):
+        self.lab_id = lab_id
+        self.date = date
+        self.loaded_at = time.monotonic()
+        self.by_id = {r.reservation_id: r for r in reservations}
+        self.by_user = {}
+        for r in sorted(reservations, key=lambda r: r.start):
+            self.by_user.setdefault(r.user_id, []).append(r)
+
+    def open_slots(self, current_time, window):
+        """{user_id: reservation} for reservations within ``window`` minutes of now."""
+        slots = {}
+        for user_id, reservations in self.by_user.items():
+            for r in reservations:
+                if minutes_away(r, current_time) <= window:
+                    slots[user_id] = r
+                    break
+        return slots
+
+
+def match_candidate(gallery, queries, candidates, margin=0.0):
+    """(user_id, distance) of the closest of ``candidates``, or (None, inf)
+    if a student outside them is closer by more than ``margin``.
+
+    Without the second, full-gallery search an enrolled student who looks
+    like a reserved one would be let in under that student's identity.
+    """
+    user_id, distance = gallery.match(*queries, candidates=candidates)
+    if user_id is None:
+        return None, float("inf")
+    nearest_id, nearest_distance = gallery.match(*queries)
+    if nearest_id != user_id and nearest_distance < distance - margin:
+        return None, float("inf")
+    return user_id, distance
+
+
+def decide_access(gallery, lab_day, queries, current_time, threshold, window, candidate_matching=False):
+    """Decide the door outcome for a probe against one lab's reservations.
+
+    ``queries`` are the probe's feature vectors (e.g. the face and its
+    mirror). Returns the response body and the reservation to check in,
+    which is None when the door stays closed.
+
+    The global match alone gives the same decisions, so ``candidate_matching``
+    (a search over the open slots first) is off by default: it only adds
+    gallery searches.
+    """
+    # Reservations whose slot is open right now, by user
+    open_slots = lab_day.open_slots(current_time, window)
+
+    if candidate_matching:
+        matched_student_id, min_distance = match_candidate(gallery, queries, open_slots)
+        if min_distance < threshold:
+            return {"verified": True, "student_id": matched_student_id}, open_slots[matched_student_id]
+
+    # Nobody with an open slot matched; find out who it was so the
+    # kiosk can say why the door stays closed
+    matched_student_id, min_distance = gallery.match(*queries)
+    if min_distance >= threshold:
+        return {"verified": False, "message": "No matching student"}, None
+    if matched_student_id in open_slots:
+        return {"verified": True, "student_id": matched_student_id}, open_slots[matched_student_id]
+    if matched_student_id in lab_day.by_user:
+        return {"verified": False, "message": "Outside the reservation time window"}, None
+    return {"verified": False, "message": "No upcoming reservation found"}, None
+
+
+class ReservationCache:
+    """TTL cache of each lab's verified reservations for a day.
+
+    The first lookup for a (lab_id, date) loads the whole day with one query;
+    later lookups are served from memory until ``ttl`` seconds pass or
+    ``invalidate`` is called (e.g. when the reservation site reports a
+    change). ``mark_checked`` keeps the cached copy in step with check-ins.
+    If a reload fails, the last copy of the day is served for another
+    ``ttl`` seconds, so a DB outage does not stop verification.
+
+    ``connect`` returns a DB connection usable as a context manager.
+    """
+
+    def __init__(self, connect, ttl=60):
+        self.connect = connect
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._days = {}
+        self._lock = threading.Lock()
+
+    def cached(self, lab_id, date):
+        """Return the fresh cached day, or None if it has to be (re)loaded."""
+        with self._lock:
+            day = self._days.get((str(lab_id), date))
+            if day is not None and time.monotonic() - day.loaded_at < self.ttl:
+                self.hits += 1
+                return day
+            self.misses += 1
+            return None
+
+    def stale(self, lab_id, date):
+        """The expired copy of a day to fall back on when reloading it
+        failed, or None; it counts as fresh for another ``ttl`` seconds."""
+        with self._lock:
+            day = self._days.get((str(lab_id), date))
+            if day is not None:
+                day.loaded_at = time.monotonic()
+            return day
+
+    def store(self, lab_id, date, rows):
+        """Build and cache a day from ``RESERVATIONS_QUERY`` rows."""
+        reservations = []
+        for reservation_id, user_id, row_date, time_text, checked in rows:
+            try:
+                start = parse_start(row_date, time_text)
+            except ValueError:
+                continue
+            reservations.append(Reservation(str(reservation_id), lab_id, user_id, row_date,
+                                            time_text, start, bool(checked)))
+        day = LabDay(lab_id, date, reservations)
+        with self._lock:
+            self._days[(str(lab_id), date)] = day
+            # Yesterday's entries are never read again
+            for stale in [k for k in self._days if k[1] < date]:
+                del self._days[stale]
+        return day
+
+    def get(self, lab_id, date=None):
+        date = date or datetime.date.today()
+        day = self.cached(lab_id, date)
+        if day is not None:
+            return day
+        return self.load(lab_id, date)
+
+    def load(self, lab_id, date):
+        """Read a day from the DB and cache it; on a DB error, fall back on
+        the stale copy if there is one."""
+        try:
+            with self.connect() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(RESERVATIONS_QUERY, (lab_id, date))
+                    rows = cursor.fetchall()
+        except Exception:
+            day = self.stale(lab_id, date)
+            if day is None:
+                raise
+            return day
+        return self.store(lab_id, date, rows)
+
+    def find(self, lab_id, reservation_id, date=None):
+        """Cached reservation by id, or None if it is not a verified
+        reservation of this lab on that day."""
+        return self.get(lab_id, date).by_id.get(str(reservation_id))
+
+    def mark_checked(self, lab_id, reservation_id, date=None):
+        date = date or datetime.date.today()
+        with self._lock:
+            day = self._days.get((str(lab_id), date))
+            if day is None:
+                return
+            reservation = day.by_id.get(str(reservation_id))
+            if reservation is None:
+                return
+            updated = reservation._replace(checked=True)
+            day.by_id[updated.reservation_id] = updated
+            day.by_user[updated.user_id] = [updated if r.reservation_id == updated.reservation_id else r
+                                            for r in day.by_user[updated.user_id]]
+
+    def invalidate(self, lab_id=None, date=None):
+        with self._lock:
+            for key in list(self._days):
+                if (lab_id is None or key[0] == str(lab_id)) and (date is None or key[1] == date):
+                    del self._days[key]
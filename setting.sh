@@ -6,10 +6,35 @@ MAIN_APP_PATH="filelamlai/main.py"
 
 echo "Activating virtual environment and starting Flask..."
 source "$VENV_PATH/bin/activate"
+# Async alternative with the same /upload_image API (see asgi_AI.py):
+#   nohup uvicorn asgi_AI:app --host 0.0.0.0 --port 5000 --workers 1 > flask.log 2>&1 &
 nohup python3 "$FLASK_APP_PATH" > flask.log 2>&1 &  
 FLASK_PID=$!  
 echo "Flask started with PID $FLASK_PID"
 
+# The kiosk starts only once the model is warm and the gallery is loaded
+READY_TIMEOUT=300
+echo "Waiting for Flask to become ready..."
+READY=0
+for _ in $(seq 1 $READY_TIMEOUT); do
+    if curl -sf http://localhost:5000/ready > /dev/null; then
+        READY=1
+        echo "Flask is ready"
+        break
+    fi
+    if ! kill -0 $FLASK_PID 2> /dev/null; then
+        echo "Flask exited during startup, see flask.log"
+        exit 1
+    fi
+    sleep 1
+done
+if [ $READY -ne 1 ]; then
+    echo "Flask was not ready after ${READY_TIMEOUT}s, see flask.log"
+    kill $FLASK_PID
+    deactivate
+    exit 1
+fi
+
 deactivate
 
 echo "Running main.py..."
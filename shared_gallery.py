@@ -0,0 +1,187 @@
+import json
+import threading
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from face_index import FaceIndex, as_id_array, normalize_rows, top_k
+
+
+# Layout of a published gallery segment:
+#   header (3 x int64: rows, dim, id bytes) | ids as JSON | padding | float32 matrix
+# A tiny control segment holds the generation number of the current segment.
+HEADER = 3 * 8
+CONTROL_SIZE = 8
+
+
+def _segment_name(name, generation):
+    return f"{name}_{generation}"
+
+
+def _attach(name, untrack=True):
+    segment = shared_memory.SharedMemory(name=name)
+    # Attaching registers the segment with this process's resource tracker,
+    # which unlinks it when the process exits; readers must not take the
+    # owner's segments with them. Only a reader sharing the owner's tracker
+    # (forked after the owner created it) may skip this (untrack=False).
+    if untrack:
+        resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+class SharedGalleryPublisher:
+    """Publishes a gallery's vectors to shared memory for worker processes.
+
+    Each publish writes a fresh read-only segment and then bumps the
+    generation in the control segment, so readers switch over atomically.
+    The previous ``keep`` segments stay linked for readers that are still
+    attaching; mappings already held survive an unlink on Linux.
+    """
+
+    def __init__(self, gallery, name="lab_gallery", keep=2):
+        self.gallery = gallery
+        self.name = name
+        self.keep = keep
+        self.generation = 0
+        self.published_version = None
+        self._segments = []
+        try:
+            stale = shared_memory.SharedMemory(name=f"{name}_ctl")
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        self.control = shared_memory.SharedMemory(name=f"{name}_ctl", create=True, size=CONTROL_SIZE)
+        self._control_view = np.ndarray((1,), dtype=np.int64, buffer=self.control.buf)
+        self._control_view[0] = 0
+
+    def publish(self):
+        version = self.gallery.version
+        ids, matrix = self.gallery.index.vectors()
+        id_bytes = json.dumps([i.item() if hasattr(i, "item") else i for i in ids]).encode("utf-8")
+        offset = HEADER + len(id_bytes)
+        offset += -offset % 8
+        rows, dim = matrix.shape
+
+        generation = self.generation + 1
+        segment = shared_memory.SharedMemory(
+            name=_segment_name(self.name, generation), create=True,
+            size=max(1, offset + matrix.nbytes))
+        np.ndarray((3,), dtype=np.int64, buffer=segment.buf)[:] = (rows, dim, len(id_bytes))
+        segment.buf[HEADER:HEADER + len(id_bytes)] = id_bytes
+        np.ndarray((rows, dim), dtype=np.float32, buffer=segment.buf, offset=offset)[:] = matrix
+
+        self._control_view[0] = generation
+        self.generation = generation
+        self.published_version = version
+        self._segments.append(segment)
+        while len(self._segments) > self.keep:
+            old = self._segments.pop(0)
+            old.close()
+            old.unlink()
+
+    def publish_changes(self, interval=1.0, stop_event=None):
+        """Start a thread that republishes whenever the gallery changes."""
+        stop_event = stop_event or threading.Event()
+
+        def run():
+            while not stop_event.wait(interval):
+                if self.gallery.version != self.published_version:
+                    self.publish()
+
+        threading.Thread(target=run, name="gallery-publisher", daemon=True).start()
+        return stop_event
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+            segment.unlink()
+        self._segments = []
+        self.control.close()
+        self.control.unlink()
+
+
+class SharedIndex(FaceIndex):
+    """Read-only index over the segment published by SharedGalleryPublisher.
+
+    Every search first checks the generation counter (one shared-memory read)
+    and re-attaches when the owner has published a newer gallery, so workers
+    see updates without loading anything from the database. Searches are
+    exact over float32, whatever index the owner uses.
+    """
+
+    kind = "shared"
+
+    def __init__(self, name="lab_gallery", dim=512, untrack=True):
+        super().__init__(dim)
+        self.name = name
+        self.untrack = untrack
+        self.control = _attach(f"{name}_ctl", untrack)
+        self._control_view = np.ndarray((1,), dtype=np.int64, buffer=self.control.buf)
+        self._generation = None
+        self._segment = None
+        self._retired = []
+        self._ids = as_id_array([])
+        self._matrix = np.empty((0, dim), dtype=np.float32)
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        generation = int(self._control_view[0])
+        if generation == self._generation or generation == 0:
+            return
+        with self._lock:
+            if generation == self._generation:
+                return
+            try:
+                segment = _attach(_segment_name(self.name, generation), self.untrack)
+            except FileNotFoundError:
+                # Superseded while we were attaching; pick it up next time
+                return
+            rows, dim, id_length = (int(v) for v in np.ndarray((3,), dtype=np.int64, buffer=segment.buf))
+            ids = as_id_array(json.loads(bytes(segment.buf[HEADER:HEADER + id_length]).decode("utf-8")))
+            offset = HEADER + id_length
+            offset += -offset % 8
+            matrix = np.ndarray((rows, dim), dtype=np.float32, buffer=segment.buf, offset=offset)
+            matrix.flags.writeable = False
+
+            if self._segment is not None:
+                self._retired.append(self._segment)
+            self._ids, self._matrix = ids, matrix
+            self._rows = {user_id: row for row, user_id in enumerate(ids)}
+            self._segment, self._generation = segment, generation
+
+            # Old mappings can only be closed once no search still uses them
+            still_used = []
+            for old in self._retired:
+                try:
+                    old.close()
+                except BufferError:
+                    still_used.append(old)
+            self._retired = still_used
+
+    def __len__(self):
+        self._refresh()
+        return len(self._ids)
+
+    def vectors(self):
+        self._refresh()
+        with self._lock:
+            return self._ids, self._matrix
+
+    def get(self, ids):
+        self._refresh()
+        with self._lock:
+            all_ids, matrix, positions = self._ids, self._matrix, self._rows
+        rows = [positions[user_id] for user_id in ids if user_id in positions]
+        return all_ids[rows], matrix[rows]
+
+    def search(self, queries, k=1):
+        ids, matrix = self.vectors()
+        queries = normalize_rows(queries).reshape(-1, self.dim)
+        return top_k(ids, matrix @ queries.T, k)
+
+    def _read_only(self, *args, **kwargs):
+        raise NotImplementedError("The shared gallery is only updated by its owner process")
+
+    replace = add = remove = _read_only
@@ -0,0 +1,78 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from enrollment import EnrollmentPipeline
+
+
+class FakeCursor:
+    def __init__(self, rows, writes):
+        self.rows = rows
+        self.writes = writes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=()):
+        pass
+
+    def executemany(self, query, rows):
+        self.writes.extend(rows)
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, rows, writes):
+        self.rows = rows
+        self.writes = writes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self):
+        return FakeCursor(self.rows, self.writes)
+
+    def commit(self):
+        pass
+
+
+def test_embed_failure_does_not_stop_the_inference_thread():
+    rows = [("broken", "broken.jpg"), ("ok", "ok.jpg")]
+    writes = []
+    stored = threading.Event()
+
+    def embed(image):
+        if image == "broken.jpg":
+            raise RuntimeError("no face")
+        return [1.0]
+
+    pipeline = EnrollmentPipeline(
+        connect=lambda: FakeConnection(rows, writes),
+        fetch_image=lambda photo_path: photo_path,
+        embed=embed,
+        encode=repr,
+        on_embedded=lambda batch: stored.set(),
+        interval=60, download_workers=1, flush_interval=0.05,
+    )
+    pipeline.start()
+    try:
+        assert stored.wait(5)
+    finally:
+        pipeline.stop()
+
+    deadline = time.monotonic() + 5
+    while pipeline.pending() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert writes == [("[1.0]", "ok")]
+    assert pipeline.pending() == 0
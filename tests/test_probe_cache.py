@@ -0,0 +1,56 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from probe_cache import ProbeCache, perceptual_hash
+
+FEATURES = (np.ones(4, dtype=np.float32), None)
+
+
+def face(rng):
+    # Smooth random texture at the size of an aligned crop
+    small = rng.integers(0, 256, (14, 14, 3), dtype=np.uint8)
+    return cv2.GaussianBlur(cv2.resize(small, (112, 112), interpolation=cv2.INTER_CUBIC), (0, 0), 2)
+
+
+def same_hash_face(image, rng, size=16):
+    # A different image whose 16x16 difference hash is identical: every
+    # pixel keeps the sign of its step to the right neighbour, with new steps
+    grey = cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (size + 1, size), interpolation=cv2.INTER_AREA)
+    brighter = grey[:, 1:] > grey[:, :-1]
+    steps = rng.integers(4, 12, brighter.shape)
+    rows = np.hstack([rng.integers(60, 90, (size, 1)), np.where(brighter, steps, -steps)]).cumsum(axis=1)
+    other = cv2.resize(rows.astype(np.uint8), ((size + 1) * 8, size * 8), interpolation=cv2.INTER_NEAREST)
+    return cv2.cvtColor(other, cv2.COLOR_GRAY2BGR)
+
+
+def test_near_duplicate_frame_hits():
+    rng = np.random.default_rng(0)
+    cache = ProbeCache()
+    image = face(rng)
+    cache.put(cache.key(image, "ArcFace", "101"), FEATURES)
+    noisy = np.clip(image + rng.normal(0, 2, image.shape), 0, 255).astype(np.uint8)
+    assert cache.get(cache.key(noisy, "ArcFace", "101")) == FEATURES
+
+
+def test_different_faces_with_the_same_hash_do_not_hit():
+    rng = np.random.default_rng(1)
+    cache = ProbeCache()
+    image = face(rng)
+    other = same_hash_face(image, rng)
+    assert (perceptual_hash(image) == perceptual_hash(other)).all()
+    cache.put(cache.key(image, "ArcFace", "101"), FEATURES)
+    assert cache.get(cache.key(other, "ArcFace", "101")) is None
+
+
+def test_other_lab_does_not_hit():
+    rng = np.random.default_rng(2)
+    cache = ProbeCache()
+    image = face(rng)
+    cache.put(cache.key(image, "ArcFace", "101"), FEATURES)
+    assert cache.get(cache.key(image, "ArcFace", "102")) is None
+    assert cache.get(cache.key(image, "ArcFace", "101")) == FEATURES
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from probe_protocol import HEADER, decode_probe, encode_probe
+
+
+def probe(**kwargs):
+    crop = np.full((32, 32, 3), 128, dtype=np.uint8)
+    return encode_probe(crop, "lab1", **kwargs)
+
+
+def test_round_trip():
+    img, lab_id, face_box = decode_probe(probe(face_box=(2, 3, 20, 24), format="bgr"))
+    assert img.shape == (32, 32, 3)
+    assert lab_id == "lab1"
+    assert face_box == (2, 3, 20, 24)
+
+
+@pytest.mark.parametrize("data", [
+    # Cut inside the face box
+    probe(face_box=(2, 3, 20, 24))[:HEADER.size + 4 + 5],
+    # No JPEG payload at all
+    probe()[:HEADER.size + 4],
+    # A payload that is not a JPEG
+    probe()[:HEADER.size + 4] + b"\xff",
+])
+def test_malformed_probe_raises_value_error(data):
+    with pytest.raises(ValueError):
+        decode_probe(data)
@@ -0,0 +1,52 @@
+import datetime
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gallery import EmbeddingGallery
+from reservation_cache import LabDay, Reservation, decide_access, parse_start
+
+DIM = 8
+NOW = datetime.datetime(2024, 11, 4, 9, 30)
+
+
+def unit(*values):
+    vector = np.zeros(DIM, dtype=np.float32)
+    vector[:len(values)] = values
+    return vector / np.linalg.norm(vector)
+
+
+def lab_day(*user_ids):
+    reservations = [
+        Reservation(n, "lab1", user_id, NOW.date(), "9:30", parse_start(NOW.date(), "9:30"), 0)
+        for n, user_id in enumerate(user_ids, 1)
+    ]
+    return LabDay("lab1", NOW.date(), reservations)
+
+
+def make_gallery(**vectors):
+    gallery = EmbeddingGallery(dim=DIM)
+    gallery.apply_changes(vectors)
+    return gallery
+
+
+def test_reserved_student_is_let_in():
+    gallery = make_gallery(alice=unit(1, 0), bob=unit(0, 1))
+    body, reservation = decide_access(gallery, lab_day("alice"), [unit(1, 0.1)], NOW, threshold=0.6, window=5)
+    assert body == {"verified": True, "student_id": "alice"}
+    assert reservation.user_id == "alice"
+
+
+@pytest.mark.parametrize("candidate_matching", [False, True])
+def test_closer_unreserved_lookalike_is_not_let_in_as_reserved_student(candidate_matching):
+    # The probe is within threshold of alice, who has a reservation, but
+    # closer still to mallory, who has none
+    gallery = make_gallery(alice=unit(1, 0), mallory=unit(1, 0.3))
+    body, reservation = decide_access(gallery, lab_day("alice"), [unit(1, 0.25)], NOW, threshold=0.6, window=5,
+                                      candidate_matching=candidate_matching)
+    assert reservation is None
+    assert body["verified"] is False
@@ -0,0 +1,84 @@
+import datetime
+
+import cv2
+import numpy as np
+
+from reservation_cache import decide_access, match_candidate
+
+
+def frame_quality(face):
+    """Weight of a face crop in the fused embedding: its sharpness (variance
+    of the Laplacian), so blurred frames from a moving head count less."""
+    gray = cv2.cvtColor(face, cv2.COLOR_BGR2GRAY) if face.ndim == 3 else face
+    sharpness = cv2.Laplacian(gray, cv2.CV_32F).var()
+    return float(np.clip(sharpness / 100.0, 0.05, 1.0))
+
+
+class VerificationSession:
+    """Fuses the frames of one approach to the door into a single decision.
+
+    The lab's reservations are looked up once, when the session opens. Each
+    frame's embedding pair is added to a quality-weighted mean of unit
+    vectors. The door opens as soon as the fused embedding is within
+    ``confident_distance`` of a student with an open slot, or within
+    ``threshold`` once that student also won ``min_votes`` single frames.
+    After ``max_frames`` without a match the session ends with the usual
+    rejection reason for the fused embedding.
+    """
+
+    def __init__(self, gallery, lab_day, threshold, window, confident_distance=None,
+                 min_votes=2, max_frames=10, current_time=None):
+        self.gallery = gallery
+        self.lab_day = lab_day
+        self.threshold = threshold
+        self.window = window
+        self.confident_distance = confident_distance if confident_distance is not None else 0.8 * threshold
+        self.min_votes = min_votes
+        self.max_frames = max_frames
+        self.opened_at = current_time or datetime.datetime.now()
+        self.open_slots = lab_day.open_slots(self.opened_at, window)
+        self.frames = 0
+        self.votes = {}
+        self._sum = None
+        self._weight = 0.0
+
+    def fused(self):
+        if self._sum is None or self._weight == 0:
+            return None
+        return self._sum / max(np.linalg.norm(self._sum), 1e-12)
+
+    def add(self, features, quality=1.0):
+        """Add one frame's (feature, mirrored feature); returns the final
+        (response, reservation) once decided, or None to ask for more frames."""
+        probes = [np.asarray(f, dtype=np.float32) for f in features if f is not None]
+        if not probes:
+            return None
+        self.frames += 1
+        frame = np.mean([p / max(np.linalg.norm(p), 1e-12) for p in probes], axis=0)
+        self._sum = frame * quality if self._sum is None else self._sum + frame * quality
+        self._weight += quality
+
+        # Only reserved students who are also the nearest enrolled face count
+        frame_user, frame_distance = match_candidate(self.gallery, probes, self.open_slots)
+        if frame_distance < self.threshold:
+            self.votes[frame_user] = self.votes.get(frame_user, 0) + 1
+
+        user, distance = match_candidate(self.gallery, (self.fused(),), self.open_slots)
+        if distance < self.confident_distance or (
+                distance < self.threshold and self.votes.get(user, 0) >= self.min_votes):
+            return {"verified": True, "student_id": user, "frames": self.frames}, self.open_slots[user]
+        if self.frames >= self.max_frames:
+            return self.finish()
+        return None
+
+    def finish(self, current_time=None):
+        """Decide on what has been seen so far, e.g. when the kiosk stops
+        sending because the face left the frame."""
+        fused = self.fused()
+        if fused is None:
+            return {"verified": False, "message": "No face detected", "frames": self.frames}, None
+        response, reservation = decide_access(self.gallery, self.lab_day, (fused,),
+                                              current_time or datetime.datetime.now(),
+                                              self.threshold, self.window)
+        response["frames"] = self.frames
+        return response, reservation